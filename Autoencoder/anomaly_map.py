@@ -0,0 +1,96 @@
+"""
+Localization of the anomalies of a sheet from the reconstruction of the autoencoder.
+
+The squared error of every pixel is downscaled to a heatmap in the geometry of the sheet, and the areas of a high
+error become anomaly regions. The anomaly worker sends only the heatmap, the regions and the reconstruction error
+to the main process instead of the full reconstructed image.
+"""
+import cv2
+import numpy as np
+
+from Autoencoder.tiling import fabric_pixels
+from data_transfer.dtos import AnomalyResult, EvalBox
+from libs.pyramid import ImagePyramid
+
+# squared error of a pixel shown with the full intensity of the heatmap
+HEATMAP_MAX_ERROR = 0.1
+# heatmap pixels with a higher squared error, averaged over the area of the heatmap pixel, are anomalies
+REGION_ERROR_THRESHOLD = 0.04
+# smaller regions, in px of the heatmap, are noise
+MIN_REGION_PIXELS = 16
+ANOMALY_LABEL = "anomaly"
+
+
+def error_map(input_image, reconstructed_image: np.ndarray) -> np.ndarray:
+    '''
+    Squared error of every pixel of the reconstruction, averaged over the color channels.
+
+    Parameters:
+        input_image: the blacked out sheet (BGR) or an image pyramid of it, scaled to the reconstruction like the
+            model input.
+        reconstructed_image: the reconstruction of the autoencoder (BGR).
+
+    Returns:
+        errors: the errors in the geometry of the reconstruction, 0 on the background and its border.
+    '''
+    pyramid = input_image if isinstance(input_image, ImagePyramid) else ImagePyramid(input_image)
+    height, width = reconstructed_image.shape[:2]
+    original = pyramid.level(pyramid.level_for_size(width, height))
+    if original.shape[:2] != (height, width):
+        original = cv2.resize(original, (width, height), interpolation=cv2.INTER_AREA)
+    difference = (original.astype(np.float32) - reconstructed_image.astype(np.float32)) / 255
+    errors = np.mean(difference ** 2, axis=2)
+    errors[~fabric_pixels(original)] = 0
+    return errors
+
+
+def anomaly_regions(errors: np.ndarray, scale: float, width: int, height: int) -> list[EvalBox]:
+    '''
+    The connected areas of the heatmap errors above REGION_ERROR_THRESHOLD.
+
+    Parameters:
+        errors: the errors at the heatmap size.
+        scale: scale of the heatmap relative to the sheet.
+        width: width of the sheet.
+        height: height of the sheet.
+
+    Returns:
+        list[eval_box]: one box per region in px of the sheet, precision is the highest error of the region.
+    '''
+    count, labels, stats, _ = cv2.connectedComponentsWithStats((errors > REGION_ERROR_THRESHOLD).astype(np.uint8),
+                                                               connectivity=8)
+    regions = []
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+        if area < MIN_REGION_PIXELS:
+            continue
+        region_errors = errors[y:y + h, x:x + w][labels[y:y + h, x:x + w] == label]
+        regions.append(EvalBox(top_left=(int(x / scale), int(y / scale)),
+                               bottom_right=(min(round((x + w) / scale), width), min(round((y + h) / scale), height)),
+                               precision=float(region_errors.max()),
+                               label=ANOMALY_LABEL))
+    return regions
+
+
+def anomaly_result(input_image, reconstructed_image: np.ndarray, reconstruction_error: float,
+                   heatmap_scale: float = 0.25, with_reconstruction: bool = False) -> AnomalyResult:
+    '''
+    The compact result of the anomaly detection of a sheet.
+
+    Parameters:
+        input_image: the blacked out sheet (BGR) the reconstruction was computed from, or an image pyramid of it.
+        reconstructed_image: the reconstruction of the autoencoder (BGR).
+        reconstruction_error: the error of the sheet computed by the detector.
+        heatmap_scale: scale of the heatmap relative to the sheet.
+        with_reconstruction: keep the reconstructed image in the result.
+
+    Returns:
+        anomaly_result: heatmap, regions and error of the sheet.
+    '''
+    pyramid = input_image if isinstance(input_image, ImagePyramid) else ImagePyramid(input_image)
+    height, width = pyramid.image.shape[:2]
+    size = (max(1, round(width * heatmap_scale)), max(1, round(height * heatmap_scale)))
+    errors = cv2.resize(error_map(pyramid, reconstructed_image), size, interpolation=cv2.INTER_AREA)
+    heatmap = (np.clip(errors / HEATMAP_MAX_ERROR, 0, 1) * 255).astype(np.uint8)
+    return AnomalyResult(heatmap, float(reconstruction_error), anomaly_regions(errors, heatmap_scale, width, height),
+                         reconstructed_image if with_reconstruction else None)
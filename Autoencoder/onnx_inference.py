@@ -0,0 +1,103 @@
+import json
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from Autoencoder.tiling import reconstruct_image_tiled
+from data_transfer.dtos import AnomalyTilingConfig, OnnxSessionConfig
+from libs.onnx_session import create_inference_session
+from libs.pyramid import ImagePyramid
+
+
+class OnnxAnomalyDetector(object):
+    """
+    The autoencoder of AnomalyDetectionAutoencoder exported to onnx (export_autoencoder_onnx.py), run with
+    onnxruntime. The preprocessing and the results are the same, but neither torch nor torchvision are imported.
+    """
+    INPUT_SIZE = (2048, 2048)  # width, height of the model input
+
+    def __init__(self, model_path, num_threads=0,
+                 session_config_path='./err_detection/configurations/onnx_session.json',
+                 tiling_config_path='./Autoencoder/configurations/tiling.json'):
+        """
+        Load the exported model with the session options of the material error detection.
+
+        Parameters:
+        - model_path: the onnx model of export_autoencoder_onnx.py
+        - num_threads: threads of the onnx session, 0 takes intra_op_num_threads of the session configuration
+        - session_config_path: the onnx session options, see OnnxSessionConfig, None uses the onnxruntime defaults
+        - tiling_config_path: the tiled inference, see AnomalyTilingConfig, None resizes the sheet to the model input
+        """
+        self.model_path = model_path
+        self.tiling = AnomalyTilingConfig()
+        if tiling_config_path is not None:
+            with open(tiling_config_path) as f:
+                self.tiling = AnomalyTilingConfig.from_json(json.load(f))
+        session_config = OnnxSessionConfig()
+        if session_config_path is not None:
+            with open(session_config_path) as f:
+                session_config = OnnxSessionConfig.from_json(json.load(f))
+        if not os.path.isfile(model_path):
+            # like torch.load, a missing model deactivates the anomaly detection instead of failing the worker
+            raise FileNotFoundError(f"No such file: '{model_path}'")
+        self.session = create_inference_session(model_path, session_config, num_threads)
+        self.input_name = self.session.get_inputs()[0].name
+        self.output_name = self.session.get_outputs()[0].name
+
+    def _preprocess_image(self, input_image):
+        """
+        Preprocess the input image (either a cv2 image or an image pyramid of it) exactly like the torchvision
+        transforms of AnomalyDetectionAutoencoder: bilinear resize by PIL and scaling to [0, 1].
+
+        Returns:
+        - image: the model input (1, C, H, W) as float32 RGB
+        """
+        if isinstance(input_image, np.ndarray):
+            input_image = ImagePyramid(input_image)
+        if not isinstance(input_image, ImagePyramid):
+            raise TypeError("Unsupported input image type. Must be a cv2 image (numpy array) or an ImagePyramid.")
+        # The resize to the model input starts from the full resolution, RECONSTRUCTION_ERROR_THRESHOLD was set
+        # with it, a smaller pyramid level would shift the reconstruction error
+        input_image = input_image.image
+        input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
+        resized = np.asarray(Image.fromarray(input_image).resize(self.INPUT_SIZE, Image.BILINEAR))
+        return (resized.transpose(2, 0, 1)[np.newaxis] / np.float32(255)).astype(np.float32)
+
+    def _run_batch(self, batch):
+        """
+        Run the autoencoder on a batch of patches (N, C, H, W), see Autoencoder.tiling.
+        """
+        return self.session.run([self.output_name], {self.input_name: batch})[0]
+
+    def calculate_mse(self, original, reconstructed):
+        """
+        Calculate Mean Squared Error (MSE) between original and reconstructed images.
+        """
+        return np.mean((original - reconstructed) ** 2)
+
+    def reconstruct_image(self, input_image):
+        """
+        Perform image reconstruction using the autoencoder and calculate the reconstruction error.
+        The input image can be a cv2 Image or an image pyramid of it.
+
+        Returns:
+        - reconstructed_image: the reconstructed image as a cv2 image (numpy array)
+        - reconstruction_error: the calculated MSE between the original and reconstructed image
+        With tiled inference the reconstruction has the size of the pyramid level and the MSE is taken over the
+        fabric pixels, see Autoencoder.tiling.
+        """
+        if self.tiling.patch_size is not None:
+            return reconstruct_image_tiled(input_image, self._run_batch, self.tiling)
+
+        image = self._preprocess_image(input_image)
+        reconstructed = self.session.run([self.output_name], {self.input_name: image})[0]
+
+        reconstruction_error = self.calculate_mse(image[0], reconstructed[0])
+
+        # (C, H, W) -> (H, W, C), rescaled to [0, 255] and converted back to BGR like AnomalyDetectionAutoencoder
+        reconstructed_image_np = (np.transpose(reconstructed[0], (1, 2, 0)) * 255).astype(np.uint8)
+        reconstructed_image_bgr = cv2.cvtColor(reconstructed_image_np, cv2.COLOR_RGB2BGR)
+
+        return reconstructed_image_bgr, reconstruction_error
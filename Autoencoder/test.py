@@ -1,3 +1,5 @@
+import json
+
 import cv2
 import numpy as np
 import torch
@@ -6,22 +8,32 @@ from torchvision import transforms
 
 
 from Autoencoder.Autoencoder import Autoencoder
+from Autoencoder.tiling import reconstruct_image_tiled
+from data_transfer.dtos import AnomalyTilingConfig
+from libs.pyramid import ImagePyramid
 
 
 class AnomalyDetectionAutoencoder(object):
-    def __init__(self, model_path, device=None):
+    INPUT_SIZE = (2048, 2048)  # width, height of the model input
+
+    def __init__(self, model_path, device=None, tiling_config_path='./Autoencoder/configurations/tiling.json'):
         """
         Initialize the class with the path to the pre-trained autoencoder model.
         Loads the model and sets the device (GPU/CPU).
+        tiling_config_path: the tiled inference, see AnomalyTilingConfig, None resizes the sheet to the model input.
         """
         self.model_path = model_path
+        self.tiling = AnomalyTilingConfig()
+        if tiling_config_path is not None:
+            with open(tiling_config_path) as f:
+                self.tiling = AnomalyTilingConfig.from_json(json.load(f))
         self.device = device if device else torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.model = self._load_model()
         
         # Transformation applied to images before feeding into the model (if input is cv2 image)
         self.transform = transforms.Compose([
             transforms.ToPILImage(),            # Convert cv2 image (numpy) to PIL image to use torchvision transforms
-            transforms.Resize((2048, 2048)),    # Resize to model input size
+            transforms.Resize(self.INPUT_SIZE[::-1]),  # Resize to model input size (height, width)
             transforms.ToTensor()               # Convert image to tensor
         ])
     
@@ -37,11 +49,15 @@ class AnomalyDetectionAutoencoder(object):
     
     def _preprocess_image(self, input_image):
         """
-        Preprocess the input image (either a cv2 image or a tensor).
+        Preprocess the input image (either a cv2 image, an image pyramid of it or a tensor).
         If it's a cv2 image (numpy array), apply transformations; otherwise, ensure it is a tensor on the correct device.
         """
         if isinstance(input_image, np.ndarray):
-            # If input is a cv2 image (numpy array), apply transformations
+            input_image = ImagePyramid(input_image)
+        if isinstance(input_image, ImagePyramid):
+            # The resize to the model input starts from the full resolution, RECONSTRUCTION_ERROR_THRESHOLD was set
+            # with it, a smaller pyramid level would shift the reconstruction error
+            input_image = input_image.image
             input_image = cv2.cvtColor(input_image, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
             image = self.transform(input_image).unsqueeze(0)  # Apply transformation and add batch dimension
         elif isinstance(input_image, torch.Tensor):
@@ -51,10 +67,17 @@ class AnomalyDetectionAutoencoder(object):
             else:
                 image = input_image
         else:
-            raise TypeError("Unsupported input image type. Must be a cv2 image (numpy array) or a PyTorch Tensor.")
+            raise TypeError("Unsupported input image type. Must be a cv2 image (numpy array), an ImagePyramid or a PyTorch Tensor.")
         
         return image.to(self.device)  # Move the image tensor to the same device as the model
     
+    def _run_batch(self, batch):
+        """
+        Run the autoencoder on a batch of patches (N, C, H, W) as numpy array, see Autoencoder.tiling.
+        """
+        with torch.no_grad():
+            return self.model(torch.from_numpy(batch).to(self.device)).cpu().numpy()
+
     def calculate_mse(self, original, reconstructed):
         """
         Calculate Mean Squared Error (MSE) between original and reconstructed images.
@@ -64,12 +87,17 @@ class AnomalyDetectionAutoencoder(object):
     def reconstruct_image(self, input_image):
         """
         Perform image reconstruction using the autoencoder and calculate the reconstruction error.
-        The input image can be a cv2 Image or a PyTorch tensor.
+        The input image can be a cv2 Image, an image pyramid of it or a PyTorch tensor.
         
         Returns:
         - reconstructed_image: the reconstructed image as a cv2 image (numpy array)
         - reconstruction_error: the calculated MSE between the original and reconstructed image
+        With tiled inference the reconstruction has the size of the pyramid level and the MSE is taken over the
+        fabric pixels, see Autoencoder.tiling.
         """
+        if self.tiling.patch_size is not None and not isinstance(input_image, torch.Tensor):
+            return reconstruct_image_tiled(input_image, self._run_batch, self.tiling)
+
         # Preprocess the input image
         image_tensor = self._preprocess_image(input_image)
         
@@ -0,0 +1,124 @@
+"""
+Tiled inference of the anomaly detection autoencoder, shared by the torch and the onnx backend.
+
+Instead of squeezing the whole sheet into the 2048x2048 model input, the autoencoder runs on overlapping patches of
+a fixed size at a level of the image pyramid of the sheet, a few patches per batch. The geometry of the fabric is
+not distorted, and the memory of the model scales with the patch size instead of the sheet size. The patch
+reconstructions are blended with weights falling off towards the patch borders, so there are no seams.
+"""
+from typing import Callable
+
+import cv2
+import numpy as np
+
+from data_transfer.dtos import AnomalyTilingConfig
+from libs.pyramid import ImagePyramid
+
+# the six stride 2 convolutions of Autoencoder need inputs of a multiple of 64 px
+PATCH_MULTIPLE = 64
+# px of the fabric next to the background left out of the error, their reconstruction mixes fabric and background
+FABRIC_BORDER = 4
+
+
+def patch_origins(length: int, patch_size: int, overlap: int) -> list[int]:
+    '''
+    Origins of the patches along one axis, the last patch ends at the image border. An image shorter than a patch
+    gets one patch, the image is padded to the patch size.
+    '''
+    if length <= patch_size:
+        return [0]
+    stride = patch_size - overlap
+    origins = list(range(0, length - patch_size, stride))
+    origins.append(length - patch_size)
+    return origins
+
+
+def blend_weights(patch_size: int, overlap: int) -> np.ndarray:
+    ''' Weight of every pixel of a patch, rising linearly over the overlap at every border, never 0. '''
+    ramp = np.minimum(np.arange(patch_size) + 0.5, np.arange(patch_size)[::-1] + 0.5) / max(overlap, 1)
+    ramp = np.clip(ramp, 0, 1).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+def reconstruct_tiled(image: np.ndarray, run_batch: Callable[[np.ndarray], np.ndarray], patch_size: int = 256,
+                      overlap: int = 32, batch_size: int = 4) -> np.ndarray:
+    '''
+    Reconstruct an image patch by patch.
+
+    Parameters:
+        image: RGB image scaled to [0, 1] (H, W, C) as float32.
+        run_batch: runs the autoencoder on a batch of patches (N, C, H, W), returns the reconstructions.
+        patch_size: size of the square patches, a multiple of PATCH_MULTIPLE.
+        overlap: px the neighbouring patches overlap.
+        batch_size: patches per run of the autoencoder.
+
+    Returns:
+        reconstruction: the blended reconstruction of the image (H, W, C).
+    '''
+    if patch_size % PATCH_MULTIPLE != 0:
+        raise ValueError(f"Patch size {patch_size} is not a multiple of {PATCH_MULTIPLE}!")
+    if not 0 <= overlap < patch_size:
+        raise ValueError(f"Overlap {overlap} is not smaller than the patch size {patch_size}!")
+    height, width = image.shape[:2]
+    if height < patch_size or width < patch_size:
+        # black like the background of the blacked out sheet
+        image = np.pad(image, ((0, max(patch_size - height, 0)), (0, max(patch_size - width, 0)), (0, 0)))
+    padded_height, padded_width = image.shape[:2]
+
+    weights = blend_weights(patch_size, overlap)[..., None]
+    reconstruction = np.zeros((padded_height, padded_width, image.shape[2]), dtype=np.float32)
+    weight_sum = np.zeros((padded_height, padded_width), dtype=np.float32)
+    origins = [(y, x) for y in patch_origins(padded_height, patch_size, overlap)
+               for x in patch_origins(padded_width, patch_size, overlap)]
+    # one batch buffer for all runs, the last batch uses a part of it
+    batch = np.empty((min(batch_size, len(origins)), image.shape[2], patch_size, patch_size), dtype=np.float32)
+    for first in range(0, len(origins), batch_size):
+        batch_origins = origins[first:first + batch_size]
+        for i, (y, x) in enumerate(batch_origins):
+            batch[i] = image[y:y + patch_size, x:x + patch_size].transpose(2, 0, 1)
+        reconstructed = run_batch(batch[:len(batch_origins)])
+        for i, (y, x) in enumerate(batch_origins):
+            reconstruction[y:y + patch_size, x:x + patch_size] += reconstructed[i].transpose(1, 2, 0) * weights
+            weight_sum[y:y + patch_size, x:x + patch_size] += weights[..., 0]
+    reconstruction /= weight_sum[..., None]
+    return reconstruction[:height, :width]
+
+
+def fabric_pixels(image: np.ndarray) -> np.ndarray:
+    ''' The pixels of a blacked out image showing fabric, without the border of FABRIC_BORDER px. '''
+    kernel = np.ones((2 * FABRIC_BORDER + 1, 2 * FABRIC_BORDER + 1), dtype=np.uint8)
+    return cv2.erode(np.any(image > 0, axis=2).astype(np.uint8), kernel, borderValue=1) > 0
+
+
+def fabric_error(original: np.ndarray, reconstructed: np.ndarray) -> float:
+    '''
+    Mean squared error of the fabric pixels (not blacked out) without the border of FABRIC_BORDER px, so the error
+    neither shrinks with the black margin nor grows with the outline of narrow products and is comparable across
+    product sizes. Without fabric the error of all pixels is taken.
+    '''
+    squared = np.mean((original - reconstructed) ** 2, axis=2)
+    fabric = fabric_pixels(original)
+    return float(squared[fabric].mean() if fabric.any() else squared.mean())
+
+
+def reconstruct_image_tiled(input_image, run_batch: Callable[[np.ndarray], np.ndarray],
+                            config: AnomalyTilingConfig) -> tuple[np.ndarray, float]:
+    '''
+    The tiled counterpart of reconstruct_image of the anomaly detectors.
+
+    Parameters:
+        input_image: the blacked out sheet (BGR) or an image pyramid of it.
+        run_batch: runs the autoencoder on a batch of patches (N, C, H, W), returns the reconstructions.
+        config: patch size, overlap, batch size and pyramid level.
+
+    Returns:
+        reconstructed_image: the reconstruction at the pyramid level as BGR uint8 image.
+        reconstruction_error: the mean squared error of the fabric pixels, see fabric_error.
+    '''
+    if isinstance(input_image, np.ndarray):
+        input_image = ImagePyramid(input_image)
+    image = cv2.cvtColor(input_image.level(config.level), cv2.COLOR_BGR2RGB).astype(np.float32) / 255
+    reconstruction = reconstruct_tiled(image, run_batch, config.patch_size, config.overlap, config.batch_size)
+    reconstruction_error = fabric_error(image, reconstruction)
+    reconstructed_image = cv2.cvtColor((reconstruction * 255).astype(np.uint8), cv2.COLOR_RGB2BGR)
+    return reconstructed_image, reconstruction_error
@@ -0,0 +1,226 @@
+"""
+Headless batch re-evaluation of archived scans, e.g. after a model or tolerance change.
+
+Runs the cropping, measurement, material error and anomaly detection of main.py without the HMI over
+a directory of scans, or over the images stored in the quality check database, with a pool of processes.
+The results are written as json lines and/or into a quality check database. With --cache-dir the stage results
+are cached, so a re-run after a model change only recomputes the stage of that model.
+
+Usage:
+    python batch_evaluation.py --input-dir archive/2024-11 --output results.jsonl
+    python batch_evaluation.py --db-from "2024-11-01 00:00:00" --db-to "2024-11-30 23:59:59" --output recheck.jsonl
+    python batch_evaluation.py --input-dir archive/2024-11 --output results.jsonl --cache-dir .stage_cache
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+
+from libs.boxes import merge_boxes
+from libs.database import QualityCheckDB
+from libs.image_format_conversion import convert_to_opencv
+from libs.preprocessing import BLACKED_OUT, BLACKED_OUT_RAW, image_crop, remove_background
+from libs.pyramid import ImagePyramid
+from libs.quality_check import get_qc_rows
+from libs.stage_cache import (StageCache, anomaly_config_id, cached, crop_config_id, hash_array,
+                              material_error_config_id, measurement_config_id)
+from processes import (ANOMALY_MODEL, ANOMALY_MODEL_PATH, MATERIAL_ERROR_MODEL, create_anomaly_detector,
+                       create_material_error_detector, model_version, registry_model_paths)
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+# models of a worker process, loaded once by _init_worker
+_measurement_evaluator = None
+_material_error_detector = None
+_anomaly_detector = None
+_dpi = 600
+_source_db = None
+_with_preview = False
+_stage_cache = None
+_model_versions = {}
+_image_scale = 1.0
+
+
+def _init_worker(dpi: int, num_threads: int, source_db: str | None, with_preview: bool,
+                 cache_dir: str | None = None, cache_bytes: int = 0, material_model: str | None = None,
+                 min_fabric_fraction: float | None = None, anomaly_model: str = ANOMALY_MODEL_PATH,
+                 image_scale: float = 1.0):
+    '''
+    Loads the models of a worker process. The models are resolved by registry_model_paths of processes.py like
+    main.py does, image_scale is the scale of the images relative to the scans.
+    '''
+    global _measurement_evaluator, _material_error_detector, _anomaly_detector, _dpi, _source_db, _with_preview, \
+        _stage_cache, _model_versions, _image_scale
+    from measurement_analysis.measurement_evaluation import MeasurementEvaluator
+
+    _dpi = dpi
+    _image_scale = image_scale
+    _source_db = QualityCheckDB(source_db) if source_db else None
+    _with_preview = with_preview
+    _stage_cache = StageCache(cache_dir, cache_bytes) if cache_dir else None
+    _measurement_evaluator = MeasurementEvaluator()
+    _material_error_detector = create_material_error_detector(dpi, num_threads, material_model, min_fabric_fraction)
+    try:
+        if not anomaly_model.endswith(".onnx"):
+            import torch
+            torch.set_num_threads(num_threads)
+        _anomaly_detector = create_anomaly_detector(anomaly_model, num_threads)
+    except FileNotFoundError:
+        print("Warning! Could not load anomaly detection autoencoder! Anomaly detection inactive!")
+
+    # recorded with every result like main.py does, see libs.model_registry
+    for name, path in ((MATERIAL_ERROR_MODEL, _material_error_detector.path_to_model),
+                       (ANOMALY_MODEL, anomaly_model if _anomaly_detector is not None else None)):
+        version = model_version(name, path) if path is not None else None
+        _model_versions[name] = version.version if version is not None else None
+
+
+def _reconstruction_error(black_cropped: cv2.typing.MatLike) -> float:
+    _, reconstruction_error = _anomaly_detector.reconstruct_image(black_cropped)
+    return reconstruction_error
+
+
+def _evaluate(source: str, image_cropped: cv2.typing.MatLike, image_id: str | None) -> dict:
+    ''' Evaluate a cropped image, image_id identifies the image in the stage cache. '''
+    # the background is removed once for all stages, like main.py does
+    artifacts = remove_background(image_cropped, (BLACKED_OUT, BLACKED_OUT_RAW))
+    measure_results = cached(_stage_cache, image_id, "measurement",
+                             lambda: measurement_config_id(_measurement_evaluator, _dpi),
+                             _measurement_evaluator.analyse, artifacts[BLACKED_OUT], _dpi, background_removed=True)
+    material_error_results = cached(_stage_cache, image_id, "material_error",
+                                    lambda: material_error_config_id(_material_error_detector, 0.8),
+                                    _material_error_detector.analyse, artifacts[BLACKED_OUT], 0.8,
+                                    background_removed=True)
+    # one box per material error, like main.py
+    material_error_results = merge_boxes(material_error_results)
+    reconstruction_error = 0
+    if _anomaly_detector is not None:
+        # only the error is cached, the anomaly worker of main.py caches the reconstructed image too under "anomaly"
+        reconstruction_error = cached(_stage_cache, image_id, "anomaly_error",
+                                      lambda: anomaly_config_id(_anomaly_detector),
+                                      _reconstruction_error, artifacts[BLACKED_OUT_RAW])
+
+    qc_result, rows = get_qc_rows(measure_results, material_error_results, reconstruction_error)
+    record = {"source": source, "result": qc_result, "checks": rows, "error": None, "model_versions": _model_versions,
+              "image_scale": _image_scale}
+    if _with_preview:
+        # scaled like the images main.py stores in the database
+        record["preview"] = ImagePyramid(image_cropped).scaled(0.25)
+    return record
+
+
+def evaluate_file(path: str) -> dict:
+    ''' Crop and evaluate a scan stored as image file. '''
+    try:
+        image = cv2.imread(path)
+        if image is None:
+            raise RuntimeError(f"Could not read image '{path}'!")
+        if _stage_cache is None:
+            return _evaluate(path, image_crop(image), None)
+        # the following stages are keyed by the crop, so they are reused as long as the crop does not change
+        crop_key = StageCache.key(hash_array(image), "image_crop", crop_config_id())
+        return _evaluate(path, _stage_cache.compute(crop_key, image_crop, image), crop_key)
+    except Exception as ex:
+        return {"source": path, "result": False, "checks": [], "error": str(ex)}
+
+
+def evaluate_db_entry(id_: int) -> dict:
+    ''' Evaluate the already cropped image of a quality check stored in the source database. '''
+    source = f"{_source_db.db_name}#{id_}"
+    try:
+        image_cropped = convert_to_opencv(_source_db.retrieve_image(id_).convert("RGB"))
+        return _evaluate(source, image_cropped, hash_array(image_cropped) if _stage_cache is not None else None)
+    except Exception as ex:
+        return {"source": source, "result": False, "checks": [], "error": str(ex)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='GAIH Köstler Batch Evaluation')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input-dir", help="directory with the scans to evaluate")
+    source.add_argument("--db-from", help="evaluate the images stored in the database since this time (UTC)")
+    parser.add_argument("--db-to", default="now", help="end of the time range used with --db-from (UTC)")
+    parser.add_argument("--db", default="quality_check.db", help="database to read with --db-from")
+    parser.add_argument("--db-image-scale", type=float, default=0.25,
+                        help="scale the database images were stored with, the database only holds previews, "
+                             "so the results are less accurate than re-evaluating the original scans and are marked "
+                             "with their image_scale")
+    parser.add_argument("--dpi", type=int, default=600, help="DPI setting the scans were taken with")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--output", help="json lines file to write the results to")
+    parser.add_argument("--output-db", help="quality check database to write the results to")
+    parser.add_argument("--cache-dir", help="cache the stage results in this directory and reuse them on re-runs")
+    parser.add_argument("--cache-size", type=float, default=2, help="maximum size of the stage cache in GB")
+    parser.add_argument("--material-model", help="onnx model of the material error detection, e.g. the INT8 model "
+                                                 "of quantize_material_model.py, defaults to the FP32 model")
+    parser.add_argument("--min-fabric-fraction", type=float, default=None,
+                        help="skip the material error detection of tiles with less fabric, 0 analyses all tiles, "
+                             "defaults to 0.05")
+    parser.add_argument("--model-registry", default="./model_registry", metavar="DIR",
+                        help="versioned models, the active version of every model registered there is evaluated "
+                             "like in main.py, see libs/model_registry.py")
+    parser.add_argument("--anomaly-backend", choices=["torch", "onnx"], default="torch",
+                        help="run the anomaly detection with torch or with onnxruntime and the model of "
+                             "export_autoencoder_onnx.py, a registered anomaly model takes precedence")
+    args = parser.parse_args()
+
+    if not args.output and not args.output_db:
+        parser.error("at least one of --output and --output-db is required")
+
+    if args.input_dir:
+        items = sorted(str(file) for file in Path(args.input_dir).iterdir() if file.suffix.lower() in IMAGE_SUFFIXES)
+        task = evaluate_file
+        dpi = args.dpi
+        source_db = None
+        image_scale = 1.0
+    else:
+        if args.output_db:
+            # the stored previews are no scans, their results must not be mixed with the results of main.py
+            parser.error("the database images are previews, evaluate them with --output only")
+        items = QualityCheckDB(args.db).retrieve_ids(args.db_from, args.db_to)
+        task = evaluate_db_entry
+        dpi = round(args.dpi * args.db_image_scale)
+        source_db = args.db
+        image_scale = args.db_image_scale
+
+    if len(items) == 0:
+        parser.error("no scans to evaluate")
+
+    output_db = QualityCheckDB(args.output_db) if args.output_db else None
+    output = open(args.output, "w") if args.output else None
+    material_model, anomaly_model = registry_model_paths(args.model_registry, args.material_model,
+                                                         args.anomaly_backend)
+
+    # every worker runs its own models, the cores are shared between them
+    num_threads = max(1, os.cpu_count() // args.workers)
+    before = time.perf_counter()
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                                 initargs=(dpi, num_threads, source_db, output_db is not None,
+                                           args.cache_dir, int(args.cache_size * 1024 ** 3),
+                                           material_model, args.min_fabric_fraction, anomaly_model,
+                                           image_scale)) as executor:
+            for idx, record in enumerate(executor.map(task, items), start=1):
+                preview = record.pop("preview", None)
+                if record["error"] is not None:
+                    failed += 1
+                    print(f"[{idx}/{len(items)}] {record['source']}: {record['error']}")
+                else:
+                    print(f"[{idx}/{len(items)}] {record['source']}: {'OK' if record['result'] else 'NOK'}")
+                    if output_db is not None:
+                        output_db.insert_quality_check(record["result"], record["checks"], preview, image_resize=False,
+                                                       model_versions=record["model_versions"])
+                if output is not None:
+                    output.write(json.dumps(record) + "\n")
+    finally:
+        if output is not None:
+            output.close()
+
+    duration = time.perf_counter() - before
+    print(f"Evaluated {len(items)} sheets ({failed} failed) in {duration:.1f} s, "
+          f"{len(items) / duration * 3600:.0f} sheets/h")
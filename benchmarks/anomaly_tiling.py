@@ -0,0 +1,115 @@
+"""
+Regression check and memory benchmark of the tiled autoencoder inference (Autoencoder/tiling.py).
+
+Runs the tiling on synthetic sheets with two stand-ins for the autoencoder, so no model is needed: the identity,
+whose blended reconstruction has to equal the input, and a blur, which loses the fine texture like the autoencoder
+loses the material errors. With the blur the reconstruction error of the sheet is compared with the error of a
+narrow product on the same sheet, the fabric error has to stay the same while the error of all pixels shrinks with
+the black margin. The peak memory of the tiling is reported for every sheet size, it grows with the sheet only by
+the reconstruction of the pyramid level. With --model the real autoencoder is timed as well, resized and tiled.
+
+Usage (from the repository root):
+    python -m benchmarks.anomaly_tiling --dpi 300 600 --patch-size 256 --level 1
+    python -m benchmarks.anomaly_tiling --dpi 600 --model Autoencoder/autoencoder_Final.onnx
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from Autoencoder.tiling import fabric_error, reconstruct_tiled
+from benchmarks.synthetic_sheets import generate_sheet
+from benchmarks.tile_filter import narrow
+from data_transfer.dtos import AnomalyTilingConfig
+from libs.preprocessing import BLACKED_OUT_RAW, image_crop, remove_background
+from libs.pyramid import ImagePyramid
+
+# largest accepted difference of the blended identity reconstruction and the input
+IDENTITY_TOLERANCE = 1e-5
+# largest accepted relative difference of the fabric errors of the sheet and the narrow product
+FABRIC_ERROR_TOLERANCE = 0.25
+
+
+def _identity(batch: np.ndarray) -> np.ndarray:
+    return batch.copy()
+
+
+def _blur(batch: np.ndarray) -> np.ndarray:
+    ''' Stand-in for the autoencoder, loses the texture finer than 5 px. '''
+    return np.stack([cv2.blur(patch.transpose(1, 2, 0), (5, 5)).transpose(2, 0, 1) for patch in batch])
+
+
+def _level_image(scan: np.ndarray, level: int) -> np.ndarray:
+    blacked_out_raw = remove_background(image_crop(scan), (BLACKED_OUT_RAW,))[BLACKED_OUT_RAW]
+    return cv2.cvtColor(ImagePyramid(blacked_out_raw).level(level), cv2.COLOR_BGR2RGB).astype(np.float32) / 255
+
+
+def check_dpi(dpi: int, config: AnomalyTilingConfig, narrow_fraction: float) -> int:
+    ''' Check and measure the tiling of a synthetic sheet, returns the number of failed checks. '''
+    image = _level_image(generate_sheet(dpi, defects=1, seed=dpi), config.level)
+    print(f"{dpi} dpi, level {config.level}: {image.shape[1]}x{image.shape[0]} px")
+    failed = 0
+
+    tracemalloc.start()
+    before = time.perf_counter()
+    reconstruction = reconstruct_tiled(image, _identity, config.patch_size, config.overlap, config.batch_size)
+    duration = time.perf_counter() - before
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    difference = float(np.abs(reconstruction - image).max())
+    ok = difference <= IDENTITY_TOLERANCE
+    failed += not ok
+    print(f"  identity  {duration * 1000:7.1f} ms, peak {peak / 1e6:6.1f} MB (level image {image.nbytes / 1e6:.1f} MB), "
+          f"max difference {difference:.1e}{'' if ok else '  FAILED'}")
+
+    errors = {}
+    for name, level_image in (("sheet", image), ("narrow", narrow(image, narrow_fraction))):
+        blurred = reconstruct_tiled(level_image, _blur, config.patch_size, config.overlap, config.batch_size)
+        errors[name] = (fabric_error(level_image, blurred), float(np.mean((level_image - blurred) ** 2)))
+    difference = abs(errors["narrow"][0] - errors["sheet"][0]) / errors["sheet"][0]
+    ok = difference <= FABRIC_ERROR_TOLERANCE
+    failed += not ok
+    print(f"  blur      fabric error sheet {errors['sheet'][0]:.5f} narrow {errors['narrow'][0]:.5f} "
+          f"({difference:.1%}), error of all pixels sheet {errors['sheet'][1]:.5f} narrow {errors['narrow'][1]:.5f}"
+          f"{'' if ok else '  FAILED'}")
+    return failed
+
+
+def time_model(dpi: int, model: str, config: AnomalyTilingConfig):
+    ''' Times the resized and the tiled reconstruction of the real autoencoder. '''
+    from processes import create_anomaly_detector
+    detector = create_anomaly_detector(model)
+    blacked_out_raw = remove_background(image_crop(generate_sheet(dpi, defects=1, seed=dpi)), (BLACKED_OUT_RAW,))
+    for name, tiling in (("resized", AnomalyTilingConfig()), ("tiled", config)):
+        detector.tiling = tiling
+        detector.reconstruct_image(blacked_out_raw[BLACKED_OUT_RAW])  # warm-up
+        before = time.perf_counter()
+        _, reconstruction_error = detector.reconstruct_image(blacked_out_raw[BLACKED_OUT_RAW])
+        print(f"  {name:9s} {(time.perf_counter() - before) * 1000:7.1f} ms, error {reconstruction_error:.5f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regression check and memory benchmark of the tiled autoencoder")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[300, 600])
+    parser.add_argument("--patch-size", type=int, default=256)
+    parser.add_argument("--overlap", type=int, default=32)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--level", type=int, default=1)
+    parser.add_argument("--narrow", type=float, default=0.5, help="width fraction of the simulated narrow product")
+    parser.add_argument("--model", help="time the real autoencoder too, a .pth or .onnx model")
+    args = parser.parse_args()
+
+    tiling_config = AnomalyTilingConfig(args.patch_size, args.overlap, args.batch_size, args.level)
+    failed = 0
+    for dpi in args.dpi:
+        failed += check_dpi(dpi, tiling_config, args.narrow)
+        if args.model:
+            time_model(dpi, args.model, tiling_config)
+
+    if failed:
+        print(f"{failed} checks of the tiled inference failed!")
+        sys.exit(1)
+    print("The tiled inference blends seamlessly and its error does not depend on the product size.")
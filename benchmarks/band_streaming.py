@@ -0,0 +1,86 @@
+"""
+Regression check and memory benchmark of the band streaming preprocessing (--band-height of main.py).
+
+Converts a synthetic scan with convert_to_opencv and removes the background of the crop with remove_background,
+once on the whole frame and once band by band, and reports the peak memory allocated by each. The background
+removal writes into preallocated buffers like the shared frames of main.py, so its peak is the memory of the
+intermediate images only. Exits with an error if a banded result differs from the whole-frame result.
+
+Usage (from the repository root):
+    python -m benchmarks.band_streaming --dpi 600 1200 --band-height 256 1024
+"""
+import argparse
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.synthetic_sheets import generate_sheet
+from libs.image_format_conversion import convert_to_opencv
+from libs.preprocessing import BACKGROUND_MASK, BLACKED_OUT, BLACKED_OUT_RAW, image_crop, remove_background
+
+ARTIFACTS = (BLACKED_OUT, BLACKED_OUT_RAW, BACKGROUND_MASK)
+
+
+def _measure(func, *args, **kwargs):
+    ''' Returns the result, the duration and the peak of the memory allocated by func. '''
+    tracemalloc.reset_peak()
+    before_bytes = tracemalloc.get_traced_memory()[0]
+    before = time.perf_counter()
+    result = func(*args, **kwargs)
+    duration = time.perf_counter() - before
+    return result, duration, tracemalloc.get_traced_memory()[1] - before_bytes
+
+
+def _buffers(image: np.ndarray) -> dict[str, np.ndarray]:
+    return {artifact: np.empty(image.shape[:2] if artifact == BACKGROUND_MASK else image.shape, np.uint8)
+            for artifact in ARTIFACTS}
+
+
+def check_dpi(dpi: int, band_heights: list[int]) -> int:
+    ''' Compare and measure the banded preprocessing of a synthetic sheet, returns the number of mismatches. '''
+    scan_pil = Image.fromarray(generate_sheet(dpi, defects=1, seed=dpi)[..., ::-1])
+    mismatches = 0
+
+    tracemalloc.start()
+    scan, duration, peak = _measure(convert_to_opencv, scan_pil)
+    print(f"{dpi} dpi, {scan.shape[1]}x{scan.shape[0]} px ({scan.nbytes / 1e6:.0f} MB):")
+    print(f"  convert_to_opencv    whole frame {duration * 1000:7.1f} ms, peak {peak / 1e6:7.1f} MB")
+    for band_height in band_heights:
+        banded, duration, peak = _measure(convert_to_opencv, scan_pil, band_height)
+        same = np.array_equal(banded, scan)
+        mismatches += not same
+        print(f"  convert_to_opencv    {band_height:5d} rows  {duration * 1000:7.1f} ms, peak {peak / 1e6:7.1f} MB"
+              f"{'' if same else '  MISMATCH'}")
+        del banded
+
+    image_cropped = image_crop(scan)
+    outputs = _buffers(image_cropped)
+    expected, duration, peak = _measure(remove_background, image_cropped, ARTIFACTS, outputs)
+    print(f"  remove_background    whole frame {duration * 1000:7.1f} ms, peak {peak / 1e6:7.1f} MB")
+    for band_height in band_heights:
+        band_outputs = _buffers(image_cropped)
+        results, duration, peak = _measure(remove_background, image_cropped, ARTIFACTS, band_outputs,
+                                           band_height=band_height)
+        same = all(np.array_equal(results[artifact], expected[artifact]) and results[artifact] is band_outputs[artifact]
+                   for artifact in ARTIFACTS)
+        mismatches += not same
+        print(f"  remove_background    {band_height:5d} rows  {duration * 1000:7.1f} ms, peak {peak / 1e6:7.1f} MB"
+              f"{'' if same else '  MISMATCH'}")
+    tracemalloc.stop()
+    return mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regression check and memory benchmark of the band streaming")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[600])
+    parser.add_argument("--band-height", type=int, nargs="+", default=[256, 1024])
+    args = parser.parse_args()
+
+    mismatches = sum(check_dpi(dpi, args.band_height) for dpi in args.dpi)
+    if mismatches:
+        print(f"{mismatches} banded results differ!")
+        sys.exit(1)
+    print("All banded results are identical.")
@@ -0,0 +1,142 @@
+"""
+Regression check and micro-benchmark of the border search of image_crop and delete_white_bottom.
+
+Compares the crop rectangles of libs.preprocessing with the former loop implementation on recorded scans
+and on synthetic sheets at different positions, and times both. Also checks that crop_scan on the RGB scan
+gives the same crop as converting the whole scan to BGR first. Exits with an error if a crop differs.
+
+Usage (from the repository root):
+    python -m benchmarks.crop_borders --images dummy_scans/*.png --repeats 5
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic_sheets import generate_sheet
+from libs.image_format_conversion import convert_to_opencv
+from libs.preprocessing import crop_scan, delete_white_bottom, image_crop, replace_grey_with_black_hsv
+
+
+def legacy_delete_white_bottom(scanned_image: cv2.typing.MatLike) -> cv2.typing.MatLike:
+    '''
+    delete_white_bottom before the vectorization, one python loop iteration per row. The rows are summed as int64
+    like numpy 1.26 does for sum() over uint8 values.
+    '''
+    gray_image = cv2.cvtColor(scanned_image, cv2.COLOR_BGR2GRAY)
+    i_end = scanned_image.shape[0]
+    j_end = scanned_image.shape[1]
+    for i in reversed(range(0, i_end)):
+        if sum(gray_image[i, :(j_end // 50)].astype(np.int64)) / (j_end // 50) < 253:
+            output = scanned_image[:i, :]
+            break
+    return output
+
+
+def legacy_image_crop(image, thickness: int = 100) -> cv2.typing.MatLike:
+    ''' image_crop before the vectorization, one python loop iteration per row and column. '''
+    scale_factor = 20
+    thickness = thickness // scale_factor
+    image = legacy_delete_white_bottom(image)
+    copy_image = cv2.resize(image, (image.shape[1] // scale_factor, image.shape[0] // scale_factor),
+                            interpolation=cv2.INTER_AREA)
+    copy_image = replace_grey_with_black_hsv(copy_image, lower_grey=np.array([94, 4, 160]),
+                                             upper_grey=np.array([129, 50, 205]))
+    copy_image = cv2.cvtColor(copy_image, cv2.COLOR_BGR2GRAY).astype(np.int64)
+    height = copy_image.shape[0]
+    width = copy_image.shape[1]
+    top = 0
+    for i in range(0, height):
+        if sum(copy_image[i, :]) / height > 15:
+            break
+    if i > thickness:
+        top = i - thickness
+    bottom = height
+    for i in reversed(range(0, height)):
+        if sum(copy_image[i, :]) / height > 15:
+            break
+    if height - i > thickness:
+        bottom = i + thickness
+    left = 0
+    for j in range(0, width):
+        if sum(copy_image[:, j]) / width > 15:
+            break
+    if j > thickness:
+        left = j - thickness
+    right = width
+    for j in reversed(range(0, width)):
+        if sum(copy_image[:, j]) / width > 15:
+            break
+    if width - j > thickness:
+        right = j + thickness
+    return image[top * scale_factor:bottom * scale_factor, left * scale_factor:right * scale_factor]
+
+
+def _rectangle(image: np.ndarray, cropped: np.ndarray) -> tuple[int, int, int, int]:
+    ''' Position and size of a crop, which is a view into the image. '''
+    offset = cropped.__array_interface__["data"][0] - image.__array_interface__["data"][0]
+    top, rest = divmod(offset, image.strides[0])
+    return top, rest // image.strides[1], cropped.shape[0], cropped.shape[1]
+
+
+def _synthetic_scans() -> dict[str, np.ndarray]:
+    ''' Synthetic sheets, shifted around so the borders are at different positions. '''
+    scans = {}
+    for dpi in (300, 600):
+        scan = generate_sheet(dpi, defects=1, seed=dpi)
+        for shift_y, shift_x in [(0, 0), (37, 0), (0, 53), (dpi // 2, dpi // 3)]:
+            scans[f"synthetic {dpi} dpi, shifted by ({shift_y}, {shift_x})"] = np.ascontiguousarray(
+                scan[shift_y:, shift_x:])
+    return scans
+
+
+def _time(func, image, repeats: int) -> float:
+    durations = []
+    for _ in range(repeats):
+        before = time.perf_counter()
+        func(image)
+        durations.append(time.perf_counter() - before)
+    return statistics.median(durations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regression check and micro-benchmark of the crop border search")
+    parser.add_argument("--images", nargs="*", default=[], help="recorded scans")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    scans = _synthetic_scans()
+    for path in args.images:
+        scans[path] = cv2.imread(path)
+
+    mismatches = 0
+    for name, scan in scans.items():
+        rectangles = []
+        for func in (delete_white_bottom, legacy_delete_white_bottom, image_crop, legacy_image_crop):
+            rectangles.append(_rectangle(scan, func(scan)))
+        if rectangles[0] != rectangles[1] or rectangles[2] != rectangles[3]:
+            mismatches += 1
+            print(f"MISMATCH {name}: {rectangles}")
+            continue
+        # the scanner delivers RGB, like np.asarray of the PIL scan
+        scan_rgb = np.ascontiguousarray(scan[..., ::-1])
+        if not np.array_equal(crop_scan(scan_rgb), image_crop(convert_to_opencv(scan_rgb))):
+            mismatches += 1
+            print(f"MISMATCH {name}: crop_scan differs from image_crop")
+            continue
+
+        legacy = _time(legacy_image_crop, scan, args.repeats)
+        vectorized = _time(image_crop, scan, args.repeats)
+        convert_first = _time(lambda image: image_crop(convert_to_opencv(image)), scan_rgb, args.repeats)
+        crop_first = _time(crop_scan, scan_rgb, args.repeats)
+        print(f"{name}: crop {rectangles[2]}, legacy {legacy * 1000:.1f} ms, vectorized {vectorized * 1000:.1f} ms "
+              f"({legacy / vectorized:.1f}x), convert and crop {convert_first * 1000:.1f} ms, "
+              f"crop_scan {crop_first * 1000:.1f} ms")
+
+    if mismatches:
+        print(f"{mismatches} of {len(scans)} crops differ!")
+        sys.exit(1)
+    print(f"All {len(scans)} crops are identical.")
@@ -0,0 +1,106 @@
+"""
+Scaling benchmark of the sharded material error detection.
+
+Runs the material error processes of main.py with 1..N workers on the given scans and reports the
+latency per sheet and the resulting sheets per hour, to size the test bench hardware.
+
+Usage (from the repository root):
+    python -m benchmarks.material_error_scaling --images dummy_scans/*.png --max-workers 8
+"""
+import argparse
+import json
+import statistics
+import time
+from multiprocessing import Pipe, Process
+
+import cv2
+
+from data_transfer.dtos import SheetJob
+from libs.preprocessing import BLACKED_OUT, image_crop, remove_background
+from libs.shared_frames import FramePool
+from libs.tracing import new_trace_id
+from processes import material_error_process
+
+
+def benchmark_workers(images: list[cv2.typing.MatLike], num_workers: int, dpi: int, repeats: int,
+                      path_to_model: str | None = None) -> dict:
+    '''
+    Time the material error detection of the images with a pool of num_workers processes.
+
+    Parameters:
+        images: cropped images with the background removed, see libs.preprocessing.BLACKED_OUT.
+        num_workers: number of material error processes.
+        dpi: scanner resolution the images were taken with.
+        repeats: how often every image is analysed.
+        path_to_model: onnx model of the material error detection, defaults to the FP32 model.
+
+    Returns:
+        result: latencies in seconds and sheets per hour.
+    '''
+    frames = FramePool(2, max(image.nbytes for image in images))
+    conns = []
+    processes = []
+    for shard_index in range(num_workers):
+        parent_conn, child_conn = Pipe()
+        process = Process(target=material_error_process,
+                          args=(child_conn, dpi, frames, shard_index, num_workers, None, path_to_model), daemon=True)
+        process.start()
+        conns.append(parent_conn)
+        processes.append(process)
+    for conn in conns:
+        conn.recv()  # model loaded and warmed up
+
+    def _analyse(image):
+        job = SheetJob(new_trace_id(), {BLACKED_OUT: frames.put(image, refs=num_workers)})
+        for conn in conns:
+            conn.send(job)
+        return [box for conn in conns for box in conn.recv().value]
+
+    try:
+        _analyse(images[0])  # model loading and first inference are not part of the measurement
+
+        latencies = []
+        for _ in range(repeats):
+            for image in images:
+                before = time.perf_counter()
+                _analyse(image)
+                latencies.append(time.perf_counter() - before)
+    finally:
+        for process in processes:
+            process.terminate()
+        frames.unlink()
+
+    return {
+        "workers": num_workers,
+        "sheets": len(latencies),
+        "mean_s": statistics.mean(latencies),
+        "median_s": statistics.median(latencies),
+        "max_s": max(latencies),
+        "sheets_per_hour": 3600 / statistics.mean(latencies),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the material error detection")
+    parser.add_argument("--images", nargs="+", required=True, help="uncropped scans")
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument("--dpi", type=int, default=600, help="DPI setting the scans were taken with")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--material-model", help="onnx model of the material error detection, e.g. the INT8 model")
+    args = parser.parse_args()
+
+    # the background is removed by the main process, it is not part of the material error detection
+    images = [remove_background(image_crop(cv2.imread(path)), (BLACKED_OUT,))[BLACKED_OUT] for path in args.images]
+
+    results = []
+    for num_workers in range(1, args.max_workers + 1):
+        result = benchmark_workers(images, num_workers, args.dpi, args.repeats, args.material_model)
+        results.append(result)
+        speedup = results[0]["mean_s"] / result["mean_s"]
+        print(f"{num_workers:3d} workers: {result['mean_s']:.3f} s/sheet, "
+              f"{result['sheets_per_hour']:.0f} sheets/h, speedup {speedup:.2f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -0,0 +1,212 @@
+"""
+End-to-end benchmark of the sheet processing on synthetic scans, no scanner or fabric required.
+
+Generates sheets with benchmarks.synthetic_sheets, times every stage of the pipeline in one process and
+writes the results as json, so runs of different commits can be compared. Stages whose model is missing
+are reported with their error instead of a timing.
+
+Usage (from the repository root):
+    python -m benchmarks.pipeline --dpi 300 600 --repeats 5 --output bench_new.json
+    python -m benchmarks.pipeline --dpi 300 600 --repeats 5 --output bench_new.json --compare bench_old.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic_sheets import generate_sheet
+from libs.boxes import merge_boxes
+from libs.database import QualityCheckDB
+from libs.preprocessing import BLACKED_OUT, BLACKED_OUT_RAW, image_crop, remove_background
+from libs.pyramid import ImagePyramid
+from libs.quality_check import get_qc_rows
+
+STAGES = ["image_crop", "remove_background", "MeasurementEvaluator.analyse",
+          "MaterialErrorDetector.analyse", "reconstruct_image", "preview", "QualityCheckDB.insert_quality_check"]
+PIPELINE = "pipeline"
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _metadata() -> dict:
+    return {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+    }
+
+
+def _load_models(dpi: int, anomaly_backend: str = "torch") -> tuple[dict, dict]:
+    ''' Load the models the same way the worker processes do, returns the models and the load errors. '''
+    models = {}
+    errors = {}
+    try:
+        from measurement_analysis.measurement_evaluation import MeasurementEvaluator
+        models["MeasurementEvaluator.analyse"] = MeasurementEvaluator()
+    except Exception as ex:
+        errors["MeasurementEvaluator.analyse"] = repr(ex)
+    try:
+        from processes import create_material_error_detector
+        detector = create_material_error_detector(dpi)
+        if detector.session is None:
+            raise RuntimeError("Could not load material error model!")
+        models["MaterialErrorDetector.analyse"] = detector
+    except Exception as ex:
+        errors["MaterialErrorDetector.analyse"] = repr(ex)
+    try:
+        from processes import ANOMALY_MODEL_PATHS, create_anomaly_detector
+        models["reconstruct_image"] = create_anomaly_detector(ANOMALY_MODEL_PATHS[anomaly_backend])
+    except Exception as ex:
+        errors["reconstruct_image"] = repr(ex)
+    return models, errors
+
+
+def _run_sheet(scan: cv2.typing.MatLike, dpi: int, models: dict, db: QualityCheckDB) -> dict[str, float]:
+    ''' Process one sheet like main.py does, returns the duration of every stage and the whole pipeline. '''
+    timings = {}
+
+    def _timed(stage, func, *args, **kwargs):
+        before = time.perf_counter()
+        result = func(*args, **kwargs)
+        timings[stage] = time.perf_counter() - before
+        return result
+
+    before_pipeline = time.perf_counter()
+    image_cropped = _timed("image_crop", image_crop, scan)
+    # the background is removed once for all stages, like main.py does
+    artifacts = _timed("remove_background", remove_background, image_cropped, (BLACKED_OUT, BLACKED_OUT_RAW))
+
+    measure_results = []
+    if "MeasurementEvaluator.analyse" in models:
+        measure_results = _timed("MeasurementEvaluator.analyse",
+                                 models["MeasurementEvaluator.analyse"].analyse, artifacts[BLACKED_OUT], dpi,
+                                 background_removed=True)
+    material_error_results = []
+    if "MaterialErrorDetector.analyse" in models:
+        material_error_results = _timed("MaterialErrorDetector.analyse",
+                                        models["MaterialErrorDetector.analyse"].analyse, artifacts[BLACKED_OUT], 0.8,
+                                        background_removed=True)
+    material_error_results = merge_boxes(material_error_results)
+    reconstruction_error = 0
+    if "reconstruct_image" in models:
+        _, reconstruction_error = _timed("reconstruct_image", models["reconstruct_image"].reconstruct_image,
+                                         artifacts[BLACKED_OUT_RAW])
+
+    qc_result, rows = get_qc_rows(measure_results, material_error_results, reconstruction_error)
+    # the HMI and the database share the downscaled sheet, like main.py does
+    preview = _timed("preview", ImagePyramid(image_cropped).scaled, 0.25)
+    _timed("QualityCheckDB.insert_quality_check", db.insert_quality_check, qc_result, rows, preview,
+           image_resize=False)
+    timings[PIPELINE] = time.perf_counter() - before_pipeline
+    return timings
+
+
+def _summarize(durations: list[float]) -> dict:
+    return {
+        "runs": len(durations),
+        "mean_s": statistics.mean(durations),
+        "median_s": statistics.median(durations),
+        "min_s": min(durations),
+        "max_s": max(durations),
+    }
+
+
+def benchmark_dpi(dpi: int, sheets: int, defects: int, repeats: int, anomaly_backend: str = "torch") -> dict:
+    '''
+    Time the pipeline on synthetic sheets of the given resolution.
+
+    Parameters:
+        dpi: resolution of the synthetic scans.
+        sheets: number of different synthetic sheets.
+        defects: number of material errors per sheet.
+        repeats: how often every sheet is processed.
+        anomaly_backend: torch or onnx, see processes.create_anomaly_detector.
+
+    Returns:
+        result: image shape and the timings or the error of every stage.
+    '''
+    scans = [generate_sheet(dpi, defects, seed) for seed in range(sheets)]
+    models, errors = _load_models(dpi, anomaly_backend)
+
+    durations: dict[str, list[float]] = {stage: [] for stage in STAGES + [PIPELINE]}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db = QualityCheckDB(os.path.join(tmp_dir, "benchmark.db"))
+        _run_sheet(scans[0], dpi, models, db)  # first inference and allocations are not part of the measurement
+        for _ in range(repeats):
+            for scan in scans:
+                for stage, duration in _run_sheet(scan, dpi, models, db).items():
+                    durations[stage].append(duration)
+
+    stages = {}
+    for stage, stage_durations in durations.items():
+        if stage in errors:
+            stages[stage] = {"error": errors[stage]}
+        elif len(stage_durations) > 0:
+            stages[stage] = _summarize(stage_durations)
+    return {"dpi": dpi, "shape": list(scans[0].shape), "defects": defects, "anomaly_backend": anomaly_backend,
+            "stages": stages}
+
+
+def compare(old: dict, new: dict):
+    ''' Print the median durations of two benchmark results side by side. '''
+    print(f"comparing {old['metadata'].get('commit')} (old) with {new['metadata'].get('commit')} (new)")
+    old_results = {result["dpi"]: result for result in old["results"]}
+    for result in new["results"]:
+        old_result = old_results.get(result["dpi"])
+        if old_result is None:
+            continue
+        print(f"{result['dpi']} dpi:")
+        for stage, timing in result["stages"].items():
+            old_timing = old_result["stages"].get(stage, {})
+            if "median_s" not in timing or "median_s" not in old_timing:
+                continue
+            ratio = timing["median_s"] / old_timing["median_s"]
+            print(f"  {stage:40s} {old_timing['median_s']:8.3f} s -> {timing['median_s']:8.3f} s  ({ratio:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark on synthetic sheets")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[300, 600])
+    parser.add_argument("--sheets", type=int, default=2, help="number of different synthetic sheets per dpi")
+    parser.add_argument("--defects", type=int, default=1, help="material errors per sheet")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--anomaly-backend", choices=["torch", "onnx"], default="torch")
+    parser.add_argument("--output", default="benchmark_results.json", help="json file to write the results to")
+    parser.add_argument("--compare", help="json file of an earlier run to compare the results with")
+    args = parser.parse_args()
+
+    results = {"metadata": _metadata(), "results": []}
+    for dpi in args.dpi:
+        result = benchmark_dpi(dpi, args.sheets, args.defects, args.repeats, args.anomaly_backend)
+        results["results"].append(result)
+        print(f"{dpi} dpi, {result['shape'][1]}x{result['shape'][0]} px:")
+        for stage, timing in result["stages"].items():
+            if "error" in timing:
+                print(f"  {stage:40s} skipped: {timing['error']}")
+            else:
+                print(f"  {stage:40s} {timing['median_s']:8.3f} s (median of {timing['runs']})")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Saved {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
@@ -0,0 +1,112 @@
+"""
+Synthetic scans for benchmarks and the dummy mode, no scanner or fabric required.
+
+A sheet is a grey scanner background with a white strip at the bottom, a textured fabric rectangle with
+two punched circles and optional material errors built with data_generation.distorted_mass_generation.
+
+Usage (from the repository root), e.g. to fill the dummy_scans folder:
+    python -m benchmarks.synthetic_sheets --dpi 600 --count 5 --defects 1 --output-dir dummy_scans
+"""
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+MM_PER_INCH = 25.4
+PAGE_INCH = (8.27, 11.69)  # width, height (A4)
+WHITE_BOTTOM_INCH = 0.5
+# fabric geometry in mm, within the tolerances of measurement_analysis/configurations/measurement.json
+FABRIC_MM = (169.0, 240.0)  # width (weft edge), height (warp edge)
+FABRIC_OFFSET_MM = (20.0, 15.0)
+CIRCLE_RADIUS_MM = 5.0
+CIRCLE_CENTERS_MM = [(25.0, 35.0), (15.0, 195.0)]  # relative to the top left fabric corner
+# colors in BGR, the background is inside the grey hsv range of libs.preprocessing, the fabric is light
+BACKGROUND_BGR = (190, 178, 172)
+FABRIC_BGR = (212, 218, 224)
+DEFECT_BGR = (120, 132, 150)
+
+
+def _mm_to_px(mm: float, dpi: int) -> int:
+    return int(round(mm * dpi / MM_PER_INCH))
+
+
+def _texture(shape: tuple[int, int], color: tuple[int, int, int], rng: np.random.Generator) -> np.ndarray:
+    ''' A woven looking texture: a fine grid pattern plus noise around the given color. '''
+    rows = np.arange(shape[0], dtype=np.float32)[:, None]
+    cols = np.arange(shape[1], dtype=np.float32)[None, :]
+    weave = 6.0 * np.sin(rows * 0.9) * np.sin(cols * 0.9)
+    noise = rng.normal(0.0, 6.0, size=shape).astype(np.float32)
+    texture = np.empty((*shape, 3), dtype=np.uint8)
+    for channel, value in enumerate(color):
+        texture[..., channel] = np.clip(value + weave + noise, 0, 255)
+    return texture
+
+
+def _add_defect(fabric: np.ndarray, dpi: int, rng: np.random.Generator):
+    ''' Paste a distorted patch of a different texture into the fabric. '''
+    import random2
+    from data_generation.distorted_mass_generation import build_shape
+
+    random2.seed(int(rng.integers(2 ** 31)))
+    size = _mm_to_px(6.0, dpi)
+    variation = max(size // 4, 1)
+    patch_shape = (size + 4 * variation, size + 4 * variation)
+    mask = build_shape((2 * variation, 2 * variation), size, size, 6, variation, patch_shape)
+
+    y = int(rng.integers(0, fabric.shape[0] - patch_shape[0]))
+    x = int(rng.integers(0, fabric.shape[1] - patch_shape[1]))
+    region = fabric[y:y + patch_shape[0], x:x + patch_shape[1]]
+    defect = _texture(patch_shape, DEFECT_BGR, rng)
+    region[mask > 0] = defect[mask > 0]
+
+
+def generate_sheet(dpi: int = 600, defects: int = 0, seed: int = 0) -> cv2.typing.MatLike:
+    '''
+    Generate a synthetic scan as it is returned by the scanner, converted to opencv (BGR).
+
+    Parameters:
+        dpi: resolution of the scan.
+        defects: number of material errors in the fabric.
+        seed: seed of the random texture and defect placement.
+
+    Returns:
+        scan: the synthetic scan.
+    '''
+    rng = np.random.default_rng(seed)
+    height = int(PAGE_INCH[1] * dpi)
+    width = int(PAGE_INCH[0] * dpi)
+
+    scan = np.empty((height, width, 3), dtype=np.uint8)
+    scan[:] = BACKGROUND_BGR
+    scan[height - int(WHITE_BOTTOM_INCH * dpi):] = 255
+
+    fabric = _texture((_mm_to_px(FABRIC_MM[1], dpi), _mm_to_px(FABRIC_MM[0], dpi)), FABRIC_BGR, rng)
+    for _ in range(defects):
+        _add_defect(fabric, dpi, rng)
+    for center in CIRCLE_CENTERS_MM:
+        # punched holes show the background
+        cv2.circle(fabric, (_mm_to_px(center[0], dpi), _mm_to_px(center[1], dpi)),
+                   _mm_to_px(CIRCLE_RADIUS_MM, dpi), BACKGROUND_BGR, thickness=cv2.FILLED)
+
+    top = _mm_to_px(FABRIC_OFFSET_MM[1], dpi)
+    left = _mm_to_px(FABRIC_OFFSET_MM[0], dpi)
+    scan[top:top + fabric.shape[0], left:left + fabric.shape[1]] = fabric
+    return scan
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic scans")
+    parser.add_argument("--dpi", type=int, default=600)
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--defects", type=int, default=0, help="material errors per sheet")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default="dummy_scans")
+    args = parser.parse_args()
+
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for idx in range(args.count):
+        path = output_dir / f"synthetic_{args.dpi}dpi_{args.seed + idx:03d}.png"
+        cv2.imwrite(str(path), generate_sheet(args.dpi, args.defects, args.seed + idx))
+        print(f"Saved {path}")
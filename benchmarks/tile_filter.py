@@ -0,0 +1,87 @@
+"""
+Skip counts and regression check of the background tile filter of the material error detection
+(MaterialErrorDetector.filter_background_tiles, --min-fabric-fraction of main.py).
+
+Cuts synthetic sheets, or recorded scans, into the tiles of the material error detection and reports how many tiles
+the filter skips and how long it takes, once for the sheet and once for a narrow product covering only part of its
+width. The fabric fraction the filter estimates from the sampled integral image is compared with the exact fraction
+of every tile, the run fails if a tile is kept or skipped differently than with the exact fraction beyond the
+sampling error. The model is not run, the filter only needs the tile geometry.
+
+Usage (from the repository root):
+    python -m benchmarks.tile_filter --dpi 300 600 --min-fabric-fraction 0.05 --narrow 0.5
+"""
+import argparse
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from benchmarks.synthetic_sheets import generate_sheet
+from err_detection.material_evaluation import MaterialErrorDetector
+from libs.preprocessing import BLACKED_OUT, image_crop, remove_background
+from processes import create_material_error_detector
+
+# largest difference of the sampled and the exact fabric fraction of a tile still accepted as sampling error
+SAMPLING_TOLERANCE = 0.01
+
+
+def _exact_fractions(image: np.ndarray, detector: MaterialErrorDetector) -> np.ndarray:
+    ''' Fabric fraction of every tile, counted on every pixel. '''
+    fabric = np.any(image, axis=2)
+    return np.array([fabric[eb.top_left[1]:eb.bottom_right[1], eb.top_left[0]:eb.bottom_right[0]].mean()
+                     for eb in detector.get_tile_boxes(*image.shape[:2])])
+
+
+def check_image(name: str, image: np.ndarray, detector: MaterialErrorDetector) -> int:
+    ''' Filter the tiles of a blacked out image, returns the number of tiles decided wrongly. '''
+    eval_boxes = detector.get_tile_boxes(*image.shape[:2])
+    before = time.perf_counter()
+    kept = detector.filter_background_tiles(image, eval_boxes)
+    duration = time.perf_counter() - before
+
+    fractions = _exact_fractions(image, detector)
+    kept_ids = {id(eb) for eb in kept}
+    kept_mask = np.array([id(eb) in kept_ids for eb in eval_boxes])
+    expected = fractions >= detector.min_fabric_fraction
+    # tiles close to the threshold may fall on both sides of it
+    ambiguous = np.abs(fractions - detector.min_fabric_fraction) <= SAMPLING_TOLERANCE
+    wrong = int(np.sum((kept_mask != expected) & ~ambiguous))
+    print(f"  {name:24s} {len(eval_boxes) - len(kept):4d} of {len(eval_boxes):4d} tiles skipped "
+          f"({(len(eval_boxes) - len(kept)) / max(len(eval_boxes), 1):.0%}), {duration * 1000:6.1f} ms"
+          f"{'' if wrong == 0 else f'  {wrong} WRONG'}")
+    return wrong
+
+
+def narrow(image: np.ndarray, width_fraction: float) -> np.ndarray:
+    ''' The blacked out image of a product covering only the left width_fraction of the sheet. '''
+    narrowed = image.copy()
+    narrowed[:, round(image.shape[1] * width_fraction):] = 0
+    return narrowed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Skip counts and regression check of the background tile filter")
+    parser.add_argument("--dpi", type=int, nargs="+", default=[300, 600])
+    parser.add_argument("--images", nargs="*", default=[], help="recorded scans, taken with the first --dpi")
+    parser.add_argument("--min-fabric-fraction", type=float, default=0.05)
+    parser.add_argument("--narrow", type=float, default=0.5, help="width fraction of the simulated narrow product")
+    args = parser.parse_args()
+
+    wrong = 0
+    for dpi in args.dpi:
+        detector = create_material_error_detector(dpi, min_fabric_fraction=args.min_fabric_fraction)
+        images = [(f"synthetic {dpi} dpi", generate_sheet(dpi, defects=1, seed=dpi))]
+        if dpi == args.dpi[0]:
+            images += [(path, cv2.imread(path)) for path in args.images]
+        print(f"{dpi} dpi, tiles of {detector.size} px:")
+        for name, scan in images:
+            blacked_out = remove_background(image_crop(scan), (BLACKED_OUT,))[BLACKED_OUT]
+            wrong += check_image(name, blacked_out, detector)
+            wrong += check_image(f"{name} narrow", narrow(blacked_out, args.narrow), detector)
+
+    if wrong:
+        print(f"{wrong} tiles are filtered differently than with the exact fabric fraction!")
+        sys.exit(1)
+    print("All tiles are filtered like with the exact fabric fraction.")
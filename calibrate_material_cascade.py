@@ -0,0 +1,147 @@
+"""
+Calibration of the first stage of the material error cascade, see MaterialErrorDetector.cascade_scores.
+
+The scans are cropped, blacked out and tiled like on the test bench, and every tile with enough fabric is scored by
+the same cascade_scores path as in MaterialErrorDetector.analyse, on the same band of the sheet and the same low
+resolution level. The classifier is the reference: the threshold is set below the lowest score of the tiles it flags
+as material error, so on the calibration scans the first stage does not change a single decision of the classifier
+and the recall of the cascade equals the recall of the classifier. Held out scans show whether the threshold
+generalizes; the fraction of the other tiles stopped by the first stage is the share of the classifier runs saved.
+
+Use scans with material errors, archived scans of flagged sheets are best:
+
+    python calibrate_material_cascade.py --scan-dir archive/calibration \
+        --model ./err_detection/models/res_net/resmodel50.onnx
+"""
+import argparse
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from data_transfer.dtos import MaterialCascadeConfig
+from err_detection.material_evaluation import MaterialErrorDetector
+from libs.preprocessing import BLACKED_OUT, image_crop, remove_background
+from processes import create_material_error_detector
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+
+def score_scan(detector: MaterialErrorDetector, image: np.ndarray, precision: float,
+               shard_count: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    The texture scores and the classifier decisions of the tiles of a scan, like MaterialErrorDetector.analyse.
+
+    Parameters:
+        detector: the material error detector, its cascade_config gives the tile size of the low resolution level.
+        image: an uncropped scan.
+        precision: detection threshold of the classifier.
+        shard_count: the number of material error workers, every shard scores its own band like on the test bench.
+
+    Returns:
+        scores: the texture score of every tile with enough fabric.
+        flagged: whether the classifier flags the tile as material error.
+    '''
+    blacked_out = remove_background(image_crop(image), (BLACKED_OUT,))[BLACKED_OUT]
+    scores = []
+    flagged = []
+    for shard_index in range(shard_count):
+        band, eval_boxes, band_top = detector.shard_band(blacked_out, shard_index, shard_count,
+                                                         background_removed=True)
+        eval_boxes = detector.filter_background_tiles(band, eval_boxes, band_top)
+        if len(eval_boxes) == 0:
+            continue
+        scores.append(detector.cascade_scores(band, eval_boxes, band_top))
+        flagged.append(detector.predict_tiles(band, eval_boxes, band_top)[:, 1] > precision)
+    if len(scores) == 0:
+        return np.empty(0), np.empty(0, dtype=bool)
+    return np.concatenate(scores), np.concatenate(flagged)
+
+
+def _recall(scores: np.ndarray, threshold: float) -> float | None:
+    return float(np.mean(scores >= threshold)) if len(scores) > 0 else None
+
+
+def _stopped(scores: np.ndarray, threshold: float) -> float | None:
+    return float(np.mean(scores < threshold)) if len(scores) > 0 else None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the first stage of the material error cascade")
+    parser.add_argument("--scan-dir", required=True, help="directory with uncropped scans")
+    parser.add_argument("--dpi", type=int, default=600, help="DPI setting the scans were taken with")
+    parser.add_argument("--model", default="./err_detection/models/res_net/resmodel50.onnx",
+                        help="onnx classifier of the test bench, the tiles it flags are the material errors")
+    parser.add_argument("--precision", type=float, default=0.8, help="detection threshold of the classifier")
+    parser.add_argument("--material-workers", type=int, default=1,
+                        help="number of material error workers of main.py, the tiles are scored per shard")
+    parser.add_argument("--margin", type=float, default=0.8,
+                        help="the threshold is this fraction of the lowest score of a material error")
+    parser.add_argument("--validation-split", type=float, default=0.2, help="fraction of the scans held out")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tile-size", type=int, default=64, help="size of a tile on the low resolution level")
+    parser.add_argument("--output", default="./err_detection/configurations/material_cascade.json",
+                        help="cascade configuration to write")
+    args = parser.parse_args()
+
+    paths = sorted(path for path in Path(args.scan_dir).iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+    if len(paths) == 0:
+        parser.error(f"no scans in '{args.scan_dir}'")
+    detector = create_material_error_detector(args.dpi, path_to_model=args.model)
+    if detector.session is None:
+        parser.error(f"could not load material error model '{args.model}'")
+    detector.cascade_config = MaterialCascadeConfig(None, args.tile_size)
+
+    held_out_scans = set(np.random.default_rng(args.seed).permutation(len(paths))[
+                         :round(len(paths) * args.validation_split)].tolist())
+    scores = []
+    errors = []
+    held_out = []
+    for i, path in enumerate(paths):
+        image = cv2.imread(str(path))
+        if image is None:
+            print(f"Warning! Could not read image '{path}'!")
+            continue
+        scan_scores, scan_errors = score_scan(detector, image, args.precision, args.material_workers)
+        print(f"[{i + 1}/{len(paths)}] {path.name}: {len(scan_scores)} tiles, {np.sum(scan_errors)} flagged")
+        scores.append(scan_scores)
+        errors.append(scan_errors)
+        held_out.append(np.full(len(scan_scores), i in held_out_scans))
+    scores = np.concatenate(scores)
+    errors = np.concatenate(errors)
+    held_out = np.concatenate(held_out)
+
+    calibration_errors = scores[errors & ~held_out]
+    if len(calibration_errors) == 0:
+        parser.error("the classifier flags no tile of the calibration scans, add scans with material errors or "
+                     "lower --validation-split")
+    # errors scored inf (too little fabric) always pass, they do not bound the threshold
+    finite = calibration_errors[np.isfinite(calibration_errors)]
+    threshold = float(args.margin * finite.min()) if len(finite) > 0 else 0.0
+
+    calibration = {
+        "scan_dir": args.scan_dir,
+        "dpi": args.dpi,
+        "model": args.model,
+        "precision": args.precision,
+        "material_workers": args.material_workers,
+        "margin": args.margin,
+        "calibration_tiles": int(np.sum(~held_out)),
+        "calibration_errors": len(calibration_errors),
+        "calibration_recall": _recall(calibration_errors, threshold),
+        "calibration_stopped": _stopped(scores[~errors & ~held_out], threshold),
+        "validation_tiles": int(np.sum(held_out)),
+        "validation_errors": int(np.sum(errors & held_out)),
+        "validation_recall": _recall(scores[errors & held_out], threshold),
+        "validation_stopped": _stopped(scores[~errors & held_out], threshold),
+    }
+    print(f"threshold {threshold:.3f}")
+    for key, value in calibration.items():
+        print(f"  {key}: {value}")
+    if calibration["validation_recall"] is not None and calibration["validation_recall"] < 1:
+        print("Warning! The first stage stops material errors of the held out scans, lower --margin!")
+
+    with open(args.output, "w") as f:
+        json.dump(MaterialCascadeConfig(threshold, args.tile_size, calibration).toJSON(), f, indent=4)
+    print(f"Saved {args.output}")
@@ -115,4 +115,221 @@ class TemplateMatchConfig(object):
                                      json.get('rel_y_0',0.0),
                                      json.get('rel_y_1',1.0),
                                      json.get('match_type',cv.TM_CCOEFF)
-                                     )
\ No newline at end of file
+                                     )
+
+class OnnxSessionConfig(object):
+    '''
+    Options of the onnx inference session of a detector and how its tiles are batched,
+    see err_detection/configurations/onnx_session.json. The defaults are the onnxruntime defaults.
+    '''
+    def __init__(self,
+                 batch_size : int = 0,
+                 intra_op_num_threads : int = 0,
+                 inter_op_num_threads : int = 0,
+                 graph_optimization_level : str = 'ORT_ENABLE_ALL',
+                 enable_cpu_mem_arena : bool = True,
+                 execution_mode : str = 'ORT_SEQUENTIAL',
+                 io_binding : bool = False,
+                 overlap_preprocessing : bool = False) -> None:
+        '''
+        Parameters:
+            batch_size: tiles per session run, 0 runs all tiles of a sheet at once.
+            intra_op_num_threads: threads of an operator, 0 uses all cores.
+            inter_op_num_threads: threads running operators in parallel (ORT_PARALLEL), 0 uses all cores.
+            graph_optimization_level: name of an onnxruntime.GraphOptimizationLevel.
+            enable_cpu_mem_arena: reuse the memory of the session between runs.
+            execution_mode: name of an onnxruntime.ExecutionMode.
+            io_binding: bind the preallocated input and output buffers instead of copying them.
+            overlap_preprocessing: prepare the next batch while the session runs the current one.
+        '''
+        self.batch_size = batch_size
+        self.intra_op_num_threads = intra_op_num_threads
+        self.inter_op_num_threads = inter_op_num_threads
+        self.graph_optimization_level = graph_optimization_level
+        self.enable_cpu_mem_arena = enable_cpu_mem_arena
+        self.execution_mode = execution_mode
+        self.io_binding = io_binding
+        self.overlap_preprocessing = overlap_preprocessing
+
+    @staticmethod
+    def from_json(json : dict[str,typing.Any]):
+        return OnnxSessionConfig(json.get('batch_size', 0),
+                                 json.get('intra_op_num_threads', 0),
+                                 json.get('inter_op_num_threads', 0),
+                                 json.get('graph_optimization_level', 'ORT_ENABLE_ALL'),
+                                 json.get('enable_cpu_mem_arena', True),
+                                 json.get('execution_mode', 'ORT_SEQUENTIAL'),
+                                 json.get('io_binding', False),
+                                 json.get('overlap_preprocessing', False))
+
+class MaterialCascadeConfig(object):
+    '''
+    Coarse first stage of the material error detection, a texture statistic of every tile on a low resolution level
+    of the sheet, see err_detection/configurations/material_cascade.json and calibrate_material_cascade.py.
+    '''
+    def __init__(self,
+                 threshold : typing.Optional[float] = None,
+                 tile_size : int = 64,
+                 calibration : typing.Optional[dict[str,typing.Any]] = None) -> None:
+        '''
+        Parameters:
+            threshold: tiles scoring lower are not passed to the classifier, None disables the cascade.
+            tile_size: size of a tile on the low resolution level in px.
+            calibration: data and recall the threshold was calibrated with, written by calibrate_material_cascade.py.
+        '''
+        self.threshold = threshold
+        self.tile_size = tile_size
+        self.calibration = calibration
+
+    @staticmethod
+    def from_json(json : dict[str,typing.Any]):
+        return MaterialCascadeConfig(json.get('threshold', None),
+                                     json.get('tile_size', 64),
+                                     json.get('calibration', None))
+
+    def toJSON(self):
+        return {'threshold': self.threshold,
+                'tile_size': self.tile_size,
+                'calibration': self.calibration}
+
+class AnomalyTilingConfig(object):
+    '''
+    Tiled inference of the anomaly detection autoencoder at a level of the image pyramid of the sheet, see
+    Autoencoder/configurations/tiling.json and Autoencoder/tiling.py.
+    '''
+    def __init__(self,
+                 patch_size : typing.Optional[int] = None,
+                 overlap : int = 32,
+                 batch_size : int = 4,
+                 level : int = 1) -> None:
+        '''
+        Parameters:
+            patch_size: size of the square patches in px, a multiple of 64. None resizes the whole sheet to the
+                model input instead.
+            overlap: px the neighbouring patches overlap, blended in the reconstruction.
+            batch_size: patches per run of the autoencoder.
+            level: level of the image pyramid the patches are cut from, 0 is the full resolution.
+        '''
+        self.patch_size = patch_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.level = level
+
+    @staticmethod
+    def from_json(json : dict[str,typing.Any]):
+        return AnomalyTilingConfig(json.get('patch_size', None),
+                                   json.get('overlap', 32),
+                                   json.get('batch_size', 4),
+                                   json.get('level', 1))
+
+    def toJSON(self):
+        return {'patch_size': self.patch_size,
+                'overlap': self.overlap,
+                'batch_size': self.batch_size,
+                'level': self.level}
+
+class FrameDescriptor(object):
+    '''
+    Handle of an image stored in a shared memory frame pool slot. Only this small object is sent over pipes.
+    '''
+    def __init__(self, slot: int, shape: tuple[int, ...], dtype: str) -> None:
+        self.slot = slot
+        self.shape = shape
+        self.dtype = dtype
+
+    def get_nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+
+class SheetJob(object):
+    '''
+    A sheet sent to a worker process. The artifacts of the sheet the worker needs (see libs.preprocessing) are
+    passed as shared memory frames by name, the worker releases all of them. image_id identifies the sheet in the
+    stage cache if it may be processed more than once (dummy mode). with_reconstruction requests the full
+    reconstructed image of the anomaly detection, see AnomalyResult.
+    '''
+    def __init__(self, trace_id: str, frames: dict[str, FrameDescriptor],
+                 image_id: typing.Optional[str] = None, with_reconstruction: bool = False) -> None:
+        self.trace_id = trace_id
+        self.frames = frames
+        self.image_id = image_id
+        self.with_reconstruction = with_reconstruction
+
+
+class AnomalyResult(object):
+    '''
+    The result of the anomaly detection of a sheet, computed in the worker so only the compact error map is sent to
+    the main process, see Autoencoder/anomaly_map.py.
+    '''
+    def __init__(self,
+                 heatmap: typing.Optional[np.ndarray],
+                 reconstruction_error: float,
+                 regions: list[EvalBox],
+                 reconstruction: typing.Optional[np.ndarray] = None) -> None:
+        '''
+        Parameters:
+            heatmap: reconstruction error of every pixel as uint8 image, downscaled from the sheet geometry.
+                None if the anomaly detection is inactive.
+            reconstruction_error: the error of the sheet checked against RECONSTRUCTION_ERROR_THRESHOLD.
+            regions: the areas of a high error, in px of the cropped sheet.
+            reconstruction: the reconstructed image, only if requested by SheetJob.with_reconstruction.
+        '''
+        self.heatmap = heatmap
+        self.reconstruction_error = reconstruction_error
+        self.regions = regions
+        self.reconstruction = reconstruction
+
+
+class WorkerResult(object):
+    '''
+    The result of a worker process for one sheet together with the timing spans recorded in the worker.
+    '''
+    def __init__(self, trace_id: str, value: typing.Any, spans: list, model_version: str | None = None,
+                 counts: dict[str, int] | None = None) -> None:
+        self.trace_id = trace_id
+        self.value = value
+        self.spans = spans
+        # version of the model the result was computed with, see libs.model_registry
+        self.model_version = model_version
+        # counters of the sheet, e.g. the tiles of the material error detection, empty for a cached result
+        self.counts = counts or {}
+
+
+class WorkerReady(object):
+    '''
+    Sent once by a worker process after its model is loaded and warmed up, with the startup and warm-up spans.
+    '''
+    def __init__(self, name: str, spans: list) -> None:
+        self.name = name
+        self.spans = spans
+
+
+class ReloadModel(object):
+    '''
+    Sent on the control connection of a worker to load a version of its model in the background, None is the
+    active version of the model registry.
+    '''
+    def __init__(self, name: str, version: str | None = None) -> None:
+        self.name = name
+        self.version = version
+
+
+class ModelReloaded(object):
+    '''
+    Answer of a worker to ReloadModel once the model is loaded and warmed up, error is set if loading failed.
+    '''
+    def __init__(self, worker: str, name: str, version: str | None, error: str | None = None) -> None:
+        self.worker = worker
+        self.name = name
+        self.version = version
+        self.error = error
+
+
+class SwapModel(object):
+    '''
+    Sent on the sheet connection of a worker, so the sheets sent before are processed with the old and the sheets
+    sent after with the reloaded model. Version None discards the reloaded model.
+    '''
+    def __init__(self, name: str, version: str | None) -> None:
+        self.name = name
+        self.version = version
@@ -25,11 +25,10 @@ class HomologyDetector(object):
 
 
     def reinit(self, path_to_model : str):
-        old = self.model
-        try:
-            self.model = joblib.load(path_to_model)
-        except:
-            self.model = old
+        '''
+        Load another model, raises the error of joblib if it cannot be loaded and keeps the old model then.
+        '''
+        self.model = joblib.load(path_to_model)
 
     def analyse(self,img: cv.typing.MatLike, precission = 0.7):
         '''
@@ -42,10 +41,6 @@ class HomologyDetector(object):
         Returns:
             list[eval_box]: The boundary boxes and the label if it is an error.
         '''
-        new_width = int(img.shape[1] * 0.5) 
-        new_height = int(img.shape[0] * 0.5)
-        # Bild skalieren
-        img_resized = cv.resize(img, (new_width, new_height), interpolation=cv.INTER_AREA)
         if self.model == None:
             return [EvalBox(
                 top_left=(0,0),
@@ -3,19 +3,71 @@ Created on Mon Sept 17 10:53:00 2024
 
 @author: Thomas Schmeyer
 """
+import json
+from concurrent.futures import Future, ThreadPoolExecutor
 import tensorflow as tf
 import cv2 as cv
 import numpy as np 
-from data_transfer.dtos import EvalBox
+from data_transfer.dtos import EvalBox, MaterialCascadeConfig, OnnxSessionConfig
 import onnxruntime
 import err_detection.utils.helper as h
 import libs.preprocessing as pre
+from libs.boxes import near_duplicates
+from libs.onnx_session import create_inference_session
+
+# border of the preprocessing band around a shard, covers the 5x5 kernel of pre.morph
+MORPH_MARGIN = 2
+# every n-th row and column is sampled for the fabric fraction of the tiles, a 1024 px tile still has 65536 samples
+FABRIC_SAMPLE_STRIDE = 4
+# low resolution tiles with fewer fabric pixels are always passed to the classifier by the cascade
+CASCADE_MIN_FABRIC_PIXELS = 16
+# tiles shifted by at most this fraction of the tile size against another tile are not analysed twice
+DUPLICATE_TILE_FRACTION = 1 / 16
+
+
+def fabric_mask(level: np.ndarray) -> np.ndarray:
+    '''
+    The fabric pixels of a low resolution blacked out image, without the pixels next to the background which
+    the downscaling mixed with the black background.
+    '''
+    return cv.erode(np.any(level, axis=2).view(np.uint8), np.ones((3, 3), np.uint8)) > 0
+
+
+def texture_score(tile: np.ndarray, fabric: np.ndarray | None = None) -> float:
+    '''
+    Score of the first stage of the material error cascade: the largest deviation of a fabric pixel from the median
+    color of the fabric in the tile, in robust standard deviations (median absolute deviation) of the channel.
+
+    Parameters:
+        tile: blacked out tile on the low resolution level, see MaterialCascadeConfig.tile_size.
+        fabric: fabric_mask of the tile, cut from the mask of the whole level so the tile border is eroded too.
+
+    Returns:
+        score: inf if the tile has too little fabric to be scored.
+    '''
+    if fabric is None:
+        fabric = fabric_mask(tile)
+    pixels = tile[fabric].T.astype(np.float32)  # channel, pixel
+    count = pixels.shape[1]
+    if count < CASCADE_MIN_FABRIC_PIXELS:
+        return np.inf
+    # the (upper) median by partitioning, about twice as fast as np.median
+    middle = count // 2
+    deviation = np.abs(pixels - np.partition(pixels, middle, axis=1)[:, middle:middle + 1])
+    # 1.4826 scales the median absolute deviation to a standard deviation, +1 for flat tiles
+    spread = np.partition(deviation, middle, axis=1)[:, middle:middle + 1] * 1.4826 + 1.0
+    return float(np.max(deviation / spread))
+
 
 class MaterialErrorDetector():
     def __init__(self,
                  path_to_model = './err_detection/models/res_net/resmodel50.onnx',
                  size : int = 1024,
-                 r_scale: int = 224) -> None:
+                 r_scale: int = 224,
+                 num_threads: int = 0,
+                 session_config_path: str | None = './err_detection/configurations/onnx_session.json',
+                 min_fabric_fraction: float = 0.05,
+                 cascade_config_path: str | None = './err_detection/configurations/material_cascade.json') -> None:
         '''
         Initialize the adapted model.
 
@@ -23,9 +75,32 @@ class MaterialErrorDetector():
             path_to_model: the model to load.
             size: The size of the cropped models
             r_scale: The rescaling pixel size.
+            num_threads: The number of threads used by the onnx session, 0 takes intra_op_num_threads of the
+                session configuration.
+            session_config_path: The onnx session and batching options, see OnnxSessionConfig. None uses the
+                onnxruntime defaults and runs all tiles at once.
+            min_fabric_fraction: Tiles with less fabric (not blacked out pixels) are skipped instead of being
+                analysed, e.g. tiles on the margin of narrow products. 0 analyses all tiles.
+            cascade_config_path: The first stage of the cascade, see MaterialCascadeConfig. None passes all tiles
+                to the classifier.
         '''
+        self.num_threads = num_threads
+        self.min_fabric_fraction = min_fabric_fraction
+        self.cascade_config = MaterialCascadeConfig()
+        if cascade_config_path is not None:
+            with open(cascade_config_path) as f:
+                self.cascade_config = MaterialCascadeConfig.from_json(json.load(f))
+        # tiles of the last analysed image: all tiles of the shard, the tiles skipped as background and the tiles
+        # stopped by the first stage of the cascade
+        self.tile_counts: dict[str, int] = {}
+        self.path_to_model = path_to_model
+        self.session_config = OnnxSessionConfig()
+        if session_config_path is not None:
+            with open(session_config_path) as f:
+                self.session_config = OnnxSessionConfig.from_json(json.load(f))
+        self._executor: ThreadPoolExecutor | None = None
         try:
-            self.session = onnxruntime.InferenceSession(path_to_model)
+            self.session = self._create_session(path_to_model)
             #self.model.summary()
         except Exception as e:
             self.session = None
@@ -33,6 +108,12 @@ class MaterialErrorDetector():
         self.stride = size//2
         self.size = size
         self.r_scale = r_scale
+        # resized tiles and input slots of the model (slot, tile, NHWC), reused for every sheet and grown if needed
+        self._tiles = np.empty((0, r_scale, r_scale, 3), dtype=np.uint8)
+        self._batch = np.empty((0, 0, r_scale, r_scale, 3), dtype=np.float32)
+
+    def _create_session(self, path_to_model: str) -> onnxruntime.InferenceSession:
+        return create_inference_session(path_to_model, self.session_config, self.num_threads)
 
     def reinit(self,
                path_to_model: str,
@@ -45,54 +126,65 @@ class MaterialErrorDetector():
             path_to_model: the model to load.
             size: The size of the cropped models
             r_scale: The rescaling pixel size.
+
+        Raises the error of onnxruntime if the model cannot be loaded, the detector keeps its old model then.
         '''
-        old = self.session
-        try:
-            self.session = onnxruntime.InferenceSession(path_to_model)
-            self.size = size
-            self.stride = size // 2
+        session = self._create_session(path_to_model)
+        self.session = session
+        self.path_to_model = path_to_model
+        self.size = size
+        self.stride = size // 2
+        if r_scale != self.r_scale:
             self.r_scale = r_scale
-        except:
-            self.session = old
+            self._tiles = np.empty((0, r_scale, r_scale, 3), dtype=np.uint8)
+            self._batch = np.empty((0, 0, r_scale, r_scale, 3), dtype=np.float32)
     
     def analyse(self,
                 image: cv.typing.MatLike,
                 precision: float = 0.5,
-                show_result_img=False) -> list[EvalBox]:
+                show_result_img=False,
+                shard_index: int = 0,
+                shard_count: int = 1,
+                background_removed: bool = False) -> list[EvalBox]:
         '''
         Analyse the image on material errors.
 
         Parameter:
             image: The image to analyse.
             precision: The threshold to detect a error.
+            shard_index: The horizontal shard of the tiles to analyse.
+            shard_count: The number of shards the tiles are split into, see get_shard_boxes.
+            background_removed: The grey background of the image is already replaced by black (with morph step),
+                see preprocessing.BLACKED_OUT.
         
         Returns:
             list[eval_box]: A list of bounding boxes with detected errors with a probability
-            greater then the precision.
+            greater then the precision. The tile counts of the image are left in tile_counts.
         '''
+        image, eval_boxes, band_top = self.shard_band(image, shard_index, shard_count, background_removed)
+        self.tile_counts = {"tiles": len(eval_boxes), "skipped": 0, "cascade_stopped": 0}
+        if len(eval_boxes) == 0:
+            return []
 
-        image = pre.replace_grey_with_black_hsv(image=image,morph_step=True)
-        height, width, _ = image.shape
-        width_stride = width // self.stride
-        height_stride = height // self.stride
-        imgs = []
-        eval_boxes: list[EvalBox] = []
-
-        self.get_preprocessed_imgs(image, width_stride, height_stride, imgs, eval_boxes)
-        # right boundary
-        self.get_preprocessed_right_boundary_imgs(image, height_stride, imgs, eval_boxes)
-        # bottom
-        self.get_preprocessed_bottom_boundary_imgs(image, width_stride, imgs, eval_boxes)
-        # corner image
-        self.get_preprocessed_corner_img(image,imgs,eval_boxes)
-        
-        x = np.array(imgs)
-        x = x.astype(np.float32)
-        session = self.session
-        input_name = session.get_inputs()[0].name
-        output_name = session.get_outputs()[0].name
-        res = session.run([output_name], {input_name: x})
-        prediction = res[0]
+        tile_count = len(eval_boxes)
+        eval_boxes = self.filter_background_tiles(image, eval_boxes, band_top)
+        self.tile_counts["skipped"] = tile_count - len(eval_boxes)
+        if len(eval_boxes) < tile_count:
+            print(f"Skipped {tile_count - len(eval_boxes)} of {tile_count} tiles with less than "
+                  f"{self.min_fabric_fraction:.0%} fabric!")
+
+        threshold = self.cascade_config.threshold
+        if threshold is not None and len(eval_boxes) > 0:
+            # most sheets are free of errors, their tiles stop at the cheap first stage
+            scores = self.cascade_scores(image, eval_boxes, band_top)
+            passed = [eb for eb, score in zip(eval_boxes, scores) if score >= threshold]
+            self.tile_counts["cascade_stopped"] = len(eval_boxes) - len(passed)
+            print(f"Cascade passed {len(passed)} of {len(eval_boxes)} tiles to the classifier!")
+            eval_boxes = passed
+        if len(eval_boxes) == 0:
+            return []
+
+        prediction = self.predict_tiles(image, eval_boxes, band_top)
         results : list[EvalBox] = []
         for i in range(len(eval_boxes)):
             eb = eval_boxes[i]
@@ -106,144 +198,273 @@ class MaterialErrorDetector():
                 print('error found on crop index:' + str(i) + ' prob:' + str(probability))
 
         if show_result_img:
+            image = image.copy()
             for r in results:
-                cv.rectangle(image, r.top_left, r.bottom_right, (255, 0, 0), 10)
+                cv.rectangle(image, (r.top_left[0], r.top_left[1] - band_top),
+                             (r.bottom_right[0], r.bottom_right[1] - band_top), (255, 0, 0), 10)
             cv.imshow("result", image)
             cv.waitKey(0)
         return results
 
-    def append_preprocessed_img(self,
-                                imgs: list[cv.typing.MatLike],
-                                new_size: tuple[int, int],
-                                image: cv.typing.MatLike) -> bool:
+    def shard_band(self,
+                   image: cv.typing.MatLike,
+                   shard_index: int = 0,
+                   shard_count: int = 1,
+                   background_removed: bool = False) -> tuple[cv.typing.MatLike, list[EvalBox], int]:
         '''
-        Preprocess the image and append the result to imgs. 
-        It returns true if the dimension of the crop is valid.
+        The tiles of a shard and the blacked out band of the image they cover, like analyse runs the later stages on.
+
+        Parameter:
+            image: The image to analyse.
+            shard_index: The horizontal shard of the tiles.
+            shard_count: The number of shards the tiles are split into, see get_shard_boxes.
+            background_removed: The grey background of the image is already replaced by black, see analyse.
+
+        Returns:
+            band: The blacked out rows covered by the tiles, the image itself if there are no tiles.
+            list[eval_box]: The tiles of the shard.
+            band_top: The row of the band in the image.
+        '''
+        height, width, _ = image.shape
+        eval_boxes = self.get_tile_boxes(height, width)
+        if shard_count > 1:
+            eval_boxes = self.get_shard_boxes(eval_boxes, shard_index, shard_count)
+        if len(eval_boxes) == 0:
+            return image, eval_boxes, 0
+
+        # only the rows covered by the tiles are preprocessed, the margin keeps the morphology identical
+        band_top = max(0, min(eb.top_left[1] for eb in eval_boxes) - MORPH_MARGIN)
+        band_bottom = min(height, max(eb.bottom_right[1] for eb in eval_boxes) + MORPH_MARGIN)
+        image = image[band_top:band_bottom]
+        if not background_removed:
+            image = pre.replace_grey_with_black_hsv(image=image, morph_step=True)
+        return image, eval_boxes, band_top
+
+    def get_tile_boxes(self, height: int, width: int) -> list[EvalBox]:
+        '''
+        All tiles of an image to analyse, see get_tile_coordinates.
 
         Parameters:
-            imgs: The image list to append the image.
-            new_size: The new resolution of the image in both directions.
-            image: The processed image.
-        '''
-        # enable to debug
-        # cv.imshow("crop",image)
-        # cv.waitKey(0)
-        if image.shape[0] < self.size or image.shape[1] < self.size:
-            return False
-        img_preprocessed = cv.resize(image, new_size)
-        img_preprocessed = pre.preprocessing_resnet50v2(img_preprocessed)
-        imgs.append(img_preprocessed)
-        return True
-
-    def get_preprocessed_corner_img(self,
-                                    image: cv.typing.MatLike,
-                                    imgs: list[cv.typing.MatLike],
-                                    eval_boxes: list[EvalBox]):
-        '''
-        Crop the bottom right corner of the image.
+            height: The height of the image.
+            width: The width of the image.
+
+        Returns:
+            list[eval_box]: The tiles as default evaluated bounding boxes without precision.
+        '''
+        return [EvalBox(top_left=(x_0, y_0), bottom_right=(x_1, y_1), precision=0.0, label='')
+                for x_0, y_0, x_1, y_1 in self.get_tile_coordinates(height, width).tolist()]
+
+    def get_tile_coordinates(self, height: int, width: int) -> np.ndarray:
+        '''
+        The tiles of an image to analyse: the inner grid with half overlapping tiles first, followed by the right
+        boundary, the bottom boundary and the bottom right corner. Tiles (nearly) duplicating a tile closer to the
+        right or bottom border are left out, see libs.boxes.near_duplicates.
 
         Parameters:
-            image: The original image.
-            imgs: The list to store the processed cropped image.
-            eval_boxes: The list to store the default evaluated bounding box without precision.
+            height: The height of the image.
+            width: The width of the image.
+
+        Returns:
+            coordinates: x_0, y_0, x_1, y_1 of every tile.
         '''
-        new_size = (self.r_scale, self.r_scale)
-        crop = image[-self.size:, -self.size:]
-        valid = self.append_preprocessed_img(imgs, new_size, crop)
+        # the grid positions a tile fits into the image
+        rows = np.arange(height // self.stride) * self.stride
+        rows = rows[rows + self.size <= height]
+        cols = np.arange(width // self.stride) * self.stride
+        cols = cols[cols + self.size <= width]
 
-        if valid:
-            eval_boxes.append(EvalBox(
-                top_left=(
-                    image.shape[1] - self.size, image.shape[0] - self.size),
-                bottom_right=(image.shape[1], image.shape[0]),
-                precision=0.0,
-                label=''))
+        grid_rows, grid_cols = np.meshgrid(rows, cols, indexing='ij')
+        top_lefts = [np.stack([grid_cols.ravel(), grid_rows.ravel()], axis=1)]
+        if width >= self.size:  # right boundary
+            top_lefts.append(np.stack([np.full_like(rows, width - self.size), rows], axis=1))
+        if height >= self.size:  # bottom
+            top_lefts.append(np.stack([cols, np.full_like(cols, height - self.size)], axis=1))
+        if height >= self.size and width >= self.size:  # corner image
+            top_lefts.append(np.array([[width - self.size, height - self.size]]))
+        top_lefts = np.concatenate(top_lefts).astype(np.int64)
+        coordinates = np.concatenate([top_lefts, top_lefts + self.size], axis=1)
+        return coordinates[~near_duplicates(coordinates, width, height, int(self.size * DUPLICATE_TILE_FRACTION))]
 
-    def get_preprocessed_bottom_boundary_imgs(self,
-                                              image: cv.typing.MatLike,
-                                              width_stride: int,
-                                              imgs: list[cv.typing.MatLike],
-                                              eval_boxes: list[EvalBox]):
+    def get_shard_boxes(self,
+                        eval_boxes: list[EvalBox],
+                        shard_index: int,
+                        shard_count: int) -> list[EvalBox]:
         '''
-        Divide the image's bottom into the parts to analyse.
+        Split the tiles into horizontal shards of about the same number of tiles.
+        Every shard covers a band of rows, so a worker only has to preprocess its band.
 
         Parameters:
-            image: The original image.
-            width_stride: The max number of steps in width direction.
-            imgs: The list to store the processed cropped image.
-            eval_boxes: The list to store the default evaluated bounding box without precision.
+            eval_boxes: All tiles of the image.
+            shard_index: The shard to return.
+            shard_count: The number of shards.
+
+        Returns:
+            list[eval_box]: The tiles of the shard.
         '''
-        stride = [self.stride, self.stride]
-        new_size = (self.r_scale, self.r_scale)
-        for j in range(width_stride):
-            w_0 = j * stride[1]
-            w_1 = w_0 + self.size
-            crop = image[-self.size:, w_0:w_1]
-            valid = self.append_preprocessed_img(imgs, new_size, crop)
-            if valid:
-                eval_boxes.append(EvalBox(
-                    top_left=(w_0, image.shape[0] - self.size),
-                    bottom_right=(w_1, image.shape[0]),
-                    precision=0.0,
-                    label=''))
-
-    def get_preprocessed_right_boundary_imgs(self,
-                                             image: cv.typing.MatLike,
-                                             height_stride: int,
-                                             imgs: list[cv.typing.MatLike],
-                                             eval_boxes: list[EvalBox]):
-        '''
-        Divide the image's right boundary into the parts to analyse. 
+        ordered = sorted(eval_boxes, key=lambda eb: (eb.top_left[1], eb.top_left[0]))
+        first = len(ordered) * shard_index // shard_count
+        last = len(ordered) * (shard_index + 1) // shard_count
+        return ordered[first:last]
+
+    def filter_background_tiles(self,
+                                image: cv.typing.MatLike,
+                                eval_boxes: list[EvalBox],
+                                band_top: int = 0) -> list[EvalBox]:
+        '''
+        Remove the tiles with less than min_fabric_fraction fabric. The fabric fraction of all tiles is looked up in
+        one integral image of the fabric mask, sampled every FABRIC_SAMPLE_STRIDE pixels.
 
         Parameters:
-            image: The original image.
-            height_stride: The max number of steps in height direction.
-            imgs: The list to store the processed cropped image.
-            eval_boxes: The list to store the default evaluated bounding box without precision.
+            image: The blacked out image, or a band of it.
+            eval_boxes: The tiles to filter.
+            band_top: The row of the image in the whole image the boxes refer to.
+
+        Returns:
+            list[eval_box]: The tiles with enough fabric, in the same order.
         '''
-        stride = [self.stride, self.stride]
-        new_size = (self.r_scale, self.r_scale)
-        for i in range(height_stride):
-            h_0 = i * stride[0]
-            h_1 = h_0 + self.size
-            crop = image[h_0:h_1, -self.size:]
-            valid = self.append_preprocessed_img(imgs, new_size, crop)
-            if valid:
-                eval_boxes.append(EvalBox(
-                    top_left=(image.shape[1] - self.size, h_0),
-                    bottom_right=(image.shape[1], h_1),
-                    precision=0.0,
-                    label=''))
-
-    def get_preprocessed_imgs(self,
-                              image: cv.typing.MatLike,
-                              width_stride: int,
-                              height_stride: int,
-                              imgs: list[cv.typing.MatLike],
-                              eval_boxes: list[EvalBox]):
-        '''
-        Divide the image into the parts to analyse. Ignores the right and bottom boundary.
+        if self.min_fabric_fraction <= 0 or len(eval_boxes) == 0:
+            return eval_boxes
+        step = FABRIC_SAMPLE_STRIDE
+        fabric = np.any(image[::step, ::step], axis=2).view(np.uint8)
+        integral = cv.integral(fabric)
+        boxes = np.array([(*eb.top_left, *eb.bottom_right) for eb in eval_boxes], dtype=np.int64)
+        boxes[:, [1, 3]] -= band_top
+        # index of the first sample at or after every border, the samples of a tile are [x_0, x_1) x [y_0, y_1)
+        x_0, y_0, x_1, y_1 = ((boxes + step - 1) // step).T
+        fabric_samples = integral[y_1, x_1] - integral[y_0, x_1] - integral[y_1, x_0] + integral[y_0, x_0]
+        samples = np.maximum((x_1 - x_0) * (y_1 - y_0), 1)
+        keep = fabric_samples >= self.min_fabric_fraction * samples
+        return [eb for eb, kept in zip(eval_boxes, keep) if kept]
+
+    def cascade_scores(self,
+                       image: cv.typing.MatLike,
+                       eval_boxes: list[EvalBox],
+                       band_top: int = 0) -> np.ndarray:
+        '''
+        The texture scores of the tiles, see texture_score. The image is downscaled once, so a tile has
+        cascade_config.tile_size px, and the tiles are cut from the low resolution level.
+
+        Parameters:
+            image: The blacked out image, or a band of it.
+            eval_boxes: The tiles to score.
+            band_top: The row of the image in the whole image the boxes refer to.
+
+        Returns:
+            scores: The score of every tile.
+        '''
+        tile_size = self.cascade_config.tile_size
+        scale = tile_size / self.size
+        height, width = image.shape[:2]
+        level = cv.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                          interpolation=cv.INTER_AREA)
+        fabric = fabric_mask(level)
+        scores = np.empty(len(eval_boxes))
+        for i, eb in enumerate(eval_boxes):
+            x_0 = round(eb.top_left[0] * scale)
+            y_0 = round((eb.top_left[1] - band_top) * scale)
+            tile = np.s_[y_0:y_0 + tile_size, x_0:x_0 + tile_size]
+            scores[i] = texture_score(level[tile], fabric[tile])
+        return scores
+
+    def predict_tiles(self,
+                      image: cv.typing.MatLike,
+                      eval_boxes: list[EvalBox],
+                      band_top: int = 0) -> np.ndarray:
+        '''
+        Run the model on the tiles, in batches of session_config.batch_size tiles. With overlap_preprocessing the
+        next batch is prepared while the session runs the current one, the session releases the GIL.
+
+        Parameters:
+            image: The blacked out image, or a band of it.
+            eval_boxes: The tiles to analyse.
+            band_top: The row of the image in the whole image the boxes refer to.
+
+        Returns:
+            prediction: The model output of every tile.
+        '''
+        count = len(eval_boxes)
+        batch_size = min(self.session_config.batch_size or count, count)
+        # two input buffers, one is prepared while the session reads the other one
+        slots = 2 if self.session_config.overlap_preprocessing and batch_size < count else 1
+        self._ensure_buffers(batch_size, slots)
+        if slots == 2 and self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="material_error_inference")
+
+        predictions: list[np.ndarray] = []
+        running: Future | None = None
+        for k, first in enumerate(range(0, count, batch_size)):
+            x = self.preprocess_tiles(image, eval_boxes[first:first + batch_size], band_top,
+                                      out=self._batch[k % slots][:min(batch_size, count - first)])
+            if slots == 1:
+                predictions.append(self._run(x))
+                continue
+            if running is not None:
+                predictions.append(running.result())
+            running = self._executor.submit(self._run, x)
+        if running is not None:
+            predictions.append(running.result())
+        return np.concatenate(predictions)
+
+    def _run(self, x: np.ndarray) -> np.ndarray:
+        '''
+        One session run on a batch, with io_binding the batch is read in place and the output written into
+        a preallocated array.
+        '''
+        session = self.session
+        input_name = session.get_inputs()[0].name
+        output = session.get_outputs()[0]
+        if not self.session_config.io_binding:
+            return session.run([output.name], {input_name: x})[0]
+
+        binding = session.io_binding()
+        binding.bind_input(input_name, 'cpu', 0, np.float32, list(x.shape), x.ctypes.data)
+        classes = output.shape[-1] if output.shape else None
+        if output.type != 'tensor(float)' or not isinstance(classes, int):
+            # unknown output shape, onnxruntime allocates the output
+            binding.bind_output(output.name, 'cpu')
+            session.run_with_iobinding(binding)
+            return binding.copy_outputs_to_cpu()[0]
+        prediction = np.empty((len(x), classes), dtype=np.float32)
+        binding.bind_output(output.name, 'cpu', 0, np.float32, list(prediction.shape), prediction.ctypes.data)
+        session.run_with_iobinding(binding)
+        return prediction
+
+    def _ensure_buffers(self, batch_size: int, slots: int):
+        '''
+        Allocate the input slots of the model, reused for every sheet.
+        '''
+        if self._batch.shape[0] < slots or self._batch.shape[1] < batch_size or self._batch.shape[2] != self.r_scale:
+            self._batch = np.empty((slots, batch_size, self.r_scale, self.r_scale, 3), dtype=np.float32)
+
+    def preprocess_tiles(self,
+                         image: cv.typing.MatLike,
+                         eval_boxes: list[EvalBox],
+                         band_top: int = 0,
+                         out: np.ndarray | None = None) -> np.ndarray:
+        '''
+        Resize the tiles into one batch and normalize it like preprocessing_resnet50v2.
 
         Parameters:
-            image: The original image.
-            width_stride: The max number of steps in width direction.
-            height_stride: The max number of steps in height direction.
-            imgs: The list to store the processed cropped image.
-            eval_boxes: The list to store the default evaluated bounding box without precision.
+            image: The blacked out image, or a band of it.
+            eval_boxes: The tiles to preprocess.
+            band_top: The row of the image in the whole image the boxes refer to.
+            out: float32 buffer for the batch, a reused buffer of the detector if None.
+
+        Returns:
+            batch: float32 batch of the tiles (NHWC).
         '''
-        stride = [self.stride, self.stride]
+        count = len(eval_boxes)
+        if out is None:
+            self._ensure_buffers(count, 1)
+            out = self._batch[0][:count]
+        if len(self._tiles) < count or self._tiles.shape[1] != self.r_scale:
+            self._tiles = np.empty((count, self.r_scale, self.r_scale, 3), dtype=np.uint8)
+        tiles = self._tiles[:count]
         new_size = (self.r_scale, self.r_scale)
-        for i in range(height_stride):
-            for j in range(width_stride):
-                h_0 = i * stride[0]
-                h_1 = h_0 + self.size
-                w_0 = j * stride[1]
-                w_1 = w_0 + self.size
-                crop = image[h_0:h_1, w_0:w_1]
-                valid = self.append_preprocessed_img(imgs, new_size, crop)
-                if valid:
-                    eval_boxes.append(EvalBox(
-                        top_left=(w_0, h_0),
-                        bottom_right=(w_1, h_1),
-                        precision=0.0,
-                        label=''))
+        for tile, eb in zip(tiles, eval_boxes):
+            crop = image[eb.top_left[1] - band_top:eb.bottom_right[1] - band_top, eb.top_left[0]:eb.bottom_right[0]]
+            # enable to debug
+            # cv.imshow("crop", crop)
+            # cv.waitKey(0)
+            cv.resize(crop, new_size, dst=tile)
+        return pre.preprocessing_resnet50v2_uint8(tiles, out=out)
@@ -0,0 +1,99 @@
+"""
+Export of the anomaly detection autoencoder to onnx, run by OnnxAnomalyDetector with onnxruntime instead of torch.
+
+After the export the parity of both backends is checked: the torch and the onnx model reconstruct the same sheets,
+blacked out like in the anomaly worker, and the run fails if the reconstruction errors differ by more than the
+tolerance. Without --images synthetic sheets are used. The anomaly worker runs the onnx model with
+--anomaly-backend onnx of main.py and batch_evaluation.py:
+
+    python export_autoencoder_onnx.py --images archive/evaluation/*.png
+    python main.py --anomaly-backend onnx
+"""
+import argparse
+import sys
+
+import cv2
+import numpy as np
+import torch
+
+from Autoencoder.onnx_inference import OnnxAnomalyDetector
+from Autoencoder.test import AnomalyDetectionAutoencoder
+from benchmarks.synthetic_sheets import generate_sheet
+from libs.preprocessing import BLACKED_OUT_RAW, image_crop, remove_background
+
+
+def export(model_path: str, output: str, opset: int = 17):
+    '''
+    Export the autoencoder with dynamic batch and image dimensions, for the input size of the anomaly detection and
+    for the patches of the tiled inference.
+
+    Parameters:
+        model_path: the trained state dict of Autoencoder.
+        output: path of the onnx model.
+        opset: onnx opset version.
+    '''
+    detector = AnomalyDetectionAutoencoder(model_path, device=torch.device("cpu"))
+    width, height = AnomalyDetectionAutoencoder.INPUT_SIZE
+    torch.onnx.export(detector.model, torch.zeros(1, 3, height, width), output,
+                      input_names=["input"], output_names=["output"],
+                      dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"},
+                                    "output": {0: "batch", 2: "height", 3: "width"}},
+                      opset_version=opset)
+
+
+def parity(model_path: str, onnx_path: str, images: list[tuple[str, np.ndarray]], tolerance: float) -> int:
+    '''
+    Compare the reconstruction errors of the torch and the onnx model.
+
+    Parameters:
+        model_path: the trained state dict of Autoencoder.
+        onnx_path: the exported model.
+        images: name and uncropped scan of every sheet.
+        tolerance: largest accepted difference of the errors relative to the torch error.
+
+    Returns:
+        failed: the number of sheets beyond the tolerance.
+    '''
+    torch_detector = AnomalyDetectionAutoencoder(model_path, device=torch.device("cpu"))
+    onnx_detector = OnnxAnomalyDetector(onnx_path)
+    failed = 0
+    for name, scan in images:
+        blacked_out_raw = remove_background(image_crop(scan), (BLACKED_OUT_RAW,))[BLACKED_OUT_RAW]
+        torch_image, torch_error = torch_detector.reconstruct_image(blacked_out_raw)
+        onnx_image, onnx_error = onnx_detector.reconstruct_image(blacked_out_raw)
+        difference = abs(float(onnx_error) - float(torch_error)) / max(float(torch_error), 1e-12)
+        pixels = np.abs(onnx_image.astype(np.int16) - torch_image.astype(np.int16)).max()
+        ok = difference <= tolerance
+        failed += not ok
+        print(f"  {name:32s} torch {torch_error:.6f} onnx {onnx_error:.6f} relative difference {difference:.2e}, "
+              f"max pixel difference {pixels}{'' if ok else '  FAILED'}")
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the anomaly detection autoencoder to onnx")
+    parser.add_argument("--model", default="Autoencoder/autoencoder_Final.pth", help="the trained torch model")
+    parser.add_argument("--output", default="Autoencoder/autoencoder_Final.onnx", help="path of the onnx model")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--skip-export", action="store_true", help="only check the parity of an exported model")
+    parser.add_argument("--images", nargs="*", default=[], help="uncropped scans of the parity check")
+    parser.add_argument("--dpi", type=int, default=600, help="dpi of the synthetic sheets used without --images")
+    parser.add_argument("--tolerance", type=float, default=1e-3,
+                        help="largest accepted difference of the reconstruction errors relative to torch")
+    args = parser.parse_args()
+
+    if not args.skip_export:
+        print(f"Exporting {args.model}...")
+        export(args.model, args.output, args.opset)
+        print(f"Saved {args.output}")
+
+    images = [(path, cv2.imread(path)) for path in args.images]
+    if len(images) == 0:
+        images = [(f"synthetic {defects} defects", generate_sheet(args.dpi, defects=defects, seed=defects))
+                  for defects in (0, 1, 3)]
+    print("Parity of the reconstruction errors:")
+    failed = parity(args.model, args.output, images, args.tolerance)
+    if failed:
+        print(f"{failed} reconstruction errors of the onnx model differ from torch!")
+        sys.exit(1)
+    print("The onnx model reconstructs like the torch model.")
@@ -1,5 +1,5 @@
 import asyncio
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 import cv2
 from PIL import Image
@@ -15,16 +15,43 @@ qc_table_columns = [
     {'name': 'target', 'label': 'Soll', 'field': 'target'},
 ]
 
+performance_table_columns = [
+    {'name': 'stage', 'label': 'Stage', 'field': 'stage', 'required': True, 'sortable': True, 'align': 'left'},
+    {'name': 'count', 'label': 'Anzahl', 'field': 'count'},
+    {'name': 'p50', 'label': 'p50 [ms]', 'field': 'p50', 'sortable': True},
+    {'name': 'p95', 'label': 'p95 [ms]', 'field': 'p95', 'sortable': True},
+    {'name': 'p99', 'label': 'p99 [ms]', 'field': 'p99', 'sortable': True},
+]
+
+count_table_columns = [
+    {'name': 'name', 'label': 'Zähler', 'field': 'name', 'required': True, 'sortable': True, 'align': 'left'},
+    {'name': 'sheets', 'label': 'Blätter', 'field': 'sheets'},
+    {'name': 'last', 'label': 'Letztes Blatt', 'field': 'last'},
+    {'name': 'mean', 'label': 'Mittel pro Blatt', 'field': 'mean', 'sortable': True},
+]
+
+model_table_columns = [
+    {'name': 'model', 'label': 'Modell', 'field': 'model', 'required': True, 'align': 'left'},
+    {'name': 'version', 'label': 'Aktive Version', 'field': 'version', 'align': 'left'},
+    {'name': 'versions', 'label': 'Registrierte Versionen', 'field': 'versions', 'align': 'left'},
+]
+
 
 def _prepare_image(cv_image: cv2.typing.MatLike) -> str:
-    rotated = cv2.rotate(cv_image, cv2.ROTATE_90_COUNTERCLOCKWISE)
-    return convert_opencv_to_base64(cv2.resize(rotated, None, fx=HMI.SCALE_FACTOR, fy=HMI.SCALE_FACTOR))
+    return convert_opencv_to_base64(cv2.rotate(cv_image, cv2.ROTATE_90_COUNTERCLOCKWISE))
 
 
 class HMI:
+    # the images are shown scaled by SCALE_FACTOR, the callers pass them already scaled, e.g. from the ImagePyramid
+    # of the sheet, so the full resolution image is not resampled for every update
     SCALE_FACTOR = 0.25
 
-    def __init__(self):
+    def __init__(self, models: list[str] = (), on_reload_model: Callable[[str, str | None], Awaitable] | None = None):
+        '''
+        Parameters:
+            models: names of the models which can be reloaded from the model registry while running.
+            on_reload_model: called with the model and the version to load, None for the active version.
+        '''
 
         self._empty_image = Image.new("RGB", (600, 400), (200,200,200)) # TODO
 
@@ -36,6 +63,8 @@ class HMI:
                     # self._tab_setup = ui.tab('setup', label='Einstellungen', icon='settings')
                     self._tab_qc = ui.tab('qc', 'Qualitätskontrolle', icon='rule')
                     self._tab_trend = ui.tab('trend', label='Trendauswertung', icon='assessment')
+                    self._tab_performance = ui.tab('performance', label='Laufzeiten', icon='speed')
+                    self._tab_models = ui.tab('models', label='Modelle', icon='model_training')
             with splitter.after:
                 with ui.tab_panels(tabs, value=self._tab_qc).props('vertical').classes('w-full h-full'):
                     with ui.tab_panel(self._tab_qc):
@@ -67,6 +96,21 @@ class HMI:
                     with ui.tab_panel(self._tab_trend):
                         TrendPlots()
 
+                    with ui.tab_panel(self._tab_performance):
+                        self._performance_table = ui.table(columns=performance_table_columns, rows=[],
+                                                           row_key='stage')
+                        self._count_table = ui.table(columns=count_table_columns, rows=[], row_key='name')
+
+                    with ui.tab_panel(self._tab_models):
+                        self._model_table = ui.table(columns=model_table_columns, rows=[], row_key='model')
+                        if on_reload_model is not None and len(models) > 0:
+                            with ui.row().classes('items-center'):
+                                model_select = ui.select(list(models), value=models[0], label='Modell')
+                                version_input = ui.input('Version', placeholder='aktive Version der Registry')
+                                # the workers keep checking sheets while the new model is loaded
+                                ui.button('Modell laden', icon='sync', on_click=lambda: on_reload_model(
+                                    model_select.value, version_input.value or None))
+
         # with ui.footer().classes('justify-center').style('background-color: #14144b'):
         with ui.footer().classes('justify-end').style('background-color: #37c346'):
             with ui.row():
@@ -112,5 +156,28 @@ class HMI:
         self._qc_table.update_rows(hmi_rows)
         await asyncio.sleep(0)
 
+    async def update_performance(self, rows: list[dict[str, Any]]):
+        hmi_rows = []
+        for row in rows:
+            copy = row.copy()
+            for percentile in ('p50', 'p95', 'p99'):
+                copy[percentile] = f'{copy[percentile]:.0f}'
+            hmi_rows.append(copy)
+        self._performance_table.update_rows(hmi_rows)
+        await asyncio.sleep(0)
+
+    async def update_counts(self, rows: list[dict[str, Any]]):
+        hmi_rows = []
+        for row in rows:
+            copy = row.copy()
+            copy['mean'] = f'{copy["mean"]:.1f}'
+            hmi_rows.append(copy)
+        self._count_table.update_rows(hmi_rows)
+        await asyncio.sleep(0)
+
+    async def update_models(self, rows: list[dict[str, Any]]):
+        self._model_table.update_rows(rows)
+        await asyncio.sleep(0)
+
 
 
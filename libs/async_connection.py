@@ -0,0 +1,42 @@
+import asyncio
+from multiprocessing.connection import Connection
+from typing import Any
+
+
+class AsyncConnection(object):
+    '''
+    Wraps a multiprocessing connection so that received messages can be awaited on the asyncio event loop.
+
+    The file descriptor of the connection is registered as reader of the running event loop on first use.
+    Every message is received the moment it arrives and handed to the oldest pending recv() call,
+    or buffered until someone awaits it. There is no polling involved.
+    '''
+    def __init__(self, conn: Connection) -> None:
+        self.conn = conn
+        self._messages: asyncio.Queue = asyncio.Queue()
+        self._loop = None
+
+    def _register(self):
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop.add_reader(self.conn.fileno(), self._on_readable)
+
+    def _on_readable(self):
+        try:
+            while self.conn.poll():
+                self._messages.put_nowait(self.conn.recv())
+        except (EOFError, OSError) as ex:
+            self._loop.remove_reader(self.conn.fileno())
+            self._messages.put_nowait(ex)
+
+    async def recv(self) -> Any:
+        ''' Wait for the next message of the connection. '''
+        self._register()
+        message = await self._messages.get()
+        if isinstance(message, (EOFError, OSError)):
+            self._messages.put_nowait(message)  # the connection stays broken for every further caller
+            raise message
+        return message
+
+    def send(self, obj: Any):
+        self.conn.send(obj)
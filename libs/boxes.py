@@ -0,0 +1,106 @@
+import numpy as np
+
+from data_transfer.dtos import EvalBox
+
+
+def box_array(eval_boxes: list[EvalBox]) -> np.ndarray:
+    ''' The boxes as array of x_0, y_0, x_1, y_1. '''
+    return np.array([(*eb.top_left, *eb.bottom_right) for eb in eval_boxes], dtype=np.int64).reshape(-1, 4)
+
+
+def overlap_matrix(boxes: np.ndarray) -> np.ndarray:
+    '''
+    Intersection over the area of the smaller box of every pair of boxes, 1 if a box contains the other.
+
+    Parameters:
+        boxes: x_0, y_0, x_1, y_1 of every box.
+
+    Returns:
+        overlap: symmetric matrix of the overlaps.
+    '''
+    x_0, y_0, x_1, y_1 = boxes.T
+    width = np.clip(np.minimum(x_1[:, None], x_1[None, :]) - np.maximum(x_0[:, None], x_0[None, :]), 0, None)
+    height = np.clip(np.minimum(y_1[:, None], y_1[None, :]) - np.maximum(y_0[:, None], y_0[None, :]), 0, None)
+    area = (x_1 - x_0) * (y_1 - y_0)
+    return width * height / np.maximum(np.minimum(area[:, None], area[None, :]), 1)
+
+
+def merge_boxes(eval_boxes: list[EvalBox], min_overlap: float = 0.2, max_growth: float = 0.5) -> list[EvalBox]:
+    '''
+    Merge the overlapping boxes of the same detection, e.g. the overlapping tiles flagged for the same material
+    error, like a non-maximum suppression: the box with the highest precision absorbs the boxes overlapping it,
+    then the next remaining box, and so on. Boxes only overlapping an absorbed box are not merged, so nearby
+    material errors stay separate boxes.
+
+    Parameters:
+        eval_boxes: the detected boxes.
+        min_overlap: a box is absorbed if it overlaps the box with the higher precision by at least this fraction of
+            the smaller box, see overlap_matrix. Half overlapping tiles overlap by 0.5, diagonal neighbours by 0.25.
+        max_growth: the merged box extends at most this fraction of the size of the absorbing box beyond it on
+            every side, half overlapping tiles extend it by 0.5.
+
+    Returns:
+        list[eval_box]: the merged boxes with the precision and the label of the absorbing box, in the order of
+            the first box of every group.
+    '''
+    if len(eval_boxes) < 2:
+        return list(eval_boxes)
+    boxes = box_array(eval_boxes)
+    overlapping = overlap_matrix(boxes) >= min_overlap
+    remaining = np.ones(len(boxes), dtype=bool)
+    groups = []
+    for best in sorted(range(len(boxes)), key=lambda i: -eval_boxes[i].precision):
+        if not remaining[best]:
+            continue
+        members = np.flatnonzero(overlapping[best] & remaining)
+        remaining[members] = False
+        groups.append((best, members))
+
+    merged = []
+    for best, members in sorted(groups, key=lambda group: group[1].min()):
+        if len(members) == 1:
+            merged.append(eval_boxes[best])
+            continue
+        x_0, y_0, x_1, y_1 = boxes[best]
+        growth_x = int((x_1 - x_0) * max_growth)
+        growth_y = int((y_1 - y_0) * max_growth)
+        top_left = np.maximum(boxes[members, :2].min(axis=0), (x_0 - growth_x, y_0 - growth_y))
+        bottom_right = np.minimum(boxes[members, 2:].max(axis=0), (x_1 + growth_x, y_1 + growth_y))
+        merged.append(EvalBox(top_left=tuple(top_left.tolist()),
+                              bottom_right=tuple(bottom_right.tolist()),
+                              precision=eval_boxes[best].precision,
+                              label=eval_boxes[best].label))
+    return merged
+
+
+def near_duplicates(boxes: np.ndarray, width: int, height: int, tolerance: int) -> np.ndarray:
+    '''
+    The windows of the same size shifted by at most tolerance against a kept window, which touches every image
+    border the window touches, so dropping the window does not leave a border uncovered. The windows are kept
+    greedily, those touching more borders first and of two windows touching the same borders the earlier one.
+    Every dropped window is within tolerance of a kept window, duplicates do not chain.
+
+    Parameters:
+        boxes: x_0, y_0, x_1, y_1 of every window.
+        width: width of the image.
+        height: height of the image.
+        tolerance: largest shift in px of a near duplicate.
+
+    Returns:
+        duplicate: True for the windows to drop.
+    '''
+    x_0, y_0, x_1, y_1 = boxes.T
+    borders = (x_0 == 0) * 1 | (y_0 == 0) * 2 | (x_1 == width) * 4 | (y_1 == height) * 8
+    shift = np.abs(boxes[:, None, :] - boxes[None, :, :]).max(axis=2)
+    covered = (borders[:, None] & ~borders[None, :]) == 0  # window j touches all borders of window i
+    replaceable = (shift <= tolerance) & covered
+    border_count = np.array([bin(border).count("1") for border in borders.tolist()], dtype=np.int64)
+    duplicate = np.zeros(len(boxes), dtype=bool)
+    kept = np.zeros(len(boxes), dtype=bool)
+    # a window covering the borders of another touches more borders, so it is decided first
+    for i in np.lexsort((np.arange(len(boxes)), -border_count)):
+        if np.any(replaceable[i] & kept):
+            duplicate[i] = True
+        else:
+            kept[i] = True
+    return duplicate
@@ -7,6 +7,8 @@ import cv2.typing
 import pandas as pd
 from PIL import Image
 
+from libs.tracing import Span
+
 
 def _rows_to_dataframe(rows):
     data_rows = []
@@ -32,7 +34,7 @@ class QualityCheckDB:
         self.create_table()
 
     def create_table(self):
-        """ Create the quality_checks table if it doesn't exist. """
+        """ Create the quality_checks and stage_timings tables if they don't exist. """
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
         cursor.execute('''
@@ -41,15 +43,41 @@ class QualityCheckDB:
                 check_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL, 
                 result INTEGER NOT NULL,
                 json_data TEXT NOT NULL,
-                image BLOB
+                image BLOB,
+                model_versions TEXT
+            )''')
+        # databases created before the model versions were recorded get the column added
+        columns = [column[1] for column in cursor.execute('PRAGMA table_info(quality_checks)')]
+        if 'model_versions' not in columns:
+            cursor.execute('ALTER TABLE quality_checks ADD COLUMN model_versions TEXT')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stage_timings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                check_id INTEGER REFERENCES quality_checks(id),
+                trace_id TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                duration REAL NOT NULL
+            )''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stage_counts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                check_id INTEGER REFERENCES quality_checks(id),
+                trace_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                count INTEGER NOT NULL
             )''')
         conn.commit()
         conn.close()
 
 
     def insert_quality_check(self, result: bool, rows: list[dict[str, Any]], image_cropped: cv2.typing.MatLike,
-                             image_ext = '.jpg', image_resize=True):
-        """ Insert a new quality check result along with the image into the database. """
+                             image_ext = '.jpg', image_resize=True,
+                             model_versions: dict[str, str | None] | None = None) -> int:
+        """
+        Insert a new quality check result along with the image into the database, returns its id.
+        model_versions are the versions of the models the sheet was checked with, see libs.model_registry.
+        """
 
         if image_resize:
             image_cropped = cv2.resize(image_cropped, None, fx=0.25, fy=0.25)
@@ -60,11 +88,55 @@ class QualityCheckDB:
         conn = sqlite3.connect(self.db_name)
         cursor = conn.cursor()
         # Insert the JSON data and image into the table
-        cursor.execute('INSERT INTO quality_checks (result, json_data, image) VALUES (?, ?, ?)',
-                       (result, json_string, buffer.tobytes()))
+        cursor.execute('INSERT INTO quality_checks (result, json_data, image, model_versions) VALUES (?, ?, ?, ?)',
+                       (result, json_string, buffer.tobytes(),
+                        json.dumps(model_versions) if model_versions is not None else None))
+        check_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return check_id
+
+    def insert_stage_timings(self, check_id: int, spans: list[Span]):
+        """ Insert the processing stage durations of a quality check, check_id is None for the startup. """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO stage_timings (check_id, trace_id, stage, start_time, duration) '
+                           'VALUES (?, ?, ?, ?, ?)',
+                           [(check_id, span.trace_id, span.stage, span.start, span.duration) for span in spans])
         conn.commit()
         conn.close()
 
+    def insert_stage_counts(self, check_id: int, trace_id: str, counts: dict[str, int]):
+        """ Insert the counters of a quality check, e.g. the tiles the material error detection skipped. """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO stage_counts (check_id, trace_id, name, count) VALUES (?, ?, ?, ?)',
+                           [(check_id, trace_id, name, count) for name, count in counts.items()])
+        conn.commit()
+        conn.close()
+
+    def retrieve_stage_counts(self, last=1000) -> list[tuple[str, int]]:
+        """ Retrieve name and value of the latest counters, oldest first. """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT name, count FROM stage_counts ORDER BY id DESC LIMIT ?', (last, ))
+        rows = cursor.fetchall()
+
+        conn.close()
+        return rows[::-1]
+
+    def retrieve_stage_timings(self, last=1000) -> list[tuple[str, float]]:
+        """ Retrieve stage name and duration of the latest stage timings, oldest first. """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT stage, duration FROM stage_timings ORDER BY id DESC LIMIT ?', (last, ))
+        rows = cursor.fetchall()
+
+        conn.close()
+        return rows[::-1]
+
     def retrieve_quality_checks(self, time_limit="-7 days"):
         """Retrieve and return all quality check data (except images) from the database."""
         conn = sqlite3.connect(self.db_name)
@@ -86,6 +158,18 @@ class QualityCheckDB:
 
         return df.set_index("check_time")
 
+    def retrieve_ids(self, time_from: str, time_to: str = "now") -> list[int]:
+        """ Return the ids of all quality checks between the two times, e.g. '2024-11-01 08:00:00' (UTC). """
+        conn = sqlite3.connect(self.db_name)
+        cursor = conn.cursor()
+
+        cursor.execute('SELECT id FROM quality_checks WHERE check_time BETWEEN datetime(?) AND datetime(?) ORDER BY id',
+                       (time_from, time_to))
+        ids = [row[0] for row in cursor.fetchall()]
+
+        conn.close()
+        return ids
+
     def retrieve_image(self, id_: int):
         conn = sqlite3.connect(self.db_name)
         conn.row_factory = sqlite3.Row
@@ -4,12 +4,20 @@ import cv2
 from PIL import Image
 import numpy as np
 
+from libs.streaming import pil_bands
+
 def convert_to_pillow(opencv_img: cv2.typing.MatLike) -> Image:
     return Image.fromarray(cv2.cvtColor(opencv_img, cv2.COLOR_BGR2RGB))
 
 
-def convert_to_opencv(pil_img: Image) -> cv2.typing.MatLike:
-    return cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+def convert_to_opencv(pil_img: Image.Image | np.ndarray, band_height: int | None = None) -> cv2.typing.MatLike:
+    if band_height is None or isinstance(pil_img, np.ndarray):
+        return cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
+    # band by band, np.asarray would copy the whole PIL image before the conversion
+    output = np.empty((pil_img.height, pil_img.width, 3), np.uint8)
+    for rows, band in pil_bands(pil_img, band_height):
+        cv2.cvtColor(band, cv2.COLOR_RGB2BGR, dst=output[rows])
+    return output
 
 
 def convert_opencv_to_base64(opencv_img: cv2.typing.MatLike, image_format='jpeg') -> str:
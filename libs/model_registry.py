@@ -0,0 +1,251 @@
+"""
+Versioned models of the workers, so a model can be replaced while the test bench is running.
+
+Every model (material_error, anomaly, homology) has a directory in the registry with one sub directory per version,
+holding the model file and a metadata.json with its checksum. The ACTIVE file of a model names the version the
+workers load on startup, without it the latest version is loaded:
+
+    model_registry/
+        material_error/
+            ACTIVE
+            2024-11-int8/
+                resmodel50_int8.onnx
+                metadata.json
+
+A new version is registered and listed with
+
+    python -m libs.model_registry register material_error 2024-11-int8 err_detection/models/res_net/resmodel50_int8.onnx
+    python -m libs.model_registry list material_error
+
+and loaded by the running test bench from the models tab of the HMI.
+"""
+import argparse
+import json
+import shutil
+import threading
+import time
+from multiprocessing.connection import Connection
+from pathlib import Path
+from typing import Any, Callable
+
+from data_transfer.dtos import ModelReloaded, ReloadModel, SwapModel
+from libs.stage_cache import hash_file
+
+METADATA_FILE = "metadata.json"
+ACTIVE_FILE = "ACTIVE"
+
+
+class ModelVersion(object):
+    '''
+    A version of a model, the model file and its metadata.
+    '''
+    def __init__(self, name: str, version: str, path: str, sha256: str, metadata: dict[str, Any] | None = None) -> None:
+        self.name = name
+        self.version = version
+        self.path = path
+        self.sha256 = sha256
+        self.metadata = metadata or {}
+
+    @staticmethod
+    def from_file(name: str, path: str) -> 'ModelVersion':
+        '''
+        The version of a model file. A file of the registry has the version it was registered with, any other file
+        is identified by its checksum.
+        '''
+        metadata_path = Path(path).parent / METADATA_FILE
+        if metadata_path.is_file():
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            if metadata.get("name") == name and metadata.get("file") == Path(path).name:
+                return ModelVersion(name, metadata["version"], str(path), metadata["sha256"], metadata)
+        sha256 = hash_file(path)
+        return ModelVersion(name, f"sha256:{sha256[:12]}", str(path), sha256)
+
+    def verify(self):
+        ''' Raises a RuntimeError if the model file does not match the checksum it was registered with. '''
+        if hash_file(self.path) != self.sha256:
+            raise RuntimeError(f"Checksum of model '{self.path}' ({self.name} {self.version}) does not match!")
+
+
+class ModelRegistry(object):
+    '''
+    Directory of versioned models with metadata and checksums, see the module documentation for the layout.
+    '''
+    def __init__(self, root: str = "./model_registry") -> None:
+        self.root = Path(root)
+
+    def versions(self, name: str) -> list[ModelVersion]:
+        ''' The registered versions of a model, the oldest first. '''
+        versions = []
+        model_dir = self.root / name
+        if not model_dir.is_dir():
+            return versions
+        for metadata_path in model_dir.glob(f"*/{METADATA_FILE}"):
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+            versions.append(ModelVersion(name, metadata["version"], str(metadata_path.parent / metadata["file"]),
+                                         metadata["sha256"], metadata))
+        return sorted(versions, key=lambda version: version.metadata.get("created", 0))
+
+    def get(self, name: str, version: str | None = None) -> ModelVersion:
+        '''
+        Parameters:
+            name: name of the model.
+            version: the version, None is the active version.
+
+        Returns:
+            model_version: the registered version, a RuntimeError is raised if there is none.
+        '''
+        if version is None:
+            model_version = self.active(name)
+            if model_version is None:
+                raise RuntimeError(f"No version of model '{name}' registered in '{self.root}'!")
+            return model_version
+        for model_version in self.versions(name):
+            if model_version.version == version:
+                return model_version
+        raise RuntimeError(f"Version '{version}' of model '{name}' not registered in '{self.root}'!")
+
+    def active(self, name: str) -> ModelVersion | None:
+        ''' The version named in the ACTIVE file of the model, the latest version without it. '''
+        active_path = self.root / name / ACTIVE_FILE
+        if active_path.is_file():
+            return self.get(name, active_path.read_text().strip())
+        versions = self.versions(name)
+        return versions[-1] if versions else None
+
+    def active_path(self, name: str) -> str | None:
+        ''' The model file of the active version, None if no version is registered. '''
+        model_version = self.active(name)
+        return model_version.path if model_version is not None else None
+
+    def set_active(self, name: str, version: str):
+        ''' Makes a registered version the version the workers load on startup. '''
+        self.get(name, version)
+        (self.root / name / ACTIVE_FILE).write_text(version)
+
+    def register(self, name: str, version: str, model_path: str, description: str = "") -> ModelVersion:
+        '''
+        Copies a model file into the registry.
+
+        Parameters:
+            name: name of the model.
+            version: the new version, must not be registered yet.
+            model_path: the model file.
+            description: free text stored in the metadata, e.g. the training data.
+
+        Returns:
+            model_version: the registered version.
+        '''
+        version_dir = self.root / name / version
+        if version_dir.exists():
+            raise RuntimeError(f"Version '{version}' of model '{name}' is already registered!")
+        version_dir.mkdir(parents=True)
+        path = version_dir / Path(model_path).name
+        shutil.copy2(model_path, path)
+        metadata = {
+            "name": name,
+            "version": version,
+            "file": path.name,
+            "sha256": hash_file(str(path)),
+            "source": str(model_path),
+            "description": description,
+            "created": time.time(),
+        }
+        with open(version_dir / METADATA_FILE, "w") as f:
+            json.dump(metadata, f, indent=4)
+        return ModelVersion(name, version, str(path), metadata["sha256"], metadata)
+
+
+class ModelReloader(object):
+    '''
+    Hot swap of the model of a worker process. The reload commands arrive on the control connection, the new
+    version is loaded and warmed up by a background thread while the worker keeps processing sheets with its
+    current model. The worker swaps the loaded model in when the main process sends SwapModel, between two sheets.
+    '''
+    def __init__(self, worker: str, version: ModelVersion | None, registry_dir: str | None = None,
+                 control_conn: Connection | None = None, load: Callable[[ModelVersion], Any] | None = None) -> None:
+        '''
+        Parameters:
+            worker: name of the worker, sent with the answers.
+            version: version of the model the worker started with.
+            registry_dir: root of the model registry.
+            control_conn: connection of the reload commands, without it the model is never reloaded.
+            load: loads and warms up a version of the model, raises on failure.
+        '''
+        self.worker = worker
+        self.version = version
+        self.registry = ModelRegistry(registry_dir) if registry_dir else None
+        self.control_conn = control_conn
+        self.load = load
+        self._pending: tuple[ModelVersion, Any] | None = None
+        self._lock = threading.Lock()
+        if control_conn is not None:
+            threading.Thread(target=self._listen, name=f"{worker}_reload", daemon=True).start()
+
+    @property
+    def active_version(self) -> str | None:
+        ''' Version of the model the worker currently uses, None if it runs without a model file. '''
+        return self.version.version if self.version is not None else None
+
+    def _listen(self):
+        while True:
+            try:
+                command: ReloadModel = self.control_conn.recv()
+            except EOFError:
+                return
+            try:
+                if self.registry is None:
+                    raise RuntimeError("No model registry configured!")
+                version = self.registry.get(command.name, command.version)
+                version.verify()
+                model = self.load(version)
+            except Exception as ex:
+                print(f"Warning! {self.worker} could not load model {command.name} {command.version}: {ex}")
+                self.control_conn.send(ModelReloaded(self.worker, command.name, command.version, str(ex)))
+                continue
+            with self._lock:
+                self._pending = (version, model)
+            self.control_conn.send(ModelReloaded(self.worker, command.name, version.version))
+
+    def swap(self, command: SwapModel) -> Any | None:
+        '''
+        Called by the worker between two sheets.
+
+        Returns:
+            model: the reloaded model if it has the version of the command, None if the worker keeps its model.
+        '''
+        with self._lock:
+            pending, self._pending = self._pending, None
+        if pending is None or command.version is None or pending[0].version != command.version:
+            return None
+        self.version = pending[0]
+        print(f"{self.worker} switched to model {self.version.name} {self.version.version}")
+        return pending[1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Versioned models of the workers")
+    parser.add_argument("--root", default="./model_registry", help="directory of the model registry")
+    commands = parser.add_subparsers(dest="command", required=True)
+    list_parser = commands.add_parser("list", help="list the versions of a model")
+    list_parser.add_argument("name")
+    register_parser = commands.add_parser("register", help="copy a model file into the registry")
+    register_parser.add_argument("name", help="material_error, anomaly or homology")
+    register_parser.add_argument("version")
+    register_parser.add_argument("model_path")
+    register_parser.add_argument("--description", default="")
+    register_parser.add_argument("--activate", action="store_true", help="load the version on the next startup")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(args.root)
+    if args.command == "register":
+        model_version = registry.register(args.name, args.version, args.model_path, args.description)
+        if args.activate:
+            registry.set_active(args.name, args.version)
+        print(f"Registered {model_version.name} {model_version.version} ({model_version.sha256[:12]})")
+    else:
+        active = registry.active(args.name)
+        for model_version in registry.versions(args.name):
+            marker = "*" if active is not None and model_version.version == active.version else " "
+            print(f"{marker} {model_version.version:24s} {model_version.sha256[:12]} {model_version.path}")
@@ -0,0 +1,23 @@
+import onnxruntime
+
+from data_transfer.dtos import OnnxSessionConfig
+
+
+def create_inference_session(path_to_model: str, config: OnnxSessionConfig,
+                             num_threads: int = 0) -> onnxruntime.InferenceSession:
+    '''
+    An onnx inference session with the options of a session configuration, shared by the detectors running onnx
+    models, see err_detection/configurations/onnx_session.json.
+
+    Parameters:
+        path_to_model: the model to load.
+        config: the session options.
+        num_threads: threads of an operator, 0 takes intra_op_num_threads of the configuration.
+    '''
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = num_threads or config.intra_op_num_threads
+    options.inter_op_num_threads = config.inter_op_num_threads
+    options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, config.graph_optimization_level)
+    options.enable_cpu_mem_arena = config.enable_cpu_mem_arena
+    options.execution_mode = getattr(onnxruntime.ExecutionMode, config.execution_mode)
+    return onnxruntime.InferenceSession(path_to_model, sess_options=options)
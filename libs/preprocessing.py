@@ -1,7 +1,17 @@
 import cv2
-import copy
+import typing
 import numpy as np
 import err_detection.utils.helper as helper
+from libs.streaming import row_bands
+
+# artifacts of a sheet the stages work on, see remove_background
+IMAGE = "image"                      # the cropped sheet itself
+BLACKED_OUT = "blacked_out"          # grey background replaced by black, with morph step
+BLACKED_OUT_RAW = "blacked_out_raw"  # grey background replaced by black, without morph step
+BACKGROUND_MASK = "background_mask"  # background mask of BLACKED_OUT, 255 for the background
+
+# rows the 5x5 dilation of the background mask reaches into the neighbouring bands, see remove_background
+_MORPH_OVERLAP = 2
 
 
 def delete_white_bottom(scanned_image : cv2.typing.MatLike) -> cv2.typing.MatLike:
@@ -15,75 +25,138 @@ def delete_white_bottom(scanned_image : cv2.typing.MatLike) -> cv2.typing.MatLik
         output: image without bottom white part
 
     '''
-    gray_image = cv2.cvtColor(scanned_image, cv2.COLOR_BGR2GRAY)
-    i_end = scanned_image.shape[0]
-    j_end = scanned_image.shape[1]
-    for i in reversed(range(0, i_end)):
-        if sum(gray_image[i,:(j_end//50)])/(j_end//50) < 253:
-            output = scanned_image[:i,:]
-            break
-    return output
+    return scanned_image[:_content_height(scanned_image),:]
 
 
+def _content_height(scanned_image : cv2.typing.MatLike, rgb : bool = False) -> int:
+    '''
+    Number of rows of the scanned image above the white bottom part, see delete_white_bottom.
+    '''
+    strip_width = scanned_image.shape[1]//50
+    #only the left strip is searched, so only the strip is converted to grey
+    gray_strip = cv2.cvtColor(scanned_image[:, :strip_width], cv2.COLOR_RGB2GRAY if rgb else cv2.COLOR_BGR2GRAY)
+    row_means = gray_strip.sum(axis=1, dtype=np.int64)/strip_width
+    #the last row which is not white, it is cut off as well
+    rows = np.flatnonzero(row_means < 253)
+    if len(rows) == 0:
+        raise RuntimeError("Scanned image is completely white!")
+    return int(rows[-1])
 
-def image_crop(image, thickness : int = 100) -> cv2.typing.MatLike:
+
+def _border_index(projection : np.ndarray, limit : float, from_end : bool) -> int:
     '''
-    Crops the scanned image with a thickness thick border.
+    Index of the first (or last) value of the projection above the limit. Like a search loop running through
+    the projection, the other end is returned if no value is above the limit.
+    '''
+    indices = np.flatnonzero(projection > limit)
+    if len(indices) == 0:
+        return 0 if from_end else len(projection) - 1
+    return int(indices[-1] if from_end else indices[0])
+
+
+def find_crop_bounds(binary_image : cv2.typing.MatLike, thickness : int) -> tuple[int, int, int, int]:
+    '''
+    Finds the borders of the fabric by looking at the mean grey value in rows/columns.
 
     Parameters:
-        image: image from the scanner
-        thickness: thickness of black edge
+        binary_image: grey image with black background
+        thickness: thickness of black edge kept around the fabric
 
     Returns:
-        output: cropped image
+        top, bottom, left, right: borders of the fabric
     '''
-    #scaling factor to scale image to work on down for speed up.
-    scale_factor = 20
-    thickness = thickness//scale_factor    
-    image = delete_white_bottom(image)
-    #scale image down for speed up
-    copy_image = cv2.resize(image, (image.shape[1]//scale_factor, image.shape[0]//scale_factor), interpolation=cv2.INTER_AREA) 
-    #convert grey background to black
-    copy_image = replace_grey_with_black_hsv(copy_image, lower_grey = np.array([94, 4, 160]), upper_grey = np.array([129, 50, 205])) 
-    copy_image = cv2.cvtColor(copy_image, cv2.COLOR_BGR2GRAY) #convert to black white
-    height = copy_image.shape[0]
-    width = copy_image.shape[1]
-    #search edges by looking at the mean grey value in rows/columns.
+    height = binary_image.shape[0]
+    width = binary_image.shape[1]
+    #the row sums are divided by the height and the column sums by the width
+    row_means = binary_image.sum(axis=1, dtype=np.int64)/height
+    col_means = binary_image.sum(axis=0, dtype=np.int64)/width
     #top border
     top = 0
-    for i in range(0, height):
-        if sum(copy_image[i,:])/height > 15:
-            break
+    i = _border_index(row_means, 15, from_end=False)
     if i > thickness:
         top = i - thickness
     #bottom border
     bottom = height
-    for i in reversed(range(0, height)):
-        if sum(copy_image[i,:])/height > 15:
-            break
+    i = _border_index(row_means, 15, from_end=True)
     if height - i > thickness:
         bottom = i + thickness
     #left border
     left = 0
-    for j in range(0, width):
-        if sum(copy_image[:,j])/width > 15:
-            break
+    j = _border_index(col_means, 15, from_end=False)
     if j > thickness:
         left = j - thickness
     #right border
     right = width
-    for j in reversed(range(0, width)):
-        if sum(copy_image[:,j])/width > 15:
-            break
+    j = _border_index(col_means, 15, from_end=True)
     if width - j > thickness:
         right = j + thickness
+    return top, bottom, left, right
+
+
+def crop_rectangle(image, thickness : int = 100, rgb : bool = False) -> tuple[int, int, int, int]:
+    '''
+    Finds the crop of image_crop on a downscaled copy of the scanned image.
+
+    Parameters:
+        image: image from the scanner
+        thickness: thickness of black edge
+        rgb: the image is in RGB instead of BGR order
+
+    Returns:
+        top, bottom, left, right: the crop in the scanned image
+    '''
+    #scaling factor to scale image to work on down for speed up.
+    scale_factor = 20
+    thickness = thickness//scale_factor    
+    height = _content_height(image, rgb)
+    image = image[:height]
+    #scale image down for speed up
+    copy_image = cv2.resize(image, (image.shape[1]//scale_factor, image.shape[0]//scale_factor), interpolation=cv2.INTER_AREA) 
+    if rgb:
+        copy_image = cv2.cvtColor(copy_image, cv2.COLOR_RGB2BGR)
+    #convert grey background to black
+    copy_image = replace_grey_with_black_hsv(copy_image, lower_grey = np.array([94, 4, 160]), upper_grey = np.array([129, 50, 205])) 
+    copy_image = cv2.cvtColor(copy_image, cv2.COLOR_BGR2GRAY) #convert to black white
+    top, bottom, left, right = find_crop_bounds(copy_image, thickness)
     #rescale the boundaries for the original image
-    return image[top*scale_factor:bottom*scale_factor, left*scale_factor:right*scale_factor]
+    return (top*scale_factor, min(bottom*scale_factor, height),
+            left*scale_factor, min(right*scale_factor, image.shape[1]))
+
+def image_crop(image, thickness : int = 100) -> cv2.typing.MatLike:
+    '''
+    Crops the scanned image with a thickness thick border.
+
+    Parameters:
+        image: image from the scanner
+        thickness: thickness of black edge
+
+    Returns:
+        output: cropped image, a view of the scanned image
+    '''
+    top, bottom, left, right = crop_rectangle(image, thickness)
+    return image[top:bottom, left:right]
+
+def crop_scan(scan_rgb, thickness : int = 100) -> cv2.typing.MatLike:
+    '''
+    Crops a scan in RGB order like image_crop(convert_to_opencv(scan_rgb)), but only the crop is converted to BGR.
+    The scan is only read, so it may be a shared frame which is released afterwards.
+
+    Parameters:
+        scan_rgb: image from the scanner in RGB order, e.g. np.asarray of the PIL image
+        thickness: thickness of black edge
+
+    Returns:
+        output: cropped image in BGR order
+    '''
+    top, bottom, left, right = crop_rectangle(scan_rgb, thickness, rgb=True)
+    return cv2.cvtColor(scan_rgb[top:bottom, left:right], cv2.COLOR_RGB2BGR)
 
 def replace_grey_with_black_hsv(image : cv2.typing.MatLike, 
                                 lower_grey : np.array = np.array([95, 5, 100]), 
                                 upper_grey : np.array = np.array([125, 47, 203],),
-                                morph_step = False) -> cv2.typing.MatLike:
+                                morph_step = False,
+                                out : typing.Optional[np.ndarray] = None,
+                                return_mask = False) -> cv2.typing.MatLike | tuple[cv2.typing.MatLike, cv2.typing.MatLike]:
     '''
     convert grey into black by using hsv color range. 
 
@@ -92,25 +165,102 @@ def replace_grey_with_black_hsv(image : cv2.typing.MatLike,
         lower_grey: lower bound of hsv color range
         upper_grey: upper bound of hsv color range
         morph_step: can help to denoise the black
+        out: uint8 buffer of the image shape for the output, may be the image itself to work in place
+        return_mask: return the background mask as well
 
     Returns:
         output: image with black instead of grey
+        grey_mask: only if return_mask, 255 where the background was replaced and 0 elsewhere
     '''
-    copy_image = copy.copy(image)
     #BGR2HSV
-    hsv_image = cv2.cvtColor(copy_image, cv2.COLOR_BGR2HSV)
+    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
     # Create a mask that isolates the grey background and erode + delate after
     grey_mask = cv2.inRange(hsv_image, lower_grey, upper_grey)
+    del hsv_image
     #th, grey_mask = cv2.threshold(grey_mask, 255/2,255.0,cv2.THRESH_BINARY)
     if morph_step:
         grey_mask = morph(grey_mask, 0, 1)
-    # Create a 3-channel version of the background mask
-    background_mask_3channel = cv2.cvtColor(grey_mask, cv2.COLOR_GRAY2BGR)
-    # Change the background color to black where the mask is true
-    output = np.where(background_mask_3channel != 0, [0, 0, 0], copy_image)
-    output = output.astype(np.uint8)
+    output = _black_out(image, grey_mask, out)
+    if return_mask:
+        return output, grey_mask
     return output
 
+def _black_out(image : cv2.typing.MatLike, mask : cv2.typing.MatLike, out : typing.Optional[np.ndarray]):
+    if out is None:
+        out = image.copy()
+    elif out is not image:
+        np.copyto(out, image)
+    # Change the background color to black where the mask is true, in place and without leaving uint8
+    return cv2.subtract(out, out, dst=out, mask=mask)
+
+def remove_background(image : cv2.typing.MatLike,
+                      artifacts : typing.Iterable[str],
+                      outputs : typing.Optional[dict[str, np.ndarray]] = None,
+                      band_height : typing.Optional[int] = None) -> dict[str, cv2.typing.MatLike]:
+    '''
+    Computes the requested artifacts of a sheet with a single hsv conversion, so the stages do not repeat
+    replace_grey_with_black_hsv with the default grey range on the same sheet.
+
+    Parameters:
+        image: the cropped sheet
+        artifacts: names of the artifacts, IMAGE, BLACKED_OUT, BLACKED_OUT_RAW and/or BACKGROUND_MASK
+        outputs: optional buffers of the artifacts by name, e.g. shared memory frames
+        band_height: if given, the sheet is processed in bands of this many rows, so the intermediate images
+            (hsv image and masks) only take the memory of a band. The results are identical.
+
+    Returns:
+        results: the artifacts by name
+    '''
+    artifacts = set(artifacts)
+    outputs = dict(outputs or {})
+    results = {}
+    if IMAGE in artifacts:
+        results[IMAGE] = image
+        if IMAGE in outputs:
+            np.copyto(outputs[IMAGE], image)
+            results[IMAGE] = outputs[IMAGE]
+    artifacts.discard(IMAGE)
+    if not artifacts:
+        return results
+
+    if band_height is None or band_height >= image.shape[0]:
+        results.update(_remove_background_band(image, artifacts, outputs))
+        return results
+
+    for artifact in artifacts:
+        if artifact not in outputs:
+            shape = image.shape[:2] if artifact == BACKGROUND_MASK else image.shape
+            outputs[artifact] = np.empty(shape, np.uint8)
+    for rows, padded_rows, inner in row_bands(image.shape[0], band_height, _MORPH_OVERLAP):
+        band_outputs = {artifact: outputs[artifact][rows] for artifact in artifacts}
+        _remove_background_band(image[padded_rows], artifacts, band_outputs, inner)
+    results.update({artifact: outputs[artifact] for artifact in artifacts})
+    return results
+
+def _remove_background_band(image : cv2.typing.MatLike,
+                            artifacts : set[str],
+                            outputs : dict[str, np.ndarray],
+                            inner : slice = slice(None)) -> dict[str, cv2.typing.MatLike]:
+    '''
+    remove_background of the rows inner of the image, the other rows are only read for the morph step.
+    '''
+    grey_mask = cv2.inRange(cv2.cvtColor(image, cv2.COLOR_BGR2HSV), np.array([95, 5, 100]), np.array([125, 47, 203]))
+    image = image[inner]
+    results = {}
+    if BLACKED_OUT_RAW in artifacts:
+        results[BLACKED_OUT_RAW] = _black_out(image, grey_mask[inner], outputs.get(BLACKED_OUT_RAW))
+    if artifacts & {BLACKED_OUT, BACKGROUND_MASK}:
+        grey_mask = morph(grey_mask, 0, 1)
+    grey_mask = grey_mask[inner]
+    if BLACKED_OUT in artifacts:
+        results[BLACKED_OUT] = _black_out(image, grey_mask, outputs.get(BLACKED_OUT))
+    if BACKGROUND_MASK in artifacts:
+        if BACKGROUND_MASK in outputs:
+            np.copyto(outputs[BACKGROUND_MASK], grey_mask)
+            grey_mask = outputs[BACKGROUND_MASK]
+        results[BACKGROUND_MASK] = grey_mask
+    return results
+
 def morph(im_gray, num_erode = 1, num_dilate = 1):
     """
     
@@ -162,3 +312,20 @@ def preprocessing_resnet50v2(image):
     normalized -= 1.0
     return normalized
 
+# preprocessing_resnet50v2 of every uint8 value as float32, the input type of the model
+_RESNET50V2_LUT = preprocessing_resnet50v2(np.arange(256, dtype=np.float64)).astype(np.float32)
+
+def preprocessing_resnet50v2_uint8(image : np.ndarray, out : typing.Optional[np.ndarray] = None) -> np.ndarray:
+    '''
+    preprocessing_resnet50v2(image).astype(np.float32) of an uint8 image by a lookup table, without the float64
+    intermediate image.
+
+    Parameters:
+        image: uint8 image or batch of images
+        out: float32 buffer of the image shape for the output
+
+    Returns:
+        output: the normalized image in [-1, 1]
+    '''
+    return np.take(_RESNET50V2_LUT, image, out=out, mode='clip')
+
@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+
+class ImagePyramid(object):
+    '''
+    Downscaled versions of a sheet, shared by all consumers of the sheet. Level n is the image scaled by 1/2**n,
+    every level is built lazily with INTER_AREA from the level before. So the full resolution image is resampled
+    only once, no matter how many consumers need a smaller version of it.
+    '''
+    def __init__(self, image: cv2.typing.MatLike) -> None:
+        self._levels: list[np.ndarray] = [image]
+
+    @property
+    def image(self) -> cv2.typing.MatLike:
+        ''' The full resolution image. '''
+        return self._levels[0]
+
+    def level(self, n: int) -> cv2.typing.MatLike:
+        '''
+        The image scaled by 1/2**n, built on first access. Do not draw into it, it is shared.
+
+        Parameters:
+            n: the level, 0 is the full resolution image.
+        '''
+        while len(self._levels) <= n:
+            previous = self._levels[-1]
+            height, width = previous.shape[:2]
+            if height < 2 or width < 2:
+                raise ValueError(f"Level {n} of an image of {self.image.shape[1]}x{self.image.shape[0]} px is empty!")
+            self._levels.append(cv2.resize(previous, (width // 2, height // 2), interpolation=cv2.INTER_AREA))
+        return self._levels[n]
+
+    def level_for_scale(self, scale: float) -> int:
+        ''' The smallest level which is not smaller than the image scaled by scale. '''
+        if not 0 < scale <= 1:
+            raise ValueError(f"Scale {scale} is not in (0, 1]!")
+        return int(np.floor(-np.log2(scale) + 1e-9))
+
+    def level_for_size(self, width: int, height: int, tolerance: float = 0.1) -> int:
+        '''
+        The smallest level which is at least as large as width x height, a level up to tolerance smaller in one
+        direction is preferred over a level twice as large.
+
+        Parameters:
+            width: width the consumer scales the image to.
+            height: height the consumer scales the image to.
+            tolerance: fraction a level may be smaller than the size.
+        '''
+        image_height, image_width = self.image.shape[:2]
+        scale = max(width / image_width, height / image_height) * (1 - tolerance)
+        return self.level_for_scale(min(scale, 1))
+
+    def scaled(self, scale: float) -> cv2.typing.MatLike:
+        '''
+        The image scaled by scale, taken from the closest level. Do not draw into it, it may be shared.
+
+        Parameters:
+            scale: scale factor in (0, 1], powers of 1/2 are taken from the pyramid without resampling.
+        '''
+        n = self.level_for_scale(scale)
+        level = self.level(n)
+        remaining = scale * 2 ** n
+        if np.isclose(remaining, 1):
+            return level
+        size = (round(self.image.shape[1] * scale), round(self.image.shape[0] * scale))
+        return cv2.resize(level, size, interpolation=cv2.INTER_AREA)
@@ -0,0 +1,46 @@
+from typing import Any
+
+from data_transfer.dtos import DistanceMeasurement, EvalBox
+
+RECONSTRUCTION_ERROR_THRESHOLD = 0.01
+
+
+def get_qc_rows(measure_results: list[DistanceMeasurement],
+                material_error_results: list[EvalBox],
+                reconstruction_error: float) -> tuple[bool, list[dict[str, Any]]]:
+    '''
+    Combine the results of all checks of a sheet into the rows shown in the HMI and stored in the database.
+
+    Parameters:
+        measure_results: results of the measurement evaluation.
+        material_error_results: detected material errors.
+        reconstruction_error: reconstruction error of the anomaly detection autoencoder.
+
+    Returns:
+        qc_result: True if the sheet passed every check.
+        rows: one row per check with the actual and the target value.
+    '''
+    rows = [{"check": "material_errors",
+             "result": len(material_error_results) == 0,
+             "actual": len(material_error_results),
+             "target": 0}]
+
+    anomaly_result = bool(reconstruction_error <= RECONSTRUCTION_ERROR_THRESHOLD)
+    rows.append({'check': 'reconstruction_error',
+                 'result': anomaly_result,
+                 'actual': float(reconstruction_error),
+                 'target': f"<= {RECONSTRUCTION_ERROR_THRESHOLD}"})
+
+    qc_result = anomaly_result and len(material_error_results) == 0
+    for measurement in measure_results:
+        variance = measurement.variance
+        rows.append({
+            'check': measurement.name,
+            'result': measurement.is_ok,
+            'actual': measurement.distance,
+            'target': f'{variance[0]} - {variance[1]}'
+        })
+        if not measurement.is_ok:
+            qc_result = False
+
+    return qc_result, rows
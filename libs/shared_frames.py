@@ -0,0 +1,124 @@
+import math
+from multiprocessing import Array, Semaphore
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from data_transfer.dtos import FrameDescriptor
+
+
+def frame_bytes_for_dpi(dpi: int, width_inch: float = 8.5, height_inch: float = 14.0, channels: int = 3) -> int:
+    '''
+    Size in bytes of the largest uint8 frame the scanner can deliver at the given dpi.
+
+    Parameters:
+        dpi: scanner resolution.
+        width_inch: maximum scan width.
+        height_inch: maximum scan length.
+        channels: number of color channels.
+
+    Returns:
+        size: number of bytes.
+    '''
+    return math.ceil(width_inch * dpi) * math.ceil(height_inch * dpi) * channels
+
+
+class FramePool(object):
+    '''
+    A ring of shared memory slots used to pass full resolution images between processes without pickling them.
+
+    Every slot carries a reference count. The producer acquires a slot with the number of consumers as
+    reference count and sends only the FrameDescriptor; every consumer maps the slot zero-copy with view()
+    and calls release() when done. A slot is reused as soon as its reference count drops to zero.
+    The pool has to be created before the worker processes and handed to them as process argument.
+    '''
+    def __init__(self, num_slots: int, slot_size: int) -> None:
+        '''
+        Parameters:
+            num_slots: number of frames that can be in use at the same time.
+            slot_size: size of every slot in bytes.
+        '''
+        self.slot_size = slot_size
+        self._slots = [SharedMemory(create=True, size=slot_size) for _ in range(num_slots)]
+        self._refs = Array('i', num_slots)
+        self._free = Semaphore(num_slots)
+        self._cursor = 0
+
+    def acquire(self, shape: tuple[int, ...], dtype=np.uint8, refs: int = 1, timeout=None) -> FrameDescriptor:
+        '''
+        Reserve a free slot for a frame. Blocks until a slot is free.
+
+        Parameters:
+            shape: shape of the frame.
+            dtype: data type of the frame.
+            refs: number of consumers which have to release the frame.
+            timeout: maximum time to wait for a free slot in seconds, None waits forever.
+
+        Returns:
+            descriptor: handle of the reserved slot.
+        '''
+        descriptor = FrameDescriptor(-1, tuple(shape), np.dtype(dtype).str)
+        if descriptor.get_nbytes() > self.slot_size:
+            raise ValueError(f"Frame of shape {shape} does not fit into a frame slot of {self.slot_size} bytes!")
+        if refs < 1:
+            raise ValueError("A frame needs at least one reference!")
+        if not self._free.acquire(timeout=timeout):
+            raise TimeoutError("No free frame slot available!")
+
+        with self._refs.get_lock():
+            for offset in range(len(self._slots)):
+                slot = (self._cursor + offset) % len(self._slots)
+                if self._refs[slot] == 0:
+                    self._refs[slot] = refs
+                    self._cursor = slot + 1
+                    descriptor.slot = slot
+                    return descriptor
+        raise RuntimeError("Frame pool is inconsistent, no slot with zero references found!")
+
+    def put(self, image: np.ndarray, refs: int = 1, timeout=None) -> FrameDescriptor:
+        '''
+        Copy an image into a free slot.
+
+        Parameters:
+            image: the image to share.
+            refs: number of consumers which have to release the frame.
+            timeout: maximum time to wait for a free slot in seconds, None waits forever.
+
+        Returns:
+            descriptor: handle of the slot holding the image.
+        '''
+        descriptor = self.acquire(image.shape, image.dtype, refs, timeout)
+        np.copyto(self.view(descriptor), image)
+        return descriptor
+
+    def view(self, descriptor: FrameDescriptor) -> np.ndarray:
+        '''
+        Map a frame as numpy array without copying it. The array is only valid until the frame is released.
+        '''
+        return np.ndarray(descriptor.shape, dtype=descriptor.dtype, buffer=self._slots[descriptor.slot].buf)
+
+    def retain(self, descriptor: FrameDescriptor, count: int = 1):
+        ''' Add consumers to a frame which is already in use. '''
+        with self._refs.get_lock():
+            if self._refs[descriptor.slot] <= 0:
+                raise RuntimeError(f"Frame slot {descriptor.slot} is not in use!")
+            self._refs[descriptor.slot] += count
+
+    def release(self, descriptor: FrameDescriptor):
+        ''' Drop one reference of a frame, the slot becomes free when no reference is left. '''
+        with self._refs.get_lock():
+            if self._refs[descriptor.slot] <= 0:
+                raise RuntimeError(f"Frame slot {descriptor.slot} released too often!")
+            self._refs[descriptor.slot] -= 1
+            freed = self._refs[descriptor.slot] == 0
+        if freed:
+            self._free.release()
+
+    def unlink(self):
+        ''' Free the shared memory. Must only be called once by the process which created the pool. '''
+        for slot in self._slots:
+            slot.unlink()
+            try:
+                slot.close()
+            except BufferError:  # numpy views on the slot are still alive, memory is freed with the process
+                pass
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from pathlib import Path
+from typing import Any, Callable
+
+import numpy as np
+
+
+def hash_array(array: np.ndarray) -> str:
+    ''' Content hash of an image, independent of the file format it was read from. '''
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha256(f"{array.shape}{array.dtype}".encode())
+    digest.update(memoryview(array).cast("B"))
+    return digest.hexdigest()
+
+
+_file_hashes: dict[tuple[str, int, int], str] = {}
+
+
+def hash_file(path: str) -> str:
+    ''' Content hash of a model or configuration file, only recomputed if the file was modified. '''
+    stat = os.stat(path)
+    file_id = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if file_id not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        _file_hashes[file_id] = digest.hexdigest()
+    return _file_hashes[file_id]
+
+
+def hash_config(*parts: Any) -> str:
+    ''' Hash of json serializable parameters, e.g. file hashes and settings of a stage. '''
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def crop_config_id(thickness: int = 100) -> str:
+    return hash_config("image_crop", thickness)
+
+
+def measurement_config_id(measurement_evaluator, dpi: int) -> str:
+    ''' The measurement depends on its configuration, the template files it references and the dpi. '''
+    files = []
+    for template_matching_config in measurement_evaluator.circleMeasurementEvaluator.template_matching_configs:
+        for path in (template_matching_config.path_template, template_matching_config.path_weights):
+            if path is not None:
+                files.append(hash_file(path))
+    return hash_config("measurement", measurement_evaluator.config, files, dpi)
+
+
+def material_error_config_id(material_error_detector, precision: float, shard_index: int = 0,
+                             shard_count: int = 1) -> str:
+    # already imported with the detector
+    from err_detection.material_evaluation import DUPLICATE_TILE_FRACTION
+
+    return hash_config("material_error", hash_file(material_error_detector.path_to_model),
+                       material_error_detector.size, material_error_detector.r_scale, precision,
+                       shard_index, shard_count, material_error_detector.min_fabric_fraction,
+                       material_error_detector.cascade_config.threshold, material_error_detector.cascade_config.tile_size,
+                       DUPLICATE_TILE_FRACTION)
+
+
+def anomaly_config_id(anomaly_detector, heatmap_scale: float | None = None, with_reconstruction: bool = False) -> str:
+    '''
+    The reconstruction error depends on the model and the tiling, the AnomalyResult of the anomaly worker (with
+    heatmap_scale) also on the settings of the error map and whether the reconstruction is kept.
+    '''
+    parts = ["anomaly", hash_file(anomaly_detector.model_path), anomaly_detector.INPUT_SIZE,
+             anomaly_detector.tiling.toJSON()]
+    if heatmap_scale is not None:
+        from Autoencoder.anomaly_map import HEATMAP_MAX_ERROR, MIN_REGION_PIXELS, REGION_ERROR_THRESHOLD
+        parts += [heatmap_scale, with_reconstruction, HEATMAP_MAX_ERROR, REGION_ERROR_THRESHOLD, MIN_REGION_PIXELS]
+    return hash_config(*parts)
+
+
+class StageCache(object):
+    '''
+    On-disk cache of stage results, keyed by the input, the stage and the model and configuration of the stage.
+    If only one model changes, only the results of its stage are recomputed on a re-run.
+
+    The least recently used entries are evicted once the cache is larger than max_bytes. The entries are
+    written atomically, so several processes can share the directory.
+    '''
+    def __init__(self, directory: str = ".stage_cache", max_bytes: int = 2 * 1024 ** 3) -> None:
+        '''
+        Parameters:
+            directory: directory of the cache entries, created if missing.
+            max_bytes: maximum size of all entries.
+        '''
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(input_id: str, stage: str, config_id: str) -> str:
+        '''
+        Key of a stage result, also used as input id of the stages processing this result.
+
+        Parameters:
+            input_id: hash of the input image or key of the stage result used as input.
+            stage: name of the stage.
+            config_id: hash of the model and configuration of the stage.
+        '''
+        return hash_config(input_id, stage, config_id)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.pkl"
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        '''
+        Returns:
+            found: if the key is cached.
+            value: the cached value or None.
+        '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)  # last access time for the LRU eviction
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        return True, value
+
+    def put(self, key: str, value: Any):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pkl"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def compute(self, key: str, func: Callable, *args, **kwargs) -> Any:
+        ''' Return the cached result of the key or compute and cache it with func(*args, **kwargs). '''
+        found, value = self.get(key)
+        if found:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = func(*args, **kwargs)
+        self.put(key, value)
+        return value
+
+
+def cached(stage_cache: StageCache | None, input_id: str | None, stage: str, config_id: Callable[[], str],
+           func: Callable, *args, **kwargs) -> Any:
+    '''
+    Run a stage, or take its result from the cache if the input was processed before by the same model and
+    configuration.
+
+    Parameters:
+        stage_cache: the cache, the stage is always run if None.
+        input_id: hash of the input image or key of the stage result used as input, the stage is always run if None.
+        stage: name of the stage.
+        config_id: returns the hash of the model and configuration of the stage, only called if the cache is used.
+        func: the stage, called with the remaining arguments.
+    '''
+    if stage_cache is None or input_id is None:
+        return func(*args, **kwargs)
+    return stage_cache.compute(StageCache.key(input_id, stage, config_id()), func, *args, **kwargs)
@@ -0,0 +1,46 @@
+from typing import Iterator
+
+import numpy as np
+from PIL import Image
+
+
+def row_bands(height: int, band_height: int, overlap: int = 0) -> Iterator[tuple[slice, slice, slice]]:
+    '''
+    Splits the rows of an image into horizontal bands, so a sheet can be processed band by band with a peak memory
+    depending on the band height instead of the sheet size.
+
+    Parameters:
+        height: number of rows of the image.
+        band_height: number of rows of a band.
+        overlap: rows read beyond the band on both sides, e.g. the reach of a morphology kernel.
+
+    Returns:
+        rows: rows of the band in the image.
+        padded_rows: rows of the band and its overlap in the image, the rows to read.
+        inner: rows of the band within the padded rows.
+    '''
+    if band_height < 1:
+        raise ValueError(f"Band height {band_height} is not positive!")
+    for start in range(0, height, band_height):
+        end = min(start + band_height, height)
+        padded_start = max(start - overlap, 0)
+        padded_end = min(end + overlap, height)
+        yield slice(start, end), slice(padded_start, padded_end), slice(start - padded_start, end - padded_start)
+
+
+def pil_shape(pil_img: Image.Image) -> tuple[int, ...]:
+    ''' Shape of the array of a PIL image, without converting the whole image. '''
+    first_row = np.asarray(pil_img.crop((0, 0, pil_img.width, 1)))
+    return (pil_img.height,) + first_row.shape[1:]
+
+
+def pil_bands(pil_img: Image.Image, band_height: int) -> Iterator[tuple[slice, np.ndarray]]:
+    '''
+    The PIL image as arrays of band_height rows, np.asarray on the whole image would copy all of it at once.
+
+    Returns:
+        rows: rows of the band in the image.
+        band: the pixels of the band.
+    '''
+    for rows, _, _ in row_bands(pil_img.height, band_height):
+        yield rows, np.asarray(pil_img.crop((0, rows.start, pil_img.width, rows.stop)))
@@ -0,0 +1,119 @@
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def new_trace_id() -> str:
+    ''' Unique id of a sheet, used to relate the spans of all processes to the sheet. '''
+    return uuid.uuid4().hex
+
+
+class Span(object):
+    '''
+    Duration of one processing stage of a sheet.
+    '''
+    def __init__(self, trace_id: str | None, stage: str, start: float, duration: float) -> None:
+        '''
+        Parameters:
+            trace_id: the sheet the stage belongs to.
+            stage: name of the stage.
+            start: unix timestamp of the start of the stage.
+            duration: duration in seconds.
+        '''
+        self.trace_id = trace_id
+        self.stage = stage
+        self.start = start
+        self.duration = duration
+
+
+class Tracer(object):
+    '''
+    Records the spans of a process. Worker processes send their spans back together with their results,
+    so all spans of a sheet end up in the main process.
+    '''
+    def __init__(self) -> None:
+        self._spans: list[Span] = []
+
+    @contextmanager
+    def span(self, trace_id: str | None, stage: str):
+        ''' Time the enclosed block as stage of the given sheet. '''
+        start = time.time()
+        before = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - before
+            self._spans.append(Span(trace_id, stage, start, duration))
+            print(f"{stage} took {duration:.3f} s!")
+
+    def pop_spans(self, trace_id: str | None = None) -> list[Span]:
+        '''
+        Remove and return the recorded spans.
+
+        Parameters:
+            trace_id: only the spans of this sheet, all spans if None.
+        '''
+        spans = [span for span in self._spans if trace_id is None or span.trace_id == trace_id]
+        self._spans = [span for span in self._spans if trace_id is not None and span.trace_id != trace_id]
+        return spans
+
+
+class LatencyStatistics(object):
+    '''
+    Rolling latency percentiles per stage over the last spans.
+    '''
+    def __init__(self, window: int = 1000) -> None:
+        '''
+        Parameters:
+            window: number of spans per stage the percentiles are computed of.
+        '''
+        self._durations: dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def add(self, stage: str, duration: float):
+        self._durations[stage].append(duration)
+
+    def add_spans(self, spans: list[Span]):
+        for span in spans:
+            self.add(span.stage, span.duration)
+
+    def get_rows(self) -> list[dict]:
+        '''
+        Returns:
+            rows: count and p50, p95, p99 in milliseconds for every stage.
+        '''
+        rows = []
+        for stage in sorted(self._durations):
+            durations = np.array(self._durations[stage]) * 1000
+            p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+            rows.append({"stage": stage, "count": len(durations), "p50": p50, "p95": p95, "p99": p99})
+        return rows
+
+
+class CountStatistics(object):
+    '''
+    Rolling mean of counters per sheet over the last sheets, e.g. the tiles the material error detection skipped.
+    '''
+    def __init__(self, window: int = 1000) -> None:
+        '''
+        Parameters:
+            window: number of sheets per counter the mean is computed of.
+        '''
+        self._counts: dict[str, deque] = defaultdict(lambda: deque(maxlen=window))
+
+    def add(self, name: str, count: int):
+        self._counts[name].append(count)
+
+    def add_counts(self, counts: dict[str, int]):
+        for name, count in counts.items():
+            self.add(name, count)
+
+    def get_rows(self) -> list[dict]:
+        '''
+        Returns:
+            rows: number of sheets, the count of the last sheet and the mean per sheet for every counter.
+        '''
+        return [{"name": name, "sheets": len(counts), "last": counts[-1], "mean": float(np.mean(counts))}
+                for name, counts in sorted(self._counts.items())]
@@ -3,22 +3,31 @@
 import argparse
 import asyncio
 import random
-from datetime import datetime
+import time
+from collections import Counter
 from multiprocessing import Pipe, Process
 
 import cv2
-from nicegui import ui
+import numpy as np
+from nicegui import app, ui
 
-from data_transfer.dtos import EvalBox
+from data_transfer.dtos import (AnomalyResult, EvalBox, FrameDescriptor, ModelReloaded, ReloadModel, SheetJob,
+                                SwapModel, WorkerReady, WorkerResult)
 from hmi.hmi_main import HMI
 from libs.database import QualityCheckDB
 from libs.dummy import get_random_dummy_image
+from libs.async_connection import AsyncConnection
+from libs.boxes import merge_boxes
 from libs.hardware import send_command
-from libs.image_format_conversion import convert_to_opencv
-from libs.preprocessing import image_crop
-from processes import measurement_process, anomaly_detect_process, material_error_process, scanner_process
-
-RECONSTRUCTION_ERROR_THRESHOLD = 0.01
+from libs.model_registry import ModelRegistry
+from libs.preprocessing import BACKGROUND_MASK, crop_scan, remove_background
+from libs.pyramid import ImagePyramid
+from libs.quality_check import get_qc_rows
+from libs.shared_frames import FramePool, frame_bytes_for_dpi
+from libs.stage_cache import StageCache, crop_config_id, hash_array
+from libs.tracing import CountStatistics, LatencyStatistics, Span, Tracer, new_trace_id
+from processes import (ANOMALY_MODEL, MATERIAL_ERROR_MODEL, STAGE_ARTIFACTS, measurement_process, anomaly_detect_process,
+                       material_error_process, registry_model_paths, scanner_process)
 
 async def _show_error(msg: str):
     ui.notify(msg, type="negative")
@@ -26,83 +35,267 @@ async def _show_error(msg: str):
     await asyncio.sleep(1)
     send_command("ready")
 
-async def scan_loop():
-    while True:
-        while not scan_parent_conn.poll():  # wait for results
-            await asyncio.sleep(0.1)
-
-        result = scan_parent_conn.recv()
-        if result[0]:
-            try:
-                await process_image(result[1])
-            except Exception as ex:
-                await _show_error(str(ex))
-        else:
-            await _show_error(result[1])
-
-        await asyncio.sleep(0.1)
-
-
-async def process_image(img_pil):
+async def _finish_notification(notification: ui.notification):
+    notification.message = "Finished processing image!"
+    notification.spinner = False
+    await asyncio.sleep(1)
+    notification.dismiss()
+
+
+class Sheet(object):
+    '''
+    A sheet in the processing pipeline, from dispatching it to the workers until its results are committed.
+    '''
+    def __init__(self, trace_id: str, image_cropped: cv2.typing.MatLike, notification: ui.notification) -> None:
+        self.trace_id = trace_id
+        # the HMI and the database take their downscaled images from the pyramid, built once when first needed
+        self.pyramid = ImagePyramid(image_cropped)
+        self.notification = notification
+        self.start = time.time()
+        self.before = time.perf_counter()
+        self.spans: list[Span] = []
+
+
+async def wait_for_workers():
+    """ Waits until every worker has loaded and warmed up its model, only then sheets are accepted. """
+    notification = ui.notification(message="Loading models...", spinner=True, timeout=None)
+    try:
+        worker_readies: list[WorkerReady] = await asyncio.gather(*[conn.recv() for conn in worker_conns])
+    except Exception as ex:
+        notification.dismiss()
+        ui.notify(f"Worker start failed: {ex}", type="negative")
+        if not args.dummy:
+            send_command("error")
+        return
+
+    # startup and warm-up times of this run are stored and shown like the stages of a sheet
+    trace_id = new_trace_id()
+    spans = [span for worker_ready in worker_readies for span in worker_ready.spans]
+    for span in spans:
+        span.trace_id = trace_id
+    spans.append(Span(trace_id, "startup", startup_time, time.time() - startup_time))
+    qc_db.insert_stage_timings(None, spans)
+    latency_statistics.add_spans(spans)
+    await hmi.update_performance(latency_statistics.get_rows())
+    await hmi.update_counts(count_statistics.get_rows())
+    await hmi.update_models(model_rows())
+
+    notification.dismiss()
+    workers_ready.set()
     if not args.dummy:
-        send_command("processing")
-
-    processing_done = False
+        send_command("ready")
 
-    async def _process_image_ui(notification):
-        while not processing_done:
-            await asyncio.sleep(0.1)
 
-        notification.message = "Finished processing image!"
-        notification.spinner = False
-        await asyncio.sleep(1)
+def model_rows() -> list[dict]:
+    ''' The models of the workers with the version in use and the versions of the model registry. '''
+    return [{"model": name,
+             "version": active_versions.get(name) or "-",
+             "versions": ", ".join(version.version for version in model_registry.versions(name))}
+            for name in model_controls]
+
+
+async def reload_model(name: str, version: str | None = None):
+    '''
+    Loads another version of a model, None is the active version of the model registry. The workers load and warm
+    up the new model in the background while they keep processing sheets with the old one. Once every worker of the
+    model has loaded it, the swap is sent behind the sheets already dispatched, so every shard of a sheet uses the
+    same version and no sheet waits for the loading.
+    '''
+    async with reload_lock:
+        notification = ui.notification(message=f"Loading {name} model...", spinner=True, timeout=None)
+        for control_conn in model_controls[name]:
+            control_conn.send(ReloadModel(name, version))
+        replies: list[ModelReloaded] = await asyncio.gather(*[conn.recv() for conn in model_controls[name]])
         notification.dismiss()
 
-    # handle ui notification as background task
-    # timeout required on rare occasions when something goes wrong somewhere...
-    asyncio.ensure_future(_process_image_ui(ui.notification(message="Processing image...", spinner=True, timeout=30)))
-
-    before = datetime.now()
-    img = convert_to_opencv(img_pil)  # 1 sec
-    print(f"Converting to OpenCV took {datetime.now() - before}!")
+        errors = [f"{reply.worker}: {reply.error}" for reply in replies if reply.error is not None]
+        versions = {reply.version for reply in replies}
+        if errors or len(versions) != 1:
+            # the workers which loaded the model discard it again
+            for conn in model_conns[name]:
+                conn.send(SwapModel(name, None))
+            ui.notify(f"Loading {name} model failed: {'; '.join(errors) or versions}", type="negative")
+            return
 
-    before = datetime.now()
-    image_cropped = image_crop(img)
-    print(f"Cropping took {datetime.now() - before}!")
+        loaded_version = versions.pop()
+        for conn in model_conns[name]:
+            conn.send(SwapModel(name, loaded_version))
+        model_registry.set_active(name, loaded_version)
+        ui.notify(f"{name} model {loaded_version} is used from the next sheet on", type="positive")
+        await hmi.update_models(model_rows())
 
-    before = datetime.now()
-    hmi.clear_everything()
-    await hmi.update_crop_image(image_cropped)
-    print(f"HMI Crop Image Update took {datetime.now() - before}!")
 
+async def scan_loop():
+    await workers_ready.wait()
+    while True:
+        # backpressure: the scanner only feeds the next sheet if there is room in the pipeline. The microcontroller
+        # only accepts the next sheet after the ok/nok of the previous one, so on the test bench the sheets are not
+        # overlapped, only in dummy mode
+        await in_flight.acquire()
+        scan_conn.send(True)
+
+        while True:
+            success, result, scan_spans = await scan_conn.recv()
+            if success:
+                break
+            await _show_error(result)
+
+        try:
+            await dispatch_image(frame_pool.view(result), scan_spans)
+        except Exception as ex:
+            in_flight.release()
+            await _show_error(str(ex))
+        finally:
+            frame_pool.release(result)
+
+
+def put_artifacts(image_cropped: cv2.typing.MatLike, stages: list[str]) -> dict[str, FrameDescriptor]:
+    """ Computes the artifacts the stages need into shared frames, with one reference per stage using them. """
+    refs = Counter(artifact for stage in stages for artifact in STAGE_ARTIFACTS[stage])
+    frames: dict[str, FrameDescriptor] = {}
+    try:
+        for artifact, count in refs.items():
+            shape = image_cropped.shape[:2] if artifact == BACKGROUND_MASK else image_cropped.shape
+            frames[artifact] = frame_pool.acquire(shape, refs=count)
+        remove_background(image_cropped, frames,
+                          {artifact: frame_pool.view(frame) for artifact, frame in frames.items()},
+                          band_height=args.band_height)
+    except Exception:
+        for artifact, frame in frames.items():
+            for _ in range(refs[artifact]):
+                frame_pool.release(frame)
+        raise
+    return frames
+
+
+async def dispatch_image(img_pil, scan_spans: list[Span] = ()):
+    """ Crops the image and hands it to the workers, the results are collected by the commit loop. """
+    if not args.dummy:
+        send_command("processing")
 
-    before = datetime.now()
+    trace_id = new_trace_id()
+    notification = ui.notification(message="Processing image...", spinner=True, timeout=None)
+
+    try:
+        with tracer.span(trace_id, "crop"):
+            # the crop is found on the RGB scan (no copy of the shared frame) and only the crop is converted to BGR
+            scan = np.asarray(img_pil)
+            # the dummy scans repeat, so their crop and worker results can be taken from the stage cache
+            image_id = None
+            if stage_cache is not None:
+                image_id = StageCache.key(hash_array(scan), "crop_scan", crop_config_id())
+                image_cropped = stage_cache.compute(image_id, crop_scan, scan)
+            else:
+                image_cropped = crop_scan(scan)
+    except Exception:
+        tracer.pop_spans(trace_id)
+        notification.dismiss()
+        raise
+
+    sheet = Sheet(trace_id, image_cropped, notification)
+    for span in scan_spans:
+        span.trace_id = trace_id
+    sheet.spans.extend(scan_spans)
+
+    # the background is removed once for all workers, they only receive handles of the shared frames
+    stage_conns = [("measurement", measure_conn), ("anomaly", anomaly_conn)]
+    # stage_conns.append(("homology", homology_conn))
+    stage_conns.extend(("material_error", material_error_conn) for material_error_conn in material_error_conns)
+    try:
+        with tracer.span(trace_id, "background"):
+            # acquiring the frames blocks until the workers release a slot, which must not stall the event loop
+            sheet_frames = await asyncio.get_running_loop().run_in_executor(
+                None, put_artifacts, image_cropped, [stage for stage, _ in stage_conns])
+    except Exception:
+        tracer.pop_spans(trace_id)
+        notification.dismiss()
+        raise
 
     # parallel processing using processes
-    measure_parent_conn.send(image_cropped)
-    #homology_parent_conn.send(image_cropped)
-    anomaly_parent_conn.send(image_cropped)
-    material_error_parent_conn.send(image_cropped)
-
-    while True:  # wait for results
-        if (measure_parent_conn.poll()
-                #and homology_parent_conn.poll()
-                and anomaly_parent_conn.poll()
-                and material_error_parent_conn.poll()):
-            break
-        await asyncio.sleep(0.1)
+    for stage, conn in stage_conns:
+        conn.send(SheetJob(trace_id, {artifact: sheet_frames[artifact] for artifact in STAGE_ARTIFACTS[stage]},
+                           image_id, with_reconstruction=stage == "anomaly" and args.anomaly_reconstruction))
 
-    print(f"Parallel processing took {datetime.now() - before}!")
+    # workers answer in the order they received the sheets, so the queue keeps the sheets in scan order
+    pending_sheets.put_nowait(sheet)
 
-    measure_results = measure_parent_conn.recv()
-    # homology_results = homology_parent_conn.recv()
-    material_error_results: list[EvalBox] = material_error_parent_conn.recv()
-    reconstructed_image, reconstruction_error = anomaly_parent_conn.recv()
 
-    rows = [{"check": "material_errors",
-             "result": len(material_error_results) == 0,
-             "actual": len(material_error_results),
-             "target": 0}]
+async def commit_loop():
+    while True:
+        sheet = await pending_sheets.get()
+        try:
+            await commit_sheet(sheet)
+        except Exception as ex:
+            tracer.pop_spans(sheet.trace_id)
+            sheet.notification.dismiss()
+            await _show_error(str(ex))
+        finally:
+            in_flight.release()
+
+
+def _scaled_point(point, scale: float) -> tuple[int, int]:
+    return int(point[0] * scale), int(point[1] * scale)
+
+
+def _scaled_thickness(thickness: int, scale: float) -> int:
+    return max(1, round(thickness * scale))
+
+
+def _anomaly_image(preview: cv2.typing.MatLike, anomaly_result: AnomalyResult, scale: float):
+    '''
+    The heatmap of the anomaly detection over the preview, or the reconstruction if it was requested, with the
+    anomaly regions. None if the anomaly detection is inactive.
+    '''
+    size = preview.shape[1::-1]
+    if anomaly_result.reconstruction is not None:
+        # the reconstruction has the size of the model input or of the pyramid level of the tiled inference
+        image = cv2.resize(anomaly_result.reconstruction, size, interpolation=cv2.INTER_AREA)
+    elif anomaly_result.heatmap is not None:
+        heatmap = cv2.applyColorMap(cv2.resize(anomaly_result.heatmap, size), cv2.COLORMAP_JET)
+        image = cv2.addWeighted(preview, 0.6, heatmap, 0.4, 0)
+    else:
+        return None
+    for box in anomaly_result.regions:
+        cv2.rectangle(image, _scaled_point(box.top_left, scale), _scaled_point(box.bottom_right, scale),
+                      color=(0, 0, 255), thickness=_scaled_thickness(10, scale))
+    return image
+
+
+async def commit_sheet(sheet: Sheet):
+    """ Waits for the worker results of the oldest sheet, shows them and stores them. """
+    trace_id = sheet.trace_id
+    # the results are drawn into a copy of the downscaled sheet, which is shown and stored in the database
+    scale = HMI.SCALE_FACTOR
+
+    with tracer.span(trace_id, "hmi_crop_update"):
+        preview = sheet.pyramid.scaled(scale).copy()
+        hmi.clear_everything()
+        await hmi.update_crop_image(preview)
+
+    # every result is handled as soon as it arrives
+    with tracer.span(trace_id, "workers"):
+        worker_results: list[WorkerResult] = await asyncio.gather(
+            measure_conn.recv(),
+            # homology_conn.recv(),
+            anomaly_conn.recv(),
+            *[material_error_conn.recv() for material_error_conn in material_error_conns])
+
+    for worker_result in worker_results:
+        if worker_result.trace_id != trace_id:
+            raise RuntimeError(f"Received result of sheet {worker_result.trace_id} instead of {trace_id}!")
+        sheet.spans.extend(worker_result.spans)
+
+    # the version of every model the sheet was checked with, the shards of a sheet always use the same version
+    model_versions = {ANOMALY_MODEL: worker_results[1].model_version,
+                      MATERIAL_ERROR_MODEL: worker_results[2].model_version}
+    active_versions.update(model_versions)
+
+    measure_results = worker_results[0].value
+    anomaly_result: AnomalyResult = worker_results[1].value
+    # one box per material error, the overlapping tiles of an error may come from different shards
+    material_error_results: list[EvalBox] = merge_boxes([box for shard in worker_results[2:] for box in shard.value])
+
+    qc_result, rows = get_qc_rows(measure_results, material_error_results, anomaly_result.reconstruction_error)
 
     if len(material_error_results):
         print("Drawing material errors and updating hmi image...")
@@ -110,61 +303,58 @@ async def process_image(img_pil):
             print(box.label, box.precision)
 
             # draw eval boxes into image
-            cv2.rectangle(image_cropped, box.top_left, box.bottom_right, color=(0, 255, 0), thickness=10)
-            # draw_text(image_cropped, text=f"{box.label} ({box.precision:.2f}", text_position=box.top_left)
+            cv2.rectangle(preview, _scaled_point(box.top_left, scale), _scaled_point(box.bottom_right, scale),
+                          color=(0, 255, 0), thickness=_scaled_thickness(10, scale))
+            # draw_text(preview, text=f"{box.label} ({box.precision:.2f}", text_position=box.top_left)
 
         # update HMI
-        await hmi.update_crop_image(image_cropped)
-
-
-    anomaly_result = bool(reconstruction_error <= RECONSTRUCTION_ERROR_THRESHOLD)
-    rows.append({'check': 'reconstruction_error',
-             'result': anomaly_result,
-             'actual': float(reconstruction_error),
-             'target': f"<= {RECONSTRUCTION_ERROR_THRESHOLD}"})
+        await hmi.update_crop_image(preview)
 
+    # the material errors are already drawn into the preview
+    image_measurements = preview.copy()
 
-    image_measurements = image_cropped.copy()
-
-    qc_result = anomaly_result
     for idx, measurement in enumerate(measure_results):  # type: int, distance_measurement
-        variance = measurement.variance
-        rows.append({
-            'check': measurement.name,
-            'result': measurement.is_ok,
-            'actual': measurement.distance,
-            'target': f'{variance[0]} - {variance[1]}'
-        })
-        if not measurement.is_ok:
-            qc_result = False
-
         # draw features into image
-        p_1 = (int(measurement.p_1[0]), int(measurement.p_1[1]))
-        p_2 = (int(measurement.p_2[0]), int(measurement.p_2[1]))
+        p_1 = _scaled_point(measurement.p_1, scale)
+        p_2 = _scaled_point(measurement.p_2, scale)
         c = idx % 9
         color = [250 * (c & 1), 250 * (c & 2), 250 * (c & 4)]
 
-        cv2.line(image_measurements, p_1, p_2, color, 20)
-
-    for box in material_error_results:
-        # draw eval boxes into image
-        cv2.rectangle(image_measurements, box.top_left, box.bottom_right, color=(0, 255, 0), thickness=10)
-        qc_result = False
+        cv2.line(image_measurements, p_1, p_2, color, _scaled_thickness(20, scale))
 
 
-    print("Updating QC result rows...")
-    await hmi.update_qc_results(rows)
+    with tracer.span(trace_id, "hmi_update"):
+        print("Updating QC result rows...")
+        await hmi.update_qc_results(rows)
 
-    print("Updating Measurement image...")
-    await hmi.update_measure_image(image_measurements)
+        print("Updating Measurement image...")
+        await hmi.update_measure_image(image_measurements)
 
-    print("Updating Reconstructed image...")
-    await hmi.update_reconstructed_image(reconstructed_image)
+        print("Updating anomaly image...")
+        await hmi.update_reconstructed_image(_anomaly_image(preview, anomaly_result, scale))
 
-    print("Saving to database...")
-    qc_db.insert_quality_check(qc_result, rows, image_cropped)
+    with tracer.span(trace_id, "db_write"):
+        print("Saving to database...")
+        check_id = qc_db.insert_quality_check(qc_result, rows, preview, image_resize=False,
+                                              model_versions=model_versions)
 
-    processing_done = True
+    # handle ui notification as background task
+    asyncio.ensure_future(_finish_notification(sheet.notification))
+
+    sheet.spans.extend(tracer.pop_spans(trace_id))
+    sheet.spans.append(Span(trace_id, "sheet", sheet.start, time.perf_counter() - sheet.before))
+    qc_db.insert_stage_timings(check_id, sheet.spans)
+    latency_statistics.add_spans(sheet.spans)
+    await hmi.update_performance(latency_statistics.get_rows())
+    # the tile counts of the shards add up to the sheet, a cached result has none
+    if all(worker_result.counts for worker_result in worker_results[2:]):
+        counts = Counter()
+        for worker_result in worker_results[2:]:
+            counts.update({f"material_error_{name}": count for name, count in worker_result.counts.items()})
+        qc_db.insert_stage_counts(check_id, trace_id, counts)
+        count_statistics.add_counts(counts)
+        await hmi.update_counts(count_statistics.get_rows())
+    await hmi.update_models(model_rows())
 
     if not args.dummy:
         if qc_result:
@@ -173,9 +363,10 @@ async def process_image(img_pil):
             send_command("nok")
 
 
-
 async def dummy_scan_loop():
+    await workers_ready.wait()
     while True:
+        await in_flight.acquire()
         notification = ui.notification(message="Scanning...", spinner=True, timeout=None)
         await asyncio.sleep(5)  # Simulates scanning process
         new_image = get_random_dummy_image()
@@ -183,7 +374,11 @@ async def dummy_scan_loop():
         await asyncio.sleep(0.1)
 
         print("Processing dummy image...")
-        await process_image(new_image)
+        try:
+            await dispatch_image(new_image)
+        except Exception as ex:
+            in_flight.release()
+            ui.notify(str(ex), type="negative")
 
 
 
@@ -195,39 +390,134 @@ if __name__ == "__main__":
                         action='store_true')
     parser.add_argument("--dpi", type=int, default=600, help="DPI setting of Scanner")
     parser.add_argument("--store-scans", help="Store scans additionally as files", action="store_true")
+    parser.add_argument("--max-in-flight", type=int, default=2,
+                        help="Number of sheets processed at the same time, the scanner waits if the pipeline is full. "
+                             "Only overlaps sheets in --dummy mode, the microcontroller of the test bench accepts "
+                             "the next sheet only after the ok/nok of the previous one")
+    parser.add_argument("--frame-slots", type=int, default=None,
+                        help="Number of full resolution images shared between the processes at the same time, "
+                             "defaults to 2 * max-in-flight + 2")
+    parser.add_argument("--material-workers", type=int, default=1,
+                        help="Number of processes sharing the material error detection of a sheet")
+    parser.add_argument("--stage-cache", metavar="DIR",
+                        help="cache the results of the dummy scans in this directory, only used with --dummy")
+    parser.add_argument("--band-height", type=int, default=None, metavar="ROWS",
+                        help="copy the scans into the shared frames and remove the background in bands of this many "
+                             "rows, so the memory of the intermediate images does not grow with the dpi, e.g. 1024 "
+                             "for 1200 dpi")
+    parser.add_argument("--material-model", default=None, metavar="PATH",
+                        help="onnx model of the material error detection, e.g. the INT8 model of "
+                             "quantize_material_model.py, defaults to the FP32 model")
+    parser.add_argument("--min-fabric-fraction", type=float, default=None, metavar="FRACTION",
+                        help="skip the material error detection of tiles with less fabric, e.g. on the margin of "
+                             "narrow products, 0 analyses all tiles, defaults to 0.05")
+    parser.add_argument("--model-registry", default="./model_registry", metavar="DIR",
+                        help="versioned models, the workers start with the active version of every model registered "
+                             "there and load other versions from the models tab, see libs/model_registry.py")
+    parser.add_argument("--anomaly-backend", choices=["torch", "onnx"], default="torch",
+                        help="run the anomaly detection with torch or with onnxruntime and the model of "
+                             "export_autoencoder_onnx.py, which starts faster, a registered anomaly model takes "
+                             "precedence, its backend follows the model file")
+    parser.add_argument("--anomaly-reconstruction", action="store_true",
+                        help="show the reconstructed image of the anomaly detection instead of the error heatmap, "
+                             "the full image is sent from the worker for every sheet")
     args = parser.parse_args()
+    startup_time = time.time()
+
+    # scans of the scanner are never processed twice
+    stage_cache_dir = args.stage_cache if args.dummy else None
+    stage_cache = StageCache(stage_cache_dir) if stage_cache_dir else None
+
+    # Shared memory for the images exchanged with the processes, has to exist before the processes are started
+    # every sheet in flight holds its two blacked out images, the scanner the scans not yet cropped
+    frame_pool = FramePool(args.frame_slots or 2 * args.max_in_flight + 2, frame_bytes_for_dpi(args.dpi))
+    app.on_shutdown(frame_pool.unlink)
 
     # Setup Processes and their connections to main process
     measure_parent_conn, measure_child_conn = Pipe()
-    measure_process = Process(target=measurement_process, args=(measure_child_conn, args.dpi), name="Measurement")
+    measure_process = Process(target=measurement_process,
+                              args=(measure_child_conn, args.dpi, frame_pool, stage_cache_dir), name="Measurement")
     measure_process.start()
+    measure_conn = AsyncConnection(measure_parent_conn)
+
+    # the workers start with the active models of the registry, an explicit --material-model takes precedence
+    model_registry = ModelRegistry(args.model_registry)
+    material_model, anomaly_model = registry_model_paths(args.model_registry, args.material_model,
+                                                         args.anomaly_backend)
 
     anomaly_parent_conn, anomaly_child_conn = Pipe()
-    anomaly_process = Process(target=anomaly_detect_process, args=(anomaly_child_conn,), name="Anomaly Detection")
+    anomaly_control_conn, anomaly_child_control_conn = Pipe()
+    anomaly_process = Process(target=anomaly_detect_process,
+                              args=(anomaly_child_conn, args.dpi, frame_pool, stage_cache_dir, anomaly_model,
+                                    anomaly_child_control_conn, args.model_registry),
+                              name="Anomaly Detection")
     anomaly_process.start()
-
-    material_error_parent_conn, material_error_child_conn = Pipe()
-    material_error_process = Process(target=material_error_process, args=(material_error_child_conn, args.dpi),
-                                     name="Material Error Detection")
-    material_error_process.start()
+    anomaly_conn = AsyncConnection(anomaly_parent_conn)
+
+    # the tiles of every sheet are split into horizontal shards, one per material error process
+    material_error_conns = []
+    material_error_control_conns = []
+    for shard_index in range(args.material_workers):
+        material_error_parent_conn, material_error_child_conn = Pipe()
+        material_error_control_conn, material_error_child_control_conn = Pipe()
+        Process(target=material_error_process,
+                args=(material_error_child_conn, args.dpi, frame_pool, shard_index, args.material_workers,
+                      stage_cache_dir, material_model, args.min_fabric_fraction,
+                      material_error_child_control_conn, args.model_registry),
+                name=f"Material Error Detection {shard_index}").start()
+        material_error_conns.append(AsyncConnection(material_error_parent_conn))
+        material_error_control_conns.append(AsyncConnection(material_error_control_conn))
+
+    # models which can be reloaded while running: the sheet connections get the swap, the control connections
+    # the reload commands
+    model_conns = {ANOMALY_MODEL: [anomaly_conn], MATERIAL_ERROR_MODEL: material_error_conns}
+    model_controls = {ANOMALY_MODEL: [AsyncConnection(anomaly_control_conn)],
+                      MATERIAL_ERROR_MODEL: material_error_control_conns}
+    active_versions: dict[str, str | None] = {}
+    reload_lock = asyncio.Lock()
 
     # homology_parent_conn, homology_child_conn = Pipe()
-    # homology_process = Process(target=homology_process, args=(homology_child_conn,), name="Homology")
+    # homology_process = Process(target=homology_process, args=(homology_child_conn, args.dpi, frame_pool),
+    #                            name="Homology")
     # homology_process.start()
+    # homology_conn = AsyncConnection(homology_parent_conn)
 
     if not args.dummy:
         scan_parent_conn, scan_child_conn = Pipe()
-        scan_process = Process(target=scanner_process, args=(scan_child_conn, args.dpi, args.store_scans), name="Scanner")
+        scan_process = Process(target=scanner_process,
+                               args=(scan_child_conn, args.dpi, frame_pool, args.store_scans, args.band_height),
+                               name="Scanner")
         scan_process.start()
+        scan_conn = AsyncConnection(scan_parent_conn)
 
-    qc_db = QualityCheckDB()
+    # every worker reports once it is ready to process sheets
+    worker_conns = [measure_conn, anomaly_conn, *material_error_conns]
+    if not args.dummy:
+        worker_conns.append(scan_conn)
 
-    hmi = HMI()
+    qc_db = QualityCheckDB()
 
-    # start scan loop (dummy if corresponding argument was given)
+    hmi = HMI(models=list(model_controls), on_reload_model=reload_model)
+
+    # stage timings of the sheets, the percentiles continue where the last run stopped
+    tracer = Tracer()
+    latency_statistics = LatencyStatistics()
+    for stage, duration in qc_db.retrieve_stage_timings():
+        latency_statistics.add(stage, duration)
+    # counters of the sheets, e.g. the skipped tiles of the material error detection
+    count_statistics = CountStatistics()
+    for name, count in qc_db.retrieve_stage_counts():
+        count_statistics.add(name, count)
+
+    # sheets dispatched to the workers, in scan order
+    in_flight = asyncio.Semaphore(args.max_in_flight)
+    pending_sheets: asyncio.Queue[Sheet] = asyncio.Queue()
+    workers_ready = asyncio.Event()
+
+    # start scan loop (dummy if corresponding argument was given) and the loop committing the results,
+    # the scanner is started and the microcontroller is sent ready once all workers are warmed up
+    ui.timer(0.1, wait_for_workers, once=True)
     ui.timer(0.1, dummy_scan_loop if args.dummy else scan_loop, once=True)
-
-    if not args.dummy:
-        send_command("ready")
+    ui.timer(0.1, commit_loop, once=True)
 
     ui.run(reload=False, port=6969, title="GAIH Köstler Demonstration HMI")
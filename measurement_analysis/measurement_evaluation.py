@@ -30,16 +30,20 @@ class MeasurementEvaluator(object):
         super().__init__()
 
    
-    def analyse(self,image : cv2.typing.MatLike, dpi = 600)->list[dtos.DistanceMeasurement]:
+    def analyse(self,image : cv2.typing.MatLike, dpi = 600, background_removed = False)->list[dtos.DistanceMeasurement]:
         '''
         Analyse the geometry.
 
         Arguments:
             image: The cropped image.
             dpi: scanned dpi.
+            background_removed: The grey background of the image is already replaced by black (with morph step),
+                see preprocessing.BLACKED_OUT.
         '''
         measurements : list[dtos.DistanceMeasurement] = []
-        preprocessed = pre.replace_grey_with_black_hsv(image=image,morph_step=True)
+        preprocessed = image
+        if not background_removed:
+            preprocessed = pre.replace_grey_with_black_hsv(image=image,morph_step=True)
         _, width = preprocessed.shape[:2]
         square = ob_detection.detect_square_corners_simple(preprocessed, 100)
         self._get_square_measurements(measurements, square,dpi)
@@ -1,105 +1,359 @@
+import os
 import time
 from datetime import datetime
 
 from multiprocessing.connection import Connection
 
-from libs.preprocessing import replace_grey_with_black_hsv
+import numpy as np
 
+from data_transfer.dtos import AnomalyResult, SheetJob, SwapModel, WorkerReady, WorkerResult
+from libs.model_registry import ModelRegistry, ModelReloader, ModelVersion
+from libs.preprocessing import BLACKED_OUT, BLACKED_OUT_RAW, IMAGE
+from libs.pyramid import ImagePyramid
+from libs.shared_frames import FramePool
+from libs.stage_cache import StageCache, anomaly_config_id, cached, material_error_config_id, measurement_config_id
+from libs.streaming import pil_bands, pil_shape
+from libs.tracing import Tracer
 
-def scanner_process(conn: Connection, dpi: int, store_scans = False):
+# artifacts of a sheet every stage works on, computed once per sheet by the main process, see
+# libs.preprocessing.remove_background
+STAGE_ARTIFACTS = {
+    "measurement": (BLACKED_OUT,),
+    "material_error": (BLACKED_OUT,),
+    "anomaly": (BLACKED_OUT_RAW,),
+    "homology": (IMAGE,),
+}
+
+# names of the models in the model registry, see libs.model_registry
+MATERIAL_ERROR_MODEL = "material_error"
+ANOMALY_MODEL = "anomaly"
+HOMOLOGY_MODEL = "homology"
+# default model of every backend of the anomaly detection, see create_anomaly_detector
+ANOMALY_MODEL_PATHS = {
+    "torch": "Autoencoder/autoencoder_Final.pth",
+    "onnx": "Autoencoder/autoencoder_Final.onnx",
+}
+ANOMALY_MODEL_PATH = ANOMALY_MODEL_PATHS["torch"]
+# scale of the anomaly heatmap relative to the cropped sheet, the scale the HMI shows the sheet with
+ANOMALY_HEATMAP_SCALE = 0.25
+
+# nominal size of the fabric (warp x weft edge), see measurement_analysis/configurations/measurement.json
+NOMINAL_SHEET_MM = (240, 169)
+
+
+def _warm_up_image(dpi: int) -> np.ndarray:
+    ''' A blank cropped sheet of the nominal size, image_crop keeps a border of 100 px around the fabric. '''
+    height = round(NOMINAL_SHEET_MM[0] / 25.4 * dpi) + 200
+    width = round(NOMINAL_SHEET_MM[1] / 25.4 * dpi) + 200
+    return np.full((height, width, 3), 255, dtype=np.uint8)
+
+
+def _warm_up(tracer: Tracer, stage: str, func, *args, **kwargs):
+    '''
+    Run a first inference at the input shapes of a real sheet before the first sheet arrives, so the lazy
+    allocations and kernel selection of the inference runtimes do not slow down the first sheet.
+    '''
+    with tracer.span(None, stage):
+        try:
+            func(*args, **kwargs)
+        except Exception as ex:
+            print(f"Warning! Warm-up {stage} failed: {ex}")
+
+
+def _warm_up_material_error(material_error_detector, dpi: int, shard_index: int, shard_count: int):
+    '''
+    Warm up every stage of analyse on the tiles of the shard. The cascade would stop the blank tiles of the warm-up
+    sheet, so the classifier runs on them directly.
+    '''
+    band, eval_boxes, band_top = material_error_detector.shard_band(_warm_up_image(dpi), shard_index, shard_count,
+                                                                     background_removed=True)
+    eval_boxes = material_error_detector.filter_background_tiles(band, eval_boxes, band_top)
+    if len(eval_boxes) == 0:
+        return
+    material_error_detector.cascade_scores(band, eval_boxes, band_top)
+    material_error_detector.predict_tiles(band, eval_boxes, band_top)
+
+
+def model_version(name: str, path: str) -> ModelVersion | None:
+    ''' The version of the model file a worker started with, None if the file is missing. '''
+    try:
+        return ModelVersion.from_file(name, path)
+    except OSError:
+        return None
+
+
+def registry_model_paths(registry_dir: str, material_model: str | None = None,
+                         anomaly_backend: str = "torch") -> tuple[str | None, str]:
+    '''
+    The models the workers start with, the active versions of the model registry.
+
+    Parameters:
+        registry_dir: root of the model registry, see libs.model_registry.
+        material_model: explicit model of the material error detection, takes precedence over the registry.
+        anomaly_backend: backend of the default anomaly model if no anomaly model is registered.
+
+    Returns:
+        material_model: the material error model, None takes the model of the detector configuration.
+        anomaly_model: the anomaly model, its backend follows the model file.
+    '''
+    model_registry = ModelRegistry(registry_dir)
+    return (material_model or model_registry.active_path(MATERIAL_ERROR_MODEL),
+            model_registry.active_path(ANOMALY_MODEL) or ANOMALY_MODEL_PATHS[anomaly_backend])
+
+
+def _release(frames: FramePool, job: SheetJob):
+    for frame in job.frames.values():
+        frames.release(frame)
+
+
+def _put_scan(frames: FramePool, scanned_image, band_height: int | None):
+    ''' Copies the scan into a shared frame, band by band if band_height is given. '''
+    if band_height is None:
+        return frames.put(np.asarray(scanned_image))
+    frame = frames.acquire(pil_shape(scanned_image))
+    try:
+        view = frames.view(frame)
+        for rows, band in pil_bands(scanned_image, band_height):
+            view[rows] = band
+    except Exception:
+        frames.release(frame)
+        raise
+    return frame
+
+
+def scanner_process(conn: Connection, dpi: int, frames: FramePool, store_scans = False,
+                    band_height: int | None = None):
     from libs.scanner import Scanner
-    scanner = Scanner()
+    tracer = Tracer()
+    with tracer.span(None, "scanner_startup"):
+        scanner = Scanner()
+    conn.send(WorkerReady("scanner", tracer.pop_spans()))
 
     while True:
-        try:
-            scanned_image = scanner.scan_document(dpi)
-            print("Successfully scanned!")
-            conn.send((True, scanned_image))
+        conn.recv()  # blocks until the main process has room for the next sheet
+        while True:
+            try:
+                # the trace id is assigned by the main process when it receives the scan
+                with tracer.span(None, "scan"):
+                    scanned_image = scanner.scan_document(dpi)
+                    frame = _put_scan(frames, scanned_image, band_height)
+                print("Successfully scanned!")
+                conn.send((True, frame, tracer.pop_spans()))
+            except Exception as ex:
+                tracer.pop_spans()
+                if not "feeder out of" in str(ex):
+                    print(ex)
+                    conn.send((False, str(ex), []))
+                    time.sleep(1)
+                continue
+
             if store_scans:
                 # Erstelle einen eindeutigen Dateinamen mit Zeitstempel
                 file_name = f"scan_output_{datetime.now().strftime("%Y%m%d_%H%M%S")}.png"
                 scanned_image.save(file_name)
                 print(f"Bild gespeichert als {file_name}.")
-
-        except Exception as ex:
-            if not "feeder out of" in str(ex):
-                print(ex)
-                conn.send((False, str(ex)))
-                time.sleep(1)
+            break
 
 
 
-def anomaly_detect_process(conn: Connection):
+def create_anomaly_detector(path_to_model: str = ANOMALY_MODEL_PATH, num_threads: int = 0):
+    """
+    The backend follows the model file: onnx models of export_autoencoder_onnx.py run with onnxruntime and the session
+    options of the material error detection, without importing torch, the state dicts of Autoencoder/train.py with
+    torch. num_threads only applies to onnxruntime, 0 takes the session configuration.
+    """
+    if path_to_model.endswith(".onnx"):
+        from Autoencoder.onnx_inference import OnnxAnomalyDetector
+        return OnnxAnomalyDetector(path_to_model, num_threads)
     from Autoencoder.test import AnomalyDetectionAutoencoder
+    return AnomalyDetectionAutoencoder(path_to_model)
 
-    try:
-        anomaly_detector = AnomalyDetectionAutoencoder("Autoencoder/autoencoder_Final.pth")
-
-        while True:
-            print("Anomaly Detect Process: Waiting for input image!")
-            cropped_img = conn.recv()  # blocks until something is received
-            print("Anomaly Detect Process: Received input image!")
 
-            before = datetime.now()
-            black_cropped = replace_grey_with_black_hsv(cropped_img)
-            print(f"Changing Background to Black took {datetime.now() - before}!")
+def _load_anomaly_detector(dpi: int, version: ModelVersion):
+    ''' Loads and warms up a reloaded autoencoder, raises instead of deactivating the detection like on startup. '''
+    anomaly_detector = create_anomaly_detector(version.path)
+    anomaly_detector.reconstruct_image(_warm_up_image(dpi))
+    return anomaly_detector
 
-            before = datetime.now()
-            output_image, reconstruction_error = anomaly_detector.reconstruct_image(black_cropped)
-            print(f"Anomaly Detection took {datetime.now() - before}!")
 
-            conn.send((output_image, reconstruction_error))
+def anomaly_detect_process(conn: Connection, dpi: int, frames: FramePool, cache_dir: str | None = None,
+                           path_to_model: str = ANOMALY_MODEL_PATH, control_conn: Connection | None = None,
+                           registry_dir: str | None = None):
+    from Autoencoder.anomaly_map import anomaly_result
+    stage_cache = StageCache(cache_dir) if cache_dir else None
+    tracer = Tracer()
+    try:
+        with tracer.span(None, "anomaly_startup"):
+            anomaly_detector = create_anomaly_detector(path_to_model)
+        _warm_up(tracer, "anomaly_warmup", anomaly_detector.reconstruct_image, _warm_up_image(dpi))
     except FileNotFoundError:
-        while True:  # we still need to receive and send data
+        anomaly_detector = None
+    # a new model is loaded in the background and swapped in between two sheets, see libs.model_registry
+    reloader = ModelReloader("anomaly", model_version(ANOMALY_MODEL, path_to_model), registry_dir, control_conn,
+                             lambda version: _load_anomaly_detector(dpi, version))
+    conn.send(WorkerReady("anomaly", tracer.pop_spans()))
+
+    while True:
+        print("Anomaly Detect Process: Waiting for input image!")
+        job: SheetJob | SwapModel = conn.recv()  # blocks until something is received
+        if isinstance(job, SwapModel):
+            anomaly_detector = reloader.swap(job) or anomaly_detector
+            continue
+        print("Anomaly Detect Process: Received input image!")
+
+        if anomaly_detector is None:  # we still need to receive and send data
             print("Warning! Could not load anomaly detection autoencoder! Anomaly detection inactive!")
-            conn.recv()  # blocks until something is received
-            conn.send((None, 0))
+            _release(frames, job)
+            conn.send(WorkerResult(job.trace_id, AnomalyResult(None, 0, []), []))
+            continue
+
+        anomaly_key = None
+        if stage_cache is not None and job.image_id is not None:
+            anomaly_key = StageCache.key(job.image_id, "anomaly",
+                                         anomaly_config_id(anomaly_detector, ANOMALY_HEATMAP_SCALE,
+                                                           job.with_reconstruction))
+            found, result = stage_cache.get(anomaly_key)
+            if found:
+                _release(frames, job)
+                conn.send(WorkerResult(job.trace_id, result, tracer.pop_spans(), reloader.active_version))
+                continue
+
+        with tracer.span(job.trace_id, "anomaly_detection"):
+            # the pyramid levels of the model input are reused for the error map
+            pyramid = ImagePyramid(frames.view(job.frames[BLACKED_OUT_RAW]))
+            output_image, reconstruction_error = anomaly_detector.reconstruct_image(pyramid)
+        with tracer.span(job.trace_id, "anomaly_map"):
+            # only the heatmap and the regions are sent to the main process, the reconstruction on request
+            result = anomaly_result(pyramid, output_image, reconstruction_error, ANOMALY_HEATMAP_SCALE,
+                                    job.with_reconstruction)
+            del pyramid
+            _release(frames, job)
 
-def homology_process(conn: Connection):
+        if anomaly_key is not None:
+            stage_cache.put(anomaly_key, result)
+        conn.send(WorkerResult(job.trace_id, result, tracer.pop_spans(), reloader.active_version))
+
+
+def _load_homology_detector(dpi: int, version: ModelVersion):
+    ''' Loads and warms up a reloaded boundary model. '''
     from err_detection.boundary_evaluation import HomologyDetector
+    homology_detector = HomologyDetector(version.path)
+    homology_detector.analyse(_warm_up_image(dpi))
+    return homology_detector
+
 
-    homology_detector = HomologyDetector()
+def homology_process(conn: Connection, dpi: int, frames: FramePool, path_to_model: str | None = None,
+                     control_conn: Connection | None = None, registry_dir: str | None = None):
+    tracer = Tracer()
+    with tracer.span(None, "homology_startup"):
+        from err_detection.boundary_evaluation import HomologyDetector
+        homology_detector = HomologyDetector(path_to_model) if path_to_model else HomologyDetector()
+    _warm_up(tracer, "homology_warmup", homology_detector.analyse, _warm_up_image(dpi))
+    reloader = ModelReloader("homology", model_version(HOMOLOGY_MODEL, path_to_model) if path_to_model else None,
+                             registry_dir, control_conn, lambda version: _load_homology_detector(dpi, version))
+    conn.send(WorkerReady("homology", tracer.pop_spans()))
 
     while True:
         print("Homology Process: Waiting for input image!")
-        cropped_img = conn.recv()  # blocks until something is received
+        job: SheetJob | SwapModel = conn.recv()  # blocks until something is received
+        if isinstance(job, SwapModel):
+            homology_detector = reloader.swap(job) or homology_detector
+            continue
         print("Homology Process: Received input image!")
-        before = datetime.now()
-        homology_results = homology_detector.analyse(cropped_img)
-        print(f"Homology took {datetime.now() - before}!")
-        conn.send(homology_results)
+        with tracer.span(job.trace_id, "homology"):
+            homology_results = homology_detector.analyse(frames.view(job.frames[IMAGE]))
+            _release(frames, job)
+        conn.send(WorkerResult(job.trace_id, homology_results, tracer.pop_spans(), reloader.active_version))
 
 
-def measurement_process(conn: Connection, dpi: int):
-    from measurement_analysis.measurement_evaluation import MeasurementEvaluator
-
-    measurement_evaluator = MeasurementEvaluator()
+def measurement_process(conn: Connection, dpi: int, frames: FramePool, cache_dir: str | None = None):
+    # the measurement has no model, loading the configuration and templates is all there is to prepare
+    tracer = Tracer()
+    with tracer.span(None, "measurement_startup"):
+        from measurement_analysis.measurement_evaluation import MeasurementEvaluator
+        measurement_evaluator = MeasurementEvaluator()
+    stage_cache = StageCache(cache_dir) if cache_dir else None
+    conn.send(WorkerReady("measurement", tracer.pop_spans()))
 
     while True:
         print("Measurement Process: Waiting for input image!")
-        cropped_img = conn.recv()  # blocks until something is received
+        job: SheetJob = conn.recv()  # blocks until something is received
         print("Measurement Process: Received input image!")
-        before = datetime.now()
-        results = measurement_evaluator.analyse(cropped_img, dpi)
-        print(f"Measurement took {datetime.now() - before}!")
-        conn.send(results)
+        with tracer.span(job.trace_id, "measurement"):
+            results = cached(stage_cache, job.image_id, "measurement",
+                             lambda: measurement_config_id(measurement_evaluator, dpi),
+                             measurement_evaluator.analyse, frames.view(job.frames[BLACKED_OUT]), dpi,
+                             background_removed=True)
+            _release(frames, job)
+        conn.send(WorkerResult(job.trace_id, results, tracer.pop_spans()))
 
 
-def material_error_process(conn: Connection, dpi: int):
+def create_material_error_detector(dpi: int, num_threads: int = 0, path_to_model: str | None = None,
+                                   min_fabric_fraction: float | None = None):
+    """
+    The tiles cover the same area of the sheet for every dpi setting, 1024 px at 600 dpi.
+    path_to_model replaces the default FP32 model, e.g. by the INT8 model of quantize_material_model.py,
+    min_fabric_fraction the default of MaterialErrorDetector.
+    """
     from err_detection.material_evaluation import MaterialErrorDetector
 
-    if dpi == 600:
-        material_error_detector = MaterialErrorDetector()
-    elif dpi == 300:
-        material_error_detector = MaterialErrorDetector(size=512)
-    else:
+    if dpi <= 0:
         raise RuntimeError("Invalid DPI setting!")
+    options = {}
+    if path_to_model is not None:
+        options["path_to_model"] = path_to_model
+    if min_fabric_fraction is not None:
+        options["min_fabric_fraction"] = min_fabric_fraction
+    return MaterialErrorDetector(size=1024 * dpi // 600, num_threads=num_threads, **options)
+
+
+def _load_material_error_detector(dpi: int, num_threads: int, version: ModelVersion,
+                                  min_fabric_fraction: float | None, shard_index: int, shard_count: int):
+    ''' Loads and warms up a reloaded material error model, raises instead of running without a model. '''
+    material_error_detector = create_material_error_detector(dpi, num_threads, version.path, min_fabric_fraction)
+    if material_error_detector.session is None:
+        # raises the error of onnxruntime the constructor only printed
+        material_error_detector.reinit(version.path, material_error_detector.size, material_error_detector.r_scale)
+    _warm_up_material_error(material_error_detector, dpi, shard_index, shard_count)
+    return material_error_detector
+
+
+def material_error_process(conn: Connection, dpi: int, frames: FramePool, shard_index: int = 0, shard_count: int = 1,
+                           cache_dir: str | None = None, path_to_model: str | None = None,
+                           min_fabric_fraction: float | None = None, control_conn: Connection | None = None,
+                           registry_dir: str | None = None):
+    # share the cores between the workers of the pool instead of oversubscribing them
+    num_threads = max(1, os.cpu_count() // shard_count) if shard_count > 1 else 0
+    tracer = Tracer()
+    with tracer.span(None, f"material_error_{shard_index}_startup"):
+        material_error_detector = create_material_error_detector(dpi, num_threads, path_to_model,
+                                                                 min_fabric_fraction)
+    _warm_up(tracer, f"material_error_{shard_index}_warmup", _warm_up_material_error, material_error_detector, dpi,
+             shard_index, shard_count)
+    stage_cache = StageCache(cache_dir) if cache_dir else None
+    reloader = ModelReloader(f"material_error_{shard_index}",
+                             model_version(MATERIAL_ERROR_MODEL, material_error_detector.path_to_model),
+                             registry_dir, control_conn,
+                             lambda version: _load_material_error_detector(dpi, num_threads, version,
+                                                                           min_fabric_fraction, shard_index,
+                                                                           shard_count))
+    conn.send(WorkerReady(f"material_error_{shard_index}", tracer.pop_spans()))
 
     while True:
-        print("Material Error Process: Waiting for input image!")
-        cropped_img = conn.recv()  # blocks until something is received
-        print("Material Error Process: Received input image!")
-        before = datetime.now()
-        results = material_error_detector.analyse(cropped_img, 0.8)
-        print(f"Material Error Detection took {datetime.now() - before}!")
-        conn.send(results)
\ No newline at end of file
+        print(f"Material Error Process {shard_index}: Waiting for input image!")
+        job: SheetJob | SwapModel = conn.recv()  # blocks until something is received
+        if isinstance(job, SwapModel):
+            # the stage cache key contains the model checksum, so the new model does not reuse the old results
+            material_error_detector = reloader.swap(job) or material_error_detector
+            continue
+        print(f"Material Error Process {shard_index}: Received input image!")
+        # stays empty if the result is taken from the stage cache
+        material_error_detector.tile_counts = {}
+        with tracer.span(job.trace_id, f"material_error_{shard_index}"):
+            results = cached(stage_cache, job.image_id, "material_error",
+                             lambda: material_error_config_id(material_error_detector, 0.8, shard_index, shard_count),
+                             material_error_detector.analyse, frames.view(job.frames[BLACKED_OUT]), 0.8,
+                             shard_index=shard_index, shard_count=shard_count, background_removed=True)
+            _release(frames, job)
+        conn.send(WorkerResult(job.trace_id, results, tracer.pop_spans(), reloader.active_version,
+                               material_error_detector.tile_counts))
@@ -0,0 +1,224 @@
+"""
+Static INT8 quantization of the material error model, see transform_tf_to_onnx.py for the conversion of the
+trained keras model to onnx.
+
+The quantization is calibrated on tiles of our own scans, cut, filtered and preprocessed by the MaterialErrorDetector
+tiler exactly like on the test bench. Afterwards the FP32 and the INT8 model are compared on the tiles of the evaluation
+scans: agreement of the decisions at the detection threshold, difference of the probabilities and latency per
+batch. The FP32 model is the reference, so the agreement is the accuracy of the INT8 model relative to it.
+The quantized model has the same float input and output, MaterialErrorDetector runs it like the FP32 model:
+
+    python quantize_material_model.py --calibration-dir archive/calibration --eval-dir archive/evaluation
+    python main.py --material-model err_detection/models/res_net/resmodel50_int8.onnx
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+import onnxruntime
+from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat, QuantType,
+                                      quantize_static)
+from onnxruntime.quantization.shape_inference import quant_pre_process
+
+from libs.preprocessing import BLACKED_OUT, image_crop, remove_background
+from processes import create_material_error_detector
+
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".tif", ".tiff")
+
+
+def scan_tiles(scan_dir: str, dpi: int, model: str, max_tiles: int, seed: int = 0) -> np.ndarray:
+    '''
+    The preprocessed tiles of the scans in a directory, like MaterialErrorDetector.analyse feeds them to the model:
+    the tiles with too little fabric are skipped. A uniform random subset of the tiles is drawn scan by scan
+    (reservoir sampling), so the memory does not grow with the number of scans.
+
+    Parameters:
+        scan_dir: directory with uncropped scans.
+        dpi: dpi setting the scans were taken with.
+        model: the FP32 model, only used to set up the detector.
+        max_tiles: a random subset of at most this many tiles is returned.
+        seed: seed of the subset.
+
+    Returns:
+        tiles: float32 batch of the tiles (NHWC).
+    '''
+    detector = create_material_error_detector(dpi, path_to_model=model)
+    paths = sorted(path for path in Path(scan_dir).iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)
+    if len(paths) == 0:
+        raise RuntimeError(f"No scans in '{scan_dir}'!")
+    rng = np.random.default_rng(seed)
+    tiles = np.empty((max_tiles, detector.r_scale, detector.r_scale, 3), dtype=np.float32)
+    seen = 0
+    for path in paths:
+        image = cv2.imread(str(path))
+        if image is None:
+            print(f"Warning! Could not read image '{path}'!")
+            continue
+        blacked_out = remove_background(image_crop(image), (BLACKED_OUT,))[BLACKED_OUT]
+        eval_boxes = detector.filter_background_tiles(blacked_out, detector.get_tile_boxes(*blacked_out.shape[:2]))
+        # the reservoir slot of every tile, a later tile replaces an earlier one of the same slot
+        slots = {}
+        for eb in eval_boxes:
+            slot = seen if seen < max_tiles else int(rng.integers(seen + 1))
+            if slot < max_tiles:
+                slots[slot] = eb
+            seen += 1
+        if slots:
+            tiles[list(slots)] = detector.preprocess_tiles(blacked_out, list(slots.values()))
+    if seen == 0:
+        raise RuntimeError(f"No tiles with fabric in the scans of '{scan_dir}'!")
+    return tiles[:min(seen, max_tiles)]
+
+
+class TileCalibrationReader(CalibrationDataReader):
+    ''' Feeds the calibration tiles in batches to the quantization. '''
+    def __init__(self, input_name: str, tiles: np.ndarray, batch_size: int = 16) -> None:
+        self.input_name = input_name
+        self.tiles = tiles
+        self.batch_size = batch_size
+        self._first = 0
+
+    def get_next(self) -> dict[str, np.ndarray] | None:
+        if self._first >= len(self.tiles):
+            return None
+        batch = self.tiles[self._first:self._first + self.batch_size]
+        self._first += self.batch_size
+        return {self.input_name: batch}
+
+    def rewind(self):
+        self._first = 0
+
+
+def quantize(model: str, output: str, tiles: np.ndarray, calibrate_method: str = "MinMax", per_channel: bool = True,
+             preprocess: bool = True):
+    '''
+    Quantize the weights and activations of the model to INT8 (QDQ format), calibrated on the tiles.
+
+    Parameters:
+        model: the FP32 model.
+        output: path of the quantized model.
+        tiles: calibration tiles, see scan_tiles.
+        calibrate_method: name of an onnxruntime.quantization.CalibrationMethod.
+        per_channel: quantize the weights per output channel.
+        preprocess: run the shape inference and graph optimization recommended before the quantization.
+    '''
+    input_name = onnxruntime.InferenceSession(model).get_inputs()[0].name
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if preprocess:
+            preprocessed = os.path.join(tmp_dir, "preprocessed.onnx")
+            # the tiles have a fixed size, the onnx shape inference is sufficient for the convolutions
+            quant_pre_process(model, preprocessed, skip_symbolic_shape=True)
+            model = preprocessed
+        quantize_static(model, output, TileCalibrationReader(input_name, tiles),
+                        quant_format=QuantFormat.QDQ,
+                        per_channel=per_channel,
+                        activation_type=QuantType.QUInt8,
+                        weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod[calibrate_method])
+
+
+def _predict(session: onnxruntime.InferenceSession, tiles: np.ndarray, batch_size: int) -> tuple[np.ndarray, list]:
+    ''' Probabilities of the tiles and the duration of every batch. '''
+    input_name = session.get_inputs()[0].name
+    output_name = session.get_outputs()[0].name
+    predictions = []
+    durations = []
+    for first in range(0, len(tiles), batch_size):
+        before = time.perf_counter()
+        predictions.append(session.run([output_name], {input_name: tiles[first:first + batch_size]})[0])
+        durations.append(time.perf_counter() - before)
+    return np.concatenate(predictions), durations
+
+
+def compare(model: str, quantized: str, tiles: np.ndarray, precision: float = 0.8, batch_size: int = 16,
+            repeats: int = 3) -> dict:
+    '''
+    Compare the decisions and latency of the quantized model with the FP32 model.
+
+    Parameters:
+        model: the FP32 model, the reference.
+        quantized: the INT8 model.
+        tiles: evaluation tiles, see scan_tiles.
+        precision: detection threshold of the material error probability, see MaterialErrorDetector.analyse.
+        batch_size: tiles per session run.
+        repeats: how often the tiles are run for the latency.
+
+    Returns:
+        report: accuracy and latency of both models.
+    '''
+    report = {"tiles": len(tiles), "precision": precision, "batch_size": batch_size}
+    probabilities = {}
+    for name, path in (("fp32", model), ("int8", quantized)):
+        session = onnxruntime.InferenceSession(path)
+        _predict(session, tiles[:batch_size], batch_size)  # warm-up
+        durations = []
+        for _ in range(repeats):
+            prediction, batch_durations = _predict(session, tiles, batch_size)
+            durations.extend(batch_durations)
+        probabilities[name] = prediction[:, 1]
+        report[name] = {
+            "model": path,
+            "size_mb": os.path.getsize(path) / 1e6,
+            "batch_median_ms": statistics.median(durations) * 1000,
+            "tile_ms": sum(durations) / repeats / len(tiles) * 1000,
+            "material_errors": int(np.sum(prediction[:, 1] > precision)),
+        }
+
+    difference = np.abs(probabilities["int8"] - probabilities["fp32"])
+    decisions_fp32 = probabilities["fp32"] > precision
+    decisions_int8 = probabilities["int8"] > precision
+    report["agreement"] = float(np.mean(decisions_fp32 == decisions_int8))
+    report["missed_material_errors"] = int(np.sum(decisions_fp32 & ~decisions_int8))
+    report["additional_material_errors"] = int(np.sum(~decisions_fp32 & decisions_int8))
+    report["probability_difference_mean"] = float(difference.mean())
+    report["probability_difference_max"] = float(difference.max())
+    report["speedup"] = report["fp32"]["tile_ms"] / report["int8"]["tile_ms"]
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static INT8 quantization of the material error model")
+    parser.add_argument("--model", default="./err_detection/models/res_net/resmodel50.onnx", help="the FP32 model")
+    parser.add_argument("--output", default="./err_detection/models/res_net/resmodel50_int8.onnx",
+                        help="path of the quantized model")
+    parser.add_argument("--calibration-dir", required=True, help="uncropped scans to calibrate the quantization on")
+    parser.add_argument("--eval-dir", help="uncropped scans to compare the models on, defaults to the calibration "
+                                           "scans, which overestimates the agreement")
+    parser.add_argument("--dpi", type=int, default=600, help="DPI setting the scans were taken with")
+    parser.add_argument("--calibration-tiles", type=int, default=500, help="maximum number of calibration tiles")
+    parser.add_argument("--eval-tiles", type=int, default=2000, help="maximum number of evaluation tiles")
+    parser.add_argument("--calibrate-method", default="MinMax", choices=[method.name for method in CalibrationMethod])
+    parser.add_argument("--per-tensor", action="store_true", help="quantize the weights per tensor, not per channel")
+    parser.add_argument("--skip-preprocess", action="store_true",
+                        help="skip the shape inference and graph optimization before the quantization")
+    parser.add_argument("--precision", type=float, default=0.8, help="detection threshold used for the agreement")
+    parser.add_argument("--report", default="quantization_report.json", help="json file to write the report to")
+    args = parser.parse_args()
+
+    print("Preparing calibration tiles...")
+    calibration_tiles = scan_tiles(args.calibration_dir, args.dpi, args.model, args.calibration_tiles)
+    print(f"Quantizing {args.model} with {len(calibration_tiles)} tiles...")
+    quantize(args.model, args.output, calibration_tiles, args.calibrate_method, not args.per_tensor,
+             not args.skip_preprocess)
+    print(f"Saved {args.output}")
+
+    if args.eval_dir is None:
+        print("Warning! The models are compared on the calibration scans!")
+    eval_tiles = scan_tiles(args.eval_dir or args.calibration_dir, args.dpi, args.model, args.eval_tiles, seed=1)
+    report = compare(args.model, args.output, eval_tiles, args.precision)
+    print(f"{report['tiles']} tiles, decisions agree on {report['agreement'] * 100:.2f}% "
+          f"({report['missed_material_errors']} missed, {report['additional_material_errors']} additional "
+          f"material errors), probability difference mean {report['probability_difference_mean']:.4f} "
+          f"max {report['probability_difference_max']:.4f}")
+    for name in ("fp32", "int8"):
+        print(f"{name}: {report[name]['tile_ms']:.2f} ms per tile, {report[name]['size_mb']:.1f} MB")
+    print(f"speedup {report['speedup']:.2f}x")
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Saved {args.report}")